@@ -0,0 +1,99 @@
+"""Benchmark parallel_features.compute_features from 1 to N worker processes.
+
+A synthetic qlib bin store (random-walk prices for --instruments stocks over
+--days business days) is written to --work-dir, Alpha158 features are built
+with 1, 2, 4, ... up to --max-workers processes, and each result is checked
+to be identical to the single-process one.
+
+    python benchmark_feature_workers.py --instruments 500 --days 750 --max-workers 8
+"""
+import os
+import argparse
+import tempfile
+import time
+from multiprocessing import freeze_support
+import numpy as np
+import pandas as pd
+
+FIELDS = ["open", "high", "low", "close", "vwap", "volume", "factor"]
+
+
+def write_synthetic_bin_store(root, n_instruments, n_days, seed=0):
+    """Write calendars, instruments and <field>.day.bin files in qlib's dump_bin layout."""
+    rng = np.random.default_rng(seed)
+    calendar = pd.bdate_range("2015-01-05", periods=n_days)
+    os.makedirs(os.path.join(root, "calendars"), exist_ok=True)
+    os.makedirs(os.path.join(root, "instruments"), exist_ok=True)
+    with open(os.path.join(root, "calendars", "day.txt"), "w") as f:
+        f.write("\n".join(d.strftime("%Y-%m-%d") for d in calendar) + "\n")
+
+    codes = [f"SH{600000 + i:06d}" for i in range(n_instruments)]
+    with open(os.path.join(root, "instruments", "all.txt"), "w") as f:
+        for code in codes:
+            f.write(f"{code}\t{calendar[0]:%Y-%m-%d}\t{calendar[-1]:%Y-%m-%d}\n")
+
+    for code in codes:
+        close = 10 * np.exp(np.cumsum(rng.normal(0, 0.02, n_days)))
+        spread = np.abs(rng.normal(0, 0.01, n_days)) * close
+        values = {
+            "open": close * (1 + rng.normal(0, 0.005, n_days)),
+            "high": close + spread,
+            "low": close - spread,
+            "close": close,
+            "vwap": close * (1 + rng.normal(0, 0.002, n_days)),
+            "volume": rng.lognormal(13, 0.5, n_days),
+            "factor": np.ones(n_days),
+        }
+        inst_dir = os.path.join(root, "features", code.lower())
+        os.makedirs(inst_dir, exist_ok=True)
+        for field in FIELDS:
+            # First element is the calendar index the series starts at
+            np.hstack([[0], values[field]]).astype("<f").tofile(os.path.join(inst_dir, f"{field}.day.bin"))
+    return codes, calendar
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--instruments", type=int, default=300)
+    p.add_argument("--days", type=int, default=500)
+    p.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+    p.add_argument("--work-dir", default=None, help="Where to write the synthetic bin store (default: a temp dir)")
+    return p.parse_args()
+
+
+def main():
+    import qlib
+    from parallel_features import compute_features
+
+    args = parse_args()
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="qlib_bench_")
+    codes, calendar = write_synthetic_bin_store(work_dir, args.instruments, args.days)
+    qlib.init(provider_uri=work_dir, kernels=1)
+    start, end = calendar[0].strftime("%Y-%m-%d"), calendar[-1].strftime("%Y-%m-%d")
+
+    counts = []
+    n = 1
+    while n < args.max_workers:
+        counts.append(n)
+        n *= 2
+    counts.append(args.max_workers)
+
+    print(f"bin store: {work_dir} ({args.instruments} instruments x {args.days} days)")
+    print(f"{'workers':>8} {'seconds':>10} {'speedup':>8}")
+    baseline = None
+    base_seconds = None
+    for workers in counts:
+        t0 = time.perf_counter()
+        features = compute_features(work_dir, codes, start, end, workers=workers)
+        seconds = time.perf_counter() - t0
+        if baseline is None:
+            baseline, base_seconds = features, seconds
+        else:
+            pd.testing.assert_frame_equal(features, baseline)
+        print(f"{workers:>8} {seconds:>10.2f} {base_seconds / seconds:>7.2f}x")
+    print(f"features: {baseline.shape[0]} rows x {baseline.shape[1]} columns, identical for every worker count")
+
+
+if __name__ == "__main__":
+    freeze_support()
+    main()
@@ -0,0 +1,152 @@
+"""Native LightGBM inference for trained qlib LGBModel artifacts.
+
+`LGBModel.predict(dataset)` re-runs `DatasetH.prepare` and goes through pandas
+on every call. This module extracts the underlying `lgb.Booster` once, keeps it
+next to the pickle in LightGBM's native text format (`<model_path>.lgb.txt`),
+and predicts straight from a contiguous float32 feature matrix, so the feature
+frame prepared for a date is built once and reused for the index and the scores.
+
+Parity check against the qlib path for one date range:
+    python booster_predict.py --model-path "E:\\qlib-optimizer\\qlib_code\\mlruns\\...\\artifacts\\trained_model" \
+        --provider-uri "E:\\qlib_data\\tushare_qlib_data\\qlib_bin" --start-date 2025-10-20 --end-date 2025-10-22
+"""
+import os
+import argparse
+import pickle
+import time
+import numpy as np
+import pandas as pd
+
+BOOSTER_SUFFIX = ".lgb.txt"
+
+
+def native_booster_path(model_path):
+    return model_path + BOOSTER_SUFFIX
+
+
+def export_booster(model_path, booster_path=None):
+    """Save the booster inside a pickled LGBModel in LightGBM's text format.
+
+    LightGBM has no binary format for models (only for datasets); the text
+    format is what `lgb.Booster(model_file=...)` loads without unpickling qlib.
+    """
+    booster_path = booster_path or native_booster_path(model_path)
+    with open(model_path, "rb") as f:
+        model = pickle.load(f)
+    booster = getattr(model, "model", model)
+    if not hasattr(booster, "save_model"):
+        raise TypeError(f"{model_path} does not contain a LightGBM booster (got {type(booster).__name__})")
+    tmp_path = booster_path + ".tmp"
+    booster.save_model(tmp_path)
+    os.replace(tmp_path, booster_path)
+    return booster_path
+
+
+def load_booster(model_path, booster_path=None):
+    """Load the native booster for model_path, exporting it first if missing or stale."""
+    import lightgbm as lgb
+
+    booster_path = booster_path or native_booster_path(model_path)
+    if not os.path.exists(booster_path) or os.path.getmtime(booster_path) < os.path.getmtime(model_path):
+        export_booster(model_path, booster_path)
+    return lgb.Booster(model_file=booster_path)
+
+
+def prepare_features(dataset, segment="test"):
+    """Feature frame for a segment, exactly as `LGBModel.predict` would prepare it."""
+    from qlib.data.dataset.handler import DataHandlerLP
+
+    return dataset.prepare(segment, col_set="feature", data_key=DataHandlerLP.DK_I)
+
+
+class BoosterPredictor:
+    """Predict with a native booster on an already prepared feature frame.
+
+    num_threads: LightGBM threads used by predict (None keeps LightGBM's default).
+    num_iteration: only use the first N trees (None uses the best/all iterations).
+    """
+
+    def __init__(self, booster, num_threads=None, num_iteration=None, dtype=np.float32):
+        self.booster = booster
+        self.num_threads = num_threads
+        self.num_iteration = num_iteration
+        self.dtype = dtype
+
+    @classmethod
+    def from_model_path(cls, model_path, booster_path=None, **kwargs):
+        return cls(load_booster(model_path, booster_path), **kwargs)
+
+    def predict_array(self, features):
+        """Scores for a feature frame or array; a C-contiguous array of self.dtype is used without copying."""
+        X = np.ascontiguousarray(features.to_numpy() if hasattr(features, "to_numpy") else features,
+                                 dtype=self.dtype)
+        params = {}
+        if self.num_threads:
+            params["num_threads"] = self.num_threads
+        return self.booster.predict(X, num_iteration=self.num_iteration, **params)
+
+    def predict(self, features):
+        """Scores for a prepared feature frame, as a Series sharing its index."""
+        return pd.Series(self.predict_array(features), index=features.index)
+
+
+def check_parity(model, predictor, dataset, segment="test", atol=1e-6):
+    """Compare BoosterPredictor against `model.predict(dataset)`; return max abs difference.
+
+    Raises AssertionError when the two paths disagree by more than atol.
+    """
+    t0 = time.perf_counter()
+    expected = model.predict(dataset, segment=segment)
+    t1 = time.perf_counter()
+    features = prepare_features(dataset, segment)
+    t2 = time.perf_counter()
+    actual = predictor.predict(features)
+    t3 = time.perf_counter()
+
+    if not expected.index.equals(actual.index):
+        raise AssertionError("booster predictions are not aligned with the qlib predictions")
+    max_diff = float(np.nanmax(np.abs(expected.to_numpy() - actual.to_numpy()))) if len(actual) else 0.0
+    print(f"rows={len(actual)} max_abs_diff={max_diff:.3g} "
+          f"qlib_predict={t1 - t0:.3f}s prepare={t2 - t1:.3f}s booster_predict={t3 - t2:.3f}s")
+    if max_diff > atol:
+        raise AssertionError(f"booster predictions differ from qlib predictions by {max_diff} (> {atol})")
+    return max_diff
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Export the native LightGBM booster and check it against LGBModel.predict")
+    p.add_argument("--model-path", required=True)
+    p.add_argument("--provider-uri", default=r"E:\\qlib_data\\tushare_qlib_data\\qlib_bin", help="Qlib provider uri")
+    p.add_argument("--start-date", required=True, help="Parity check start date YYYY-MM-DD")
+    p.add_argument("--end-date", required=True, help="Parity check end date YYYY-MM-DD")
+    p.add_argument("--instruments", default="all")
+    p.add_argument("--num-threads", type=int, default=None)
+    p.add_argument("--dtype", choices=["float32", "float64"], default="float32")
+    p.add_argument("--atol", type=float, default=1e-6)
+    return p.parse_args()
+
+
+def main():
+    from qlib.data import D
+    from qlib.utils import init_instance_by_config
+    from export_test_scores_per_day import build_dataset_config
+    from qlib_cache import init_qlib
+
+    args = parse_args()
+    init_qlib(args.provider_uri)
+    os.environ["QLIB_DISABLE_MP"] = "1"
+
+    print("Native booster:", export_booster(args.model_path))
+    with open(args.model_path, "rb") as f:
+        model = pickle.load(f)
+    predictor = BoosterPredictor.from_model_path(args.model_path, num_threads=args.num_threads,
+                                                 dtype=np.dtype(args.dtype))
+
+    instruments = D.instruments(market=args.instruments)
+    dataset = init_instance_by_config(build_dataset_config(instruments, args.start_date, args.end_date))
+    check_parity(model, predictor, dataset, atol=args.atol)
+    print("Parity check passed")
+
+
+if __name__ == "__main__":
+    main()
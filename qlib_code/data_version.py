@@ -0,0 +1,74 @@
+"""Content fingerprints shared by the caches and incremental jobs.
+
+    * file_sha256       -- sha256 of a file (models, exported scores, weight csvs),
+                           memoized per (path, size, mtime) within a process
+    * bin_data_version  -- the bin store as seen by data up to an end date:
+                           calendar entries up to that date plus the instrument list,
+                           so appending a newer trading day keeps older keys valid
+    * bin_store_version -- newest mtime under calendars/ and instruments/, which
+                           dump_bin/dump_update rewrite on every update
+    * label_data_end    -- last date whose data reaches rows up to an end date
+                           through a forward-looking label, for bin_data_version
+"""
+import hashlib
+import os
+
+# label_data_end when the calendar does not reach the label horizon yet: every appended day counts
+OPEN_END = "9999-12-31"
+
+# (path, size, mtime) -> sha256, so a long-lived process hashes each file once
+_file_hash_memo = {}
+
+
+def file_sha256(path):
+    st = os.stat(path)
+    memo_key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    if memo_key not in _file_hash_memo:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        _file_hash_memo[memo_key] = h.hexdigest()
+    return _file_hash_memo[memo_key]
+
+
+def bin_data_version(provider_uri, end_date):
+    """Fingerprint of the bin store as seen by predictions up to end_date."""
+    end = str(end_date)[:10]
+    h = hashlib.sha256()
+    with open(os.path.join(provider_uri, "calendars", "day.txt"), "rb") as f:
+        for line in f:
+            day = line.strip().decode()[:10]
+            if day and day <= end:
+                h.update(line.strip())
+    instruments_path = os.path.join(provider_uri, "instruments", "all.txt")
+    if os.path.exists(instruments_path):
+        with open(instruments_path, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def label_data_end(provider_uri, end_date, horizon):
+    """Calendar day `horizon` trading days after end_date: a label looking that far ahead makes rows up
+    to end_date depend on bins up to this day. OPEN_END while the calendar does not reach it yet."""
+    end = str(end_date)[:10]
+    if horizon <= 0:
+        return end
+    seen = 0
+    with open(os.path.join(provider_uri, "calendars", "day.txt"), "rb") as f:
+        for line in f:
+            day = line.strip().decode()[:10]
+            if day and day > end:
+                seen += 1
+                if seen == horizon:
+                    return day
+    return OPEN_END
+
+
+def bin_store_version(provider_uri):
+    stamps = []
+    for sub in ("calendars", "instruments"):
+        d = os.path.join(provider_uri, sub)
+        if os.path.isdir(d):
+            stamps.extend(os.stat(os.path.join(d, n)).st_mtime_ns for n in os.listdir(d))
+    return str(max(stamps)) if stamps else "0"
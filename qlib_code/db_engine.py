@@ -0,0 +1,216 @@
+"""Shared SQLAlchemy engines for every MySQL client in qlib_code.
+
+Engines are created once per (url, connect_args, pool settings) and shared inside the process, with:
+
+- pool sizing from db.yaml (pool_size / max_overflow / pool_timeout);
+- pool_pre_ping, so a connection the RDS proxy has silently closed is replaced
+  at checkout instead of failing the first query;
+- pool_recycle below the server's wait_timeout as a keepalive;
+- pool metrics (checkouts, waits, connects, reconnects, retries), see pool_metrics().
+
+retry() re-runs an idempotent operation (reads, upserts) on lost connections,
+deadlocks and lock wait timeouts with exponential backoff.
+
+    engine = get_engine(mysql_url(cfg, host_key='host2', database_key='database3'), cfg)
+    df = read_sql(text("SELECT ..."), engine, params={...})
+    release_engine(engine)
+"""
+import atexit
+import logging
+import os
+import threading
+import time
+from urllib.parse import quote_plus
+
+import pandas as pd
+import pymysql
+import yaml
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.pool import QueuePool
+
+logger = logging.getLogger(__name__)
+
+DB_YAML = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'config', 'db.yaml'))
+
+# 可重试的 MySQL 错误：无法连接、连接断开、死锁、锁等待超时
+RETRYABLE_ERRORS = {2003, 2006, 2013, 2055, 1205, 1213}
+DEFAULT_POOL_SIZE = 5
+DEFAULT_MAX_OVERFLOW = 10
+DEFAULT_POOL_TIMEOUT = 30
+# RDS 默认 wait_timeout 为 3600 秒，连接在此之前回收
+DEFAULT_POOL_RECYCLE = 1800
+
+
+def load_db_config(config_path=DB_YAML):
+    with open(config_path, 'r', encoding='utf-8') as f:
+        return yaml.safe_load(f) or {}
+
+
+def mysql_url(cfg, host_key='host', database_key='database'):
+    """db.yaml 中某组主机/库的连接串；密码中的特殊字符会被转义。"""
+    return (f"mysql+pymysql://{cfg['user']}:{quote_plus(str(cfg['password']))}"
+            f"@{cfg[host_key]}:{cfg.get('port', 3306)}/{cfg[database_key]}")
+
+
+class PoolMetrics:
+    """一个引擎的连接池计数。waits 为池满时需要等待空闲连接的次数。"""
+
+    FIELDS = ('checkouts', 'waits', 'wait_seconds', 'connects', 'reconnects', 'retries')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = self.waits = self.connects = self.reconnects = self.retries = 0
+        self.wait_seconds = 0.0
+
+    def add(self, name, value=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def as_dict(self):
+        with self._lock:
+            return {name: getattr(self, name) for name in self.FIELDS}
+
+
+class MeteredQueuePool(QueuePool):
+    """QueuePool that counts checkouts made while the pool was exhausted, and how long they waited."""
+
+    _metrics = None
+
+    def _do_get(self):
+        metrics = self._metrics
+        if metrics is None:
+            return super()._do_get()
+        exhausted = self._max_overflow > -1 and self.checkedout() >= self.size() + self._max_overflow
+        t0 = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            if exhausted:
+                metrics.add('waits')
+                metrics.add('wait_seconds', time.perf_counter() - t0)
+
+    def recreate(self):
+        pool = super().recreate()
+        pool._metrics = self._metrics
+        return pool
+
+
+_lock = threading.Lock()
+_engines = {}    # key -> [engine, refcount]
+_metrics = {}    # id(engine) -> PoolMetrics
+
+
+def _attach_metrics(engine):
+    metrics = PoolMetrics()
+    engine.pool._metrics = metrics
+    event.listen(engine, 'checkout', lambda *args: metrics.add('checkouts'))
+    event.listen(engine, 'connect', lambda *args: metrics.add('connects'))
+    # pre-ping 失败或执行中断线时连接被作废，下次取用时重新建立
+    event.listen(engine, 'invalidate', lambda *args: metrics.add('reconnects'))
+    _metrics[id(engine)] = metrics
+
+
+def get_engine(url, cfg=None, pool_size=None, connect_args=None):
+    """同一进程内相同 url/connect_args/连接池参数共享一个引擎；用完调用 release_engine。
+
+    cfg 为 db.yaml 内容（缺省自动读取），pool_size 缺省取 cfg['pool_size']。
+    连接池参数是键的一部分，参数不同的调用方得到各自的引擎，不会静默沿用先创建的池大小。
+    """
+    cfg = load_db_config() if cfg is None else cfg
+    pool_args = {
+        'pool_size': int(pool_size or cfg.get('pool_size') or DEFAULT_POOL_SIZE),
+        'max_overflow': int(cfg.get('max_overflow', DEFAULT_MAX_OVERFLOW)),
+        'pool_timeout': int(cfg.get('pool_timeout') or DEFAULT_POOL_TIMEOUT),
+        'pool_recycle': int(cfg.get('pool_recycle') or DEFAULT_POOL_RECYCLE),
+    }
+    key = (url, tuple(sorted((connect_args or {}).items())), tuple(sorted(pool_args.items())))
+    with _lock:
+        entry = _engines.get(key)
+        if entry is None:
+            engine = create_engine(
+                url,
+                poolclass=MeteredQueuePool,
+                pool_pre_ping=True,
+                connect_args=connect_args or {},
+                **pool_args,
+            )
+            _attach_metrics(engine)
+            entry = _engines[key] = [engine, 0]
+        entry[1] += 1
+        return entry[0]
+
+
+def release_engine(engine):
+    """引用计数减一，最后一个使用者释放时关闭连接池并记录池统计。"""
+    with _lock:
+        for key, entry in list(_engines.items()):
+            if entry[0] is engine:
+                entry[1] -= 1
+                if entry[1] > 0:
+                    return
+                del _engines[key]
+                break
+        else:
+            return
+    logger.info("连接池统计 %s: %s", engine.url.host, pool_metrics(engine))
+    _metrics.pop(id(engine), None)
+    engine.dispose()
+
+
+@atexit.register
+def _dispose_all():
+    with _lock:
+        engines = [entry[0] for entry in _engines.values()]
+        _engines.clear()
+    for engine in engines:
+        engine.dispose()
+
+
+def pool_metrics(engine):
+    """引擎的池统计：checkouts/waits/wait_seconds/connects/reconnects/retries，以及当前 checked_out。"""
+    metrics = _metrics.get(id(engine))
+    stats = metrics.as_dict() if metrics is not None else {}
+    try:
+        stats['checked_out'] = engine.pool.checkedout()
+    except AttributeError:
+        pass
+    return stats
+
+
+def is_retryable(exc):
+    """断线、死锁、锁等待超时；SQLAlchemy 包装的异常取其原始驱动错误码，并沿 raise ... from 链查找。"""
+    seen = set()
+    while exc is not None and id(exc) not in seen:
+        seen.add(id(exc))
+        if isinstance(exc, DBAPIError):
+            if exc.connection_invalidated:
+                return True
+            if is_retryable(exc.orig):
+                return True
+        elif isinstance(exc, pymysql.err.MySQLError):
+            if exc.args and exc.args[0] in RETRYABLE_ERRORS:
+                return True
+        exc = exc.__cause__
+    return False
+
+
+def retry(fn, *args, retries=3, backoff=1.0, engine=None, **kwargs):
+    """执行幂等操作 fn(*args, **kwargs)，可重试错误按 backoff * 2**attempt 秒退避，最多重试 retries 次。"""
+    metrics = _metrics.get(id(engine)) if engine is not None else None
+    for attempt in range(retries + 1):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if not is_retryable(e) or attempt == retries:
+                raise
+            delay = backoff * 2 ** attempt
+            if metrics is not None:
+                metrics.add('retries')
+            logger.warning("数据库操作失败 (%s)，%.0f 秒后重试 (%d/%d)", e, delay, attempt + 1, retries)
+            time.sleep(delay)
+
+
+def read_sql(sql, engine, retries=3, backoff=1.0, **kwargs):
+    """pd.read_sql，断线或死锁时重试（查询是幂等的）。"""
+    return retry(pd.read_sql, sql, engine, retries=retries, backoff=backoff, engine=engine, **kwargs)
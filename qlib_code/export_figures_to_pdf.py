@@ -5,9 +5,9 @@ from datetime import datetime
 import numpy as np
 import pandas as pd
 
-import qlib
 from qlib.workflow import R
 from qlib.config import REG_CN
+from qlib_cache import init_qlib
 
 import logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
@@ -20,7 +20,7 @@ recorder = None
 def global_init(experiment_id, experiment_name, provider_uri):
     global qlib_initialized, recorder
     if not qlib_initialized:
-        qlib.init(provider_uri=provider_uri, region=REG_CN)
+        init_qlib(provider_uri, region=REG_CN)
         qlib_initialized = True
     recorder = R.get_recorder(experiment_id=experiment_id, experiment_name=experiment_name)
 
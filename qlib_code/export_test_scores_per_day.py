@@ -5,17 +5,64 @@ Usage examples:
     python export_test_scores_per_day.py --model-path "E:\\qlib_code\\mlruns\\505608931795866282\\7d35e7a5b04149f690fd8e0cf031f84d\\artifacts\\trained_model" \
         --start-date 2020-09-01 --end-date 2025-10-22 --output-dir "E:\\qlib_output"
 
+    # chunked: score the range month by month in parallel worker processes,
+    # writing each month's daily files as soon as it is done
+    python export_test_scores_per_day.py --chunk-freq MS --workers 8 --memory-budget-gb 24
+
+    # sharded: run shard i of N anywhere that sees the same bins and model
+    # (can be combined with --chunk-freq), then verify and merge on one machine
+    python export_test_scores_per_day.py --num-shards 4 --shard-index 0 --shard-dir "E:\\qlib_shards"
+    python export_test_scores_per_day.py --num-shards 4 --merge --shard-dir "E:\\qlib_shards" --output-dir "E:\\qlib_output"
+
+    # columnar: write one Parquet dataset partitioned by date (scores.parquet/valuation_date=YYYY-MM-DD/)
+    # instead of, or next to, the per-day CSVs; read it back with read_scores()
+    python export_test_scores_per_day.py --output-format both
+
+    # fast path: predict with the native LightGBM booster (see booster_predict.py)
+    python export_test_scores_per_day.py --fast-predict --num-threads 8
+
+    # parallel features: compute Alpha158 in 8 processes over sorted instrument slices
+    # (see parallel_features.py; output is identical to the single-process build)
+    python export_test_scores_per_day.py --feature-workers 8
+
+    # compact: float32 features/scores, categorical codes, and peak memory per stage
+    python export_test_scores_per_day.py --chunk-freq MS --compact --memory-report
+
 This will write files like `prediction_20200901.csv`, `prediction_20200902.csv`, ...
 Each CSV contains columns: code, score
 """
 import os
 import argparse
+import json
 import pickle
+import shutil
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import datetime
+from multiprocessing import freeze_support
+import numpy as np
 import pandas as pd
-import qlib
 from qlib.utils import init_instance_by_config
 from qlib.data import D
+from booster_predict import BoosterPredictor, prepare_features
+from parallel_features import build_dataset
+from qlib_cache import init_qlib
+from memory_utils import MemoryTracker, compact_features, compact_scores
+from pruned_handler import pruned_handler
+from panel_features import build_panel_dataset
+from scoring_universe import DEFAULT_MARGIN_DAYS, universe_instruments
+from data_version import file_sha256
+
+# Rough in-memory size of one (datetime, instrument) row while a window is being
+# scored: 158 Alpha158 features + label as float64, times the copies pandas makes
+# between DataHandler.fetch, DatasetH.prepare and model.predict.
+ROW_BYTES_ESTIMATE = 159 * 8 * 4
+TRADING_DAYS_PER_CALENDAR_DAY = 245 / 365
+
+MANIFEST_NAME = "manifest.json"
+SCORES_DATASET = "scores.parquet"
+
+# Per-process state for chunked mode workers, filled by _init_worker
+_worker_model = None
 
 
 def parse_args():
@@ -26,67 +73,145 @@ def parse_args():
     p.add_argument("--end-date", default="2025-10-22", help="Test end date YYYY-MM-DD")
     p.add_argument("--output-dir", default=r"E:\\qlib_output", help="Directory to save daily CSVs")
     p.add_argument("--instruments", default="all", help="Market instruments argument passed to D.instruments (default 'all')")
+    p.add_argument("--universe", default=None,
+                   help="Only score these pools / instruments files, e.g. 'zz3800' or 'csi300,csi500' "
+                        "(see scoring_universe.py). Overrides --instruments")
+    p.add_argument("--universe-margin-days", type=int, default=DEFAULT_MARGIN_DAYS,
+                   help="Keep constituents that joined or left within this many calendar days of the range")
+    p.add_argument("--chunk-freq", default=None,
+                   help="Split the range into windows of this pandas frequency (e.g. 'MS' for months, '90D') "
+                        "and score them independently. Default: score the whole range at once")
+    p.add_argument("--lookback-days", type=int, default=0,
+                   help="Extra calendar days loaded before each window start. Expression windows are already "
+                        "extended by qlib; raise this only for handlers whose processors need history")
+    p.add_argument("--workers", type=int, default=None, help="Chunked mode: max worker processes (default: cpu count)")
+    p.add_argument("--memory-budget-gb", type=float, default=None,
+                   help="Chunked mode: total memory the workers may use (default: 80%% of available memory)")
+    p.add_argument("--num-shards", type=int, default=None,
+                   help="Shard mode: split the trading days of the range into this many contiguous slices")
+    p.add_argument("--shard-index", type=int, default=None, help="Shard mode: which slice (0-based) this run scores")
+    p.add_argument("--shard-dir", default=None,
+                   help="Shard mode: directory holding one shard_NNN sub-directory and manifest per shard")
+    p.add_argument("--merge", action="store_true",
+                   help="Shard mode: verify all shard manifests under --shard-dir and copy their files into --output-dir")
+    p.add_argument("--output-format", choices=["csv", "parquet", "both"], default="csv",
+                   help=f"csv: per-day prediction_YYYYMMDD.csv files; parquet: one {SCORES_DATASET} dataset "
+                        "partitioned by valuation_date; both: write both")
+    p.add_argument("--csv-writers", type=int, default=8, help="Threads used to write the per-day CSVs")
+    p.add_argument("--fast-predict", action="store_true",
+                   help="Predict with the native LightGBM booster on a float32 matrix instead of LGBModel.predict")
+    p.add_argument("--num-threads", type=int, default=None,
+                   help="Fast path: LightGBM predict threads (chunked mode default: cpu count / workers)")
+    p.add_argument("--num-iteration", type=int, default=None, help="Fast path: only use the first N trees")
+    p.add_argument("--feature-workers", type=int, default=1,
+                   help="Processes computing Alpha158 features over instrument slices "
+                        "(1: single-process qlib handler as before; per window in chunked mode)")
+    p.add_argument("--feature-engine", choices=["qlib", "panel"], default="qlib",
+                   help="qlib: Alpha158 handler; panel: vectorized NumPy engine over the bins "
+                        "(see panel_features.py for its parity check)")
+    p.add_argument("--compact", action="store_true",
+                   help="Hold features and scores as float32 with categorical codes (about half the memory)")
+    p.add_argument("--memory-report", action="store_true", help="Print peak RSS per stage (needs psutil)")
+    p.add_argument("--prune-features", choices=["split", "topk"], default=None,
+                   help="Only compute the Alpha158 features the model uses (split: every feature with a split, "
+                        "same scores; topk: the --prune-top-k features by gain, approximate)")
+    p.add_argument("--prune-top-k", type=int, default=None, help="Number of features kept with --prune-features topk")
     return p.parse_args()
 
 
-def main():
-    args = parse_args()
-
-    os.makedirs(args.output_dir, exist_ok=True)
-
-    # initialize qlib provider first so D.instruments works
-    qlib.init(provider_uri=args.provider_uri)
-
-    print("Loading model:", args.model_path)
-    with open(args.model_path, "rb") as f:
-        model = pickle.load(f)
-
-    instruments = D.instruments(market=args.instruments)
+def build_dataset_config(instruments, start_date, end_date, lookback_days=0, handler=None):
+    """Alpha158 DatasetH config whose test segment is [start_date, end_date].
 
+    The handler itself starts ``lookback_days`` calendar days earlier so that
+    history-dependent processing sees the same data as a full-range run.
+    handler: optional {"class", "module_path", "kwargs"} replacing Alpha158
+    (e.g. pruned_handler.pruned_handler(model_path)).
+    """
+    handler = handler or {"class": "Alpha158", "module_path": "qlib.contrib.data.handler"}
+    handler_start = (pd.Timestamp(start_date) - pd.Timedelta(days=lookback_days)).strftime("%Y-%m-%d")
     handler_config = {
-        "start_time": args.start_date,
-        "end_time": args.end_date,
+        **handler.get("kwargs", {}),
+        "start_time": handler_start,
+        "end_time": end_date,
         "instruments": instruments,
     }
 
-    dataset_config = {
+    return {
         "class": "DatasetH",
         "module_path": "qlib.data.dataset",
         "kwargs": {
             "handler": {
-                "class": "Alpha158",
-                "module_path": "qlib.contrib.data.handler",
+                "class": handler["class"],
+                "module_path": handler["module_path"],
                 "kwargs": handler_config,
             },
             "segments": {
-                "test": [args.start_date, args.end_date],
+                "test": [start_date, end_date],
             },
         },
     }
 
-    # Disable qlib multiprocessing for predict stability
+
+def scoring_instruments(args):
+    """The --universe codes resolved in main(), or the D.instruments config for --instruments."""
+    if args.universe_codes is not None:
+        return args.universe_codes
+    return D.instruments(market=args.instruments)
+
+
+def make_dataset(args, instruments, start_date, end_date):
+    """Test dataset for [start_date, end_date], computed by --feature-workers processes or the panel engine."""
+    if args.feature_engine == "panel":
+        return build_panel_dataset(args.provider_uri, instruments, start_date, end_date, handler=args.handler)
+    if args.feature_workers > 1:
+        return build_dataset(args.provider_uri, instruments, start_date, end_date,
+                             args.feature_workers, args.lookback_days, compact=args.compact,
+                             handler=args.handler)
+    # Single-process build: keep qlib multiprocessing disabled for predict stability
     os.environ["QLIB_DISABLE_MP"] = "1"
+    return init_instance_by_config(build_dataset_config(instruments, start_date, end_date, args.lookback_days,
+                                                        handler=args.handler))
 
-    dataset = init_instance_by_config(dataset_config)
-    test_df = dataset.prepare("test")
 
-    # Run prediction across the full test dataset
-    print("Generating predictions for test set...")
-    pred = model.predict(dataset)
-    pred_values = pred.values if isinstance(pred, pd.Series) else pred.ravel()
+def load_model(args):
+    """The pickled qlib model, or a BoosterPredictor when --fast-predict is set."""
+    if args.fast_predict:
+        return BoosterPredictor.from_model_path(args.model_path, num_threads=args.num_threads,
+                                                num_iteration=args.num_iteration)
+    with open(args.model_path, "rb") as f:
+        return pickle.load(f)
+
+
+def predict_scores(model, dataset, compact=False):
+    """Run the model on the dataset's test segment and return a long frame
+    with datetime, code, final_score and score_name columns."""
+    if isinstance(model, BoosterPredictor):
+        # Prepare once and use the same frame for both the index and the scores
+        test_df = prepare_features(dataset)
+        if compact:
+            test_df = compact_features(test_df)
+        index = test_df.index
+        pred_values = model.predict_array(test_df)
+        del test_df
+    else:
+        pred = model.predict(dataset)
+        if isinstance(pred, pd.Series):
+            # LGBModel.predict returns the prepared index already; no need to prepare again
+            index, pred_values = pred.index, pred.values
+        else:
+            index, pred_values = dataset.prepare("test").index, pred.ravel()
 
     # Recover index levels for datetime and instrument
-    idx_names = test_df.index.names
     try:
-        datetimes = test_df.index.get_level_values("datetime")
+        datetimes = index.get_level_values("datetime")
     except Exception:
-        datetimes = test_df.index.get_level_values(0)
+        datetimes = index.get_level_values(0)
 
     try:
-        instruments_idx = test_df.index.get_level_values("instrument")
+        instruments_idx = index.get_level_values("instrument")
     except Exception:
         # assume instrument is second level
-        instruments_idx = test_df.index.get_level_values(1)
+        instruments_idx = index.get_level_values(1)
 
     df = pd.DataFrame({
         "datetime": pd.to_datetime(datetimes),
@@ -94,21 +219,400 @@ def main():
         "final_score": pred_values,
         "score_name": "vp08"
     })
+    return compact_scores(df) if compact else df
+
+
+def write_daily_csvs(df, output_dir, writers=1):
+    """Write one prediction_YYYYMMDD.csv per date in df; return the number of files."""
+    if df.empty:
+        return 0
+    df = df.assign(date_str=df["datetime"].dt.strftime("%Y%m%d"))
+    # One sort for the whole frame instead of one per day; each date is then a contiguous slice
+    df = df.sort_values(["date_str", "final_score"], ascending=[True, False], kind="mergesort")
+    dates = df["date_str"].to_numpy()
+    bounds = np.flatnonzero(dates[1:] != dates[:-1]) + 1
+    starts = np.r_[0, bounds]
+    ends = np.r_[bounds, len(df)]
+    # Only keep code and score columns
+    out = df[["code", "final_score", "score_name"]]
+
+    def _write(i):
+        out_path = os.path.join(output_dir, f"prediction_{dates[starts[i]]}.csv")
+        out.iloc[starts[i]:ends[i]].to_csv(out_path, index=False)
+
+    with ThreadPoolExecutor(max_workers=max(1, writers)) as pool:
+        list(pool.map(_write, range(len(starts))))
+    return len(starts)
+
+
+def write_scores_parquet(df, output_dir):
+    """Write df into the date-partitioned Parquet dataset under output_dir.
+
+    Scores are stored as float32 and code/score_name dictionary-encoded. Partitions
+    for the dates in df are replaced, all other dates are left untouched, so windows
+    and reruns can write into the same dataset independently.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if df.empty:
+        return 0
+    table = pa.table({
+        "valuation_date": pa.array(df["datetime"].dt.strftime("%Y-%m-%d").to_numpy()),
+        "code": pa.array(df["code"].astype(str).to_numpy()).dictionary_encode(),
+        "final_score": pa.array(df["final_score"].to_numpy(dtype=np.float32)),
+        "score_name": pa.array(df["score_name"].astype(str).to_numpy()).dictionary_encode(),
+    })
+    n_dates = df["datetime"].nunique()
+    pq.write_to_dataset(
+        table,
+        root_path=os.path.join(output_dir, SCORES_DATASET),
+        partition_cols=["valuation_date"],
+        basename_template="part-{i}.parquet",
+        existing_data_behavior="delete_matching",
+        max_partitions=max(1024, n_dates),
+    )
+    return n_dates
+
+
+def read_scores(output_dir, start_date=None, end_date=None, columns=None):
+    """Load scores written by --output-format parquet/both as one DataFrame.
+
+    Only the partitions inside [start_date, end_date] are read.
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset(
+        os.path.join(output_dir, SCORES_DATASET),
+        format="parquet",
+        partitioning=ds.partitioning(pa.schema([("valuation_date", pa.string())]), flavor="hive"),
+    )
+    flt = None
+    if start_date is not None:
+        flt = ds.field("valuation_date") >= pd.Timestamp(start_date).strftime("%Y-%m-%d")
+    if end_date is not None:
+        upper = ds.field("valuation_date") <= pd.Timestamp(end_date).strftime("%Y-%m-%d")
+        flt = upper if flt is None else flt & upper
+    df = dataset.to_table(columns=columns, filter=flt).to_pandas()
+    if "valuation_date" in df.columns:
+        df["valuation_date"] = pd.to_datetime(df["valuation_date"])
+    return df
+
+
+def write_outputs(df, args):
+    """Write df in the formats selected by --output-format; return the number of dates written."""
+    count = 0
+    if args.output_format in ("csv", "both"):
+        count = write_daily_csvs(df, args.output_dir, args.csv_writers)
+    if args.output_format in ("parquet", "both"):
+        count = write_scores_parquet(df, args.output_dir)
+    return count
+
+
+def count_output_rows(path):
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+        return pq.ParquetFile(path).metadata.num_rows
+    with open(path, "rb") as f:
+        return max(0, sum(1 for _ in f) - 1)
+
+
+def list_output_files(output_dir):
+    """Relative (posix) paths of the per-day CSVs and Parquet parts under output_dir."""
+    names = [n for n in os.listdir(output_dir) if n.startswith("prediction_") and n.endswith(".csv")]
+    dataset_dir = os.path.join(output_dir, SCORES_DATASET)
+    for root, _, files in os.walk(dataset_dir):
+        for n in files:
+            if n.endswith(".parquet"):
+                names.append(os.path.relpath(os.path.join(root, n), output_dir).replace(os.sep, "/"))
+    return sorted(names)
+
+
+def split_windows(start_date, end_date, freq):
+    """Split [start_date, end_date] into consecutive inclusive (start, end) date
+    string pairs whose boundaries fall on ``freq`` (a pandas offset alias)."""
+    start, end = pd.Timestamp(start_date), pd.Timestamp(end_date)
+    edges = [start] + [t for t in pd.date_range(start, end, freq=freq) if t > start]
+    edges.append(end + pd.Timedelta(days=1))
+
+    windows = []
+    for lo, hi in zip(edges[:-1], edges[1:]):
+        windows.append((lo.strftime("%Y-%m-%d"), (hi - pd.Timedelta(days=1)).strftime("%Y-%m-%d")))
+    return windows
+
+
+def estimate_window_bytes(n_instruments, start_date, end_date, lookback_days, compact=False):
+    calendar_days = (pd.Timestamp(end_date) - pd.Timestamp(start_date)).days + 1 + lookback_days
+    rows = n_instruments * max(1, int(calendar_days * TRADING_DAYS_PER_CALENDAR_DAY))
+    return rows * (ROW_BYTES_ESTIMATE // 2 if compact else ROW_BYTES_ESTIMATE)
+
+
+def _available_memory_bytes():
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return int(psutil.virtual_memory().available * 0.8)
+
+
+def resolve_workers(requested, n_windows, window_bytes, budget_bytes):
+    """Number of windows that can be scored at once without exceeding the memory budget."""
+    workers = min(requested or os.cpu_count() or 1, n_windows)
+    if budget_bytes:
+        workers = min(workers, max(1, budget_bytes // max(window_bytes, 1)))
+    return max(1, int(workers))
+
+
+def _init_worker(args):
+    global _worker_model
+    # Disable qlib multiprocessing inside workers; parallelism comes from the pool
+    os.environ["QLIB_DISABLE_MP"] = "1"
+    init_qlib(args.provider_uri, maintain=False)
+    _worker_model = load_model(args)
 
-    df["date_str"] = df["datetime"].dt.strftime("%Y%m%d")
 
-    print("Exporting daily CSVs to:", args.output_dir)
-    grouped = df.groupby("date_str")
+def score_window(window, args):
+    """Score one window inside a worker process and write its daily files."""
+    start_date, end_date = window
+    tracker = MemoryTracker(enabled=args.memory_report)
+    instruments = scoring_instruments(args)
+    with tracker.stage("features"):
+        dataset = make_dataset(args, instruments, start_date, end_date)
+    with tracker.stage("predict"):
+        df = predict_scores(_worker_model, dataset, args.compact)
+        del dataset
+    with tracker.stage("write"):
+        count = write_outputs(df, args)
+    tracker.report(title=f"Memory by stage, window {start_date} ~ {end_date}")
+    return window, count, len(df)
+
+
+def run_chunked(args):
+    windows = split_windows(args.start_date, args.end_date, args.chunk_freq)
+
+    if args.universe_codes is not None:
+        n_instruments = len(args.universe_codes)
+    else:
+        n_instruments = len(D.list_instruments(D.instruments(market=args.instruments), start_time=args.start_date,
+                                               end_time=args.end_date, as_list=True))
+    window_bytes = max(estimate_window_bytes(n_instruments, lo, hi, args.lookback_days, args.compact)
+                       for lo, hi in windows)
+    if args.memory_budget_gb is not None:
+        budget_bytes = int(args.memory_budget_gb * 1024 ** 3)
+    else:
+        budget_bytes = _available_memory_bytes()
+    workers = resolve_workers(args.workers, len(windows), window_bytes, budget_bytes)
+
+    if args.fast_predict:
+        # Export the native booster once here rather than racing to do it in every worker
+        BoosterPredictor.from_model_path(args.model_path)
+        if not args.num_threads:
+            args.num_threads = max(1, (os.cpu_count() or 1) // workers)
+
+    print(f"Scoring {len(windows)} windows ({args.chunk_freq}) with {workers} workers, "
+          f"~{window_bytes / 1024 ** 3:.1f} GB per window")
+
     count = 0
-    for date_str, g in grouped:
-        out_path = os.path.join(args.output_dir, f"prediction_{date_str}.csv")
-        # Only keep code and score columns
-        g_out = g[["code", "final_score", "score_name"]].sort_values("final_score", ascending=False)
-        g_out.to_csv(out_path, index=False)
-        count += 1
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(args,)) as pool:
+        futures = {
+            pool.submit(score_window, w, args): w
+            for w in windows
+        }
+        for fut in as_completed(futures):
+            window = futures[fut]
+            try:
+                _, n_files, n_rows = fut.result()
+            except Exception as e:
+                print(f"Window {window[0]} ~ {window[1]} failed: {e}")
+                failed.append(window)
+                continue
+            count += n_files
+            print(f"Window {window[0]} ~ {window[1]}: {n_rows} rows, {n_files} files")
+
+    print(f"Exported {count} days to {args.output_dir}")
+    if failed:
+        raise SystemExit(f"{len(failed)} window(s) failed: " + ", ".join(f"{lo}~{hi}" for lo, hi in failed))
+
+
+def shard_slice(start_date, end_date, num_shards, shard_index):
+    """Contiguous (start, end) slice of the trading calendar assigned to one shard,
+    or None when there are more shards than trading days."""
+    calendar = D.calendar(start_time=start_date, end_time=end_date)
+    parts = np.array_split(np.asarray(calendar), num_shards)
+    part = parts[shard_index]
+    if len(part) == 0:
+        return None
+    return pd.Timestamp(part[0]).strftime("%Y-%m-%d"), pd.Timestamp(part[-1]).strftime("%Y-%m-%d")
+
+
+def shard_path(shard_dir, shard_index):
+    return os.path.join(shard_dir, f"shard_{shard_index:03d}")
+
+
+def write_shard_manifest(args, shard_out, window):
+    """Record every output file of a finished shard with its row count and checksum.
+
+    The manifest is written last and atomically, so its presence marks the shard as complete.
+    """
+    files = {}
+    for name in list_output_files(shard_out):
+        path = os.path.join(shard_out, name)
+        files[name] = {"rows": count_output_rows(path), "sha256": file_sha256(path)}
+
+    manifest = {
+        "shard_index": args.shard_index,
+        "num_shards": args.num_shards,
+        "start_date": window[0] if window else None,
+        "end_date": window[1] if window else None,
+        "model_path": args.model_path,
+        "model_sha256": file_sha256(args.model_path),
+        "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "files": files,
+    }
+    tmp_path = os.path.join(shard_out, MANIFEST_NAME + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, os.path.join(shard_out, MANIFEST_NAME))
+    return manifest
+
+
+def run_shard(args):
+    window = shard_slice(args.start_date, args.end_date, args.num_shards, args.shard_index)
+    shard_out = shard_path(args.shard_dir, args.shard_index)
+    os.makedirs(shard_out, exist_ok=True)
+    # A stale manifest from an earlier attempt must not mark a partial rerun as complete
+    if os.path.exists(os.path.join(shard_out, MANIFEST_NAME)):
+        os.remove(os.path.join(shard_out, MANIFEST_NAME))
+
+    if window is None:
+        print(f"Shard {args.shard_index}/{args.num_shards}: no trading days assigned")
+    else:
+        print(f"Shard {args.shard_index}/{args.num_shards}: {window[0]} ~ {window[1]}")
+        args.start_date, args.end_date = window
+        args.output_dir = shard_out
+        if args.chunk_freq:
+            run_chunked(args)
+        else:
+            run_full_range(args)
+
+    manifest = write_shard_manifest(args, shard_out, window)
+    print(f"Shard {args.shard_index} manifest: {len(manifest['files'])} files, "
+          f"{sum(f['rows'] for f in manifest['files'].values())} rows")
+
+
+def merge_shards(shard_dir, num_shards, output_dir):
+    """Verify every shard manifest against the files on disk and copy them into output_dir.
+
+    Nothing is copied unless all shards are present, come from the same model,
+    cover disjoint dates and match their recorded row counts and checksums.
+    """
+    manifests = []
+    errors = []
+    for i in range(num_shards):
+        manifest_path = os.path.join(shard_path(shard_dir, i), MANIFEST_NAME)
+        if not os.path.exists(manifest_path):
+            errors.append(f"shard {i}: missing {manifest_path}")
+            continue
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("num_shards") != num_shards or manifest.get("shard_index") != i:
+            errors.append(f"shard {i}: manifest belongs to shard {manifest.get('shard_index')}/{manifest.get('num_shards')}")
+        manifests.append(manifest)
+
+    if len({m["model_sha256"] for m in manifests}) > 1:
+        errors.append("shards were scored with different models")
+
+    seen = {}
+    for m in manifests:
+        src_dir = shard_path(shard_dir, m["shard_index"])
+        for name, meta in m["files"].items():
+            if name in seen:
+                errors.append(f"{name} produced by shards {seen[name]} and {m['shard_index']}")
+                continue
+            seen[name] = m["shard_index"]
+            path = os.path.join(src_dir, name)
+            if not os.path.exists(path):
+                errors.append(f"shard {m['shard_index']}: {name} listed but missing")
+            elif count_output_rows(path) != meta["rows"] or file_sha256(path) != meta["sha256"]:
+                errors.append(f"shard {m['shard_index']}: {name} does not match its manifest")
+
+    if errors:
+        for e in errors:
+            print("Merge check failed:", e)
+        raise SystemExit(f"Refusing to merge {shard_dir}: {len(errors)} problem(s)")
+
+    os.makedirs(output_dir, exist_ok=True)
+    for name, shard_index in sorted(seen.items()):
+        dest = os.path.join(output_dir, name)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        shutil.copy2(os.path.join(shard_path(shard_dir, shard_index), name), dest)
+
+    total_rows = sum(meta["rows"] for m in manifests for meta in m["files"].values())
+    print(f"Merged {len(seen)} files ({total_rows} rows) from {num_shards} shards into {output_dir}")
+
+
+def run_full_range(args):
+    tracker = MemoryTracker(enabled=args.memory_report)
+    print("Loading model:", args.model_path)
+    with tracker.stage("load model"):
+        model = load_model(args)
+
+    instruments = scoring_instruments(args)
+    with tracker.stage("features"):
+        dataset = make_dataset(args, instruments, args.start_date, args.end_date)
+
+    # Run prediction across the full test dataset
+    print("Generating predictions for test set...")
+    with tracker.stage("predict"):
+        df = predict_scores(model, dataset, args.compact)
+        del dataset
+
+    print("Exporting daily scores to:", args.output_dir)
+    with tracker.stage("write"):
+        count = write_outputs(df, args)
+
+    print(f"Exported {count} days to {args.output_dir}")
+    tracker.report()
+
+
+def main():
+    args = parse_args()
+
+    if args.num_shards is not None:
+        if not args.shard_dir:
+            raise SystemExit("--shard-dir is required with --num-shards")
+        if args.merge:
+            merge_shards(args.shard_dir, args.num_shards, args.output_dir)
+            return
+        if args.shard_index is None or not 0 <= args.shard_index < args.num_shards:
+            raise SystemExit("--shard-index must be in [0, --num-shards)")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    args.handler = (pruned_handler(args.model_path, args.prune_features, args.prune_top_k)
+                    if args.prune_features else None)
+    if args.handler:
+        print(f"Pruned handler: computing {len(args.handler['kwargs']['keep_features'])} features")
+
+    # initialize qlib provider first so D.instruments works
+    init_qlib(args.provider_uri)
+    # Resolved once for the whole range so every window and worker scores the same names
+    args.universe_codes = None
+    if args.universe:
+        args.universe_codes = universe_instruments(args.universe, args.start_date, args.end_date,
+                                                   args.universe_margin_days)
+        print(f"Scoring universe {args.universe}: {len(args.universe_codes)} instruments")
 
-    print(f"Exported {count} daily files to {args.output_dir}")
+    if args.num_shards is not None:
+        run_shard(args)
+    elif args.chunk_freq:
+        run_chunked(args)
+    else:
+        run_full_range(args)
 
 
 if __name__ == "__main__":
+    freeze_support()
     main()
@@ -1,8 +1,8 @@
 import os
 import argparse
-import qlib
 from qlib.workflow import R
 from qlib.config import REG_CN
+from qlib_cache import init_qlib
 import pandas as pd
 import logging
 
@@ -13,7 +13,7 @@ def export_positions_and_bench(experiment_id, experiment_name, provider_uri=r"E:
    
 
     os.makedirs(output_dir, exist_ok=True)
-    qlib.init(provider_uri=provider_uri, region=REG_CN)
+    init_qlib(provider_uri, region=REG_CN)
     R.set_uri(mlruns_uri)
     recorder = R.get_recorder(experiment_id=experiment_id, experiment_name=experiment_name)
 
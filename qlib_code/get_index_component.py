@@ -1,9 +1,21 @@
+import atexit
 import pymysql
 import pandas as pd
-from sqlalchemy import create_engine
+from db_engine import get_engine, read_sql, release_engine
 from urllib.parse import quote_plus
 import os
 
+# 进程内按连接串保存的引擎，多次调用复用同一连接池，进程退出时释放
+_engines = {}
+
+
+def _engine(engine_url):
+    engine = _engines.get(engine_url)
+    if engine is None:
+        engine = _engines[engine_url] = get_engine(engine_url)
+        atexit.register(release_engine, engine)
+    return engine
+
 
 def process_index_data(host, username, password, dbname, port=3306, organization='zz500', start_date='2020-01-01'):
    
@@ -17,7 +29,8 @@ def process_index_data(host, username, password, dbname, port=3306, organization
 
     password_quoted = quote_plus(password)
     engine_url = f"mysql+pymysql://{username}:{password_quoted}@{host}:{port}/{dbname}"
-    engine = create_engine(engine_url)
+    # 共享连接池，同一进程内多次调用复用连接；查询断线时重试
+    engine = _engine(engine_url)
 
     query = """
     SELECT valuation_date, code 
@@ -25,9 +38,7 @@ def process_index_data(host, username, password, dbname, port=3306, organization
     WHERE organization = %s 
     AND valuation_date >= %s
     """
-    db = pd.read_sql(query, engine, params=(organization, start_date))
-
-    engine.dispose()
+    db = read_sql(query, engine, params=(organization, start_date))
   
     db['valuation_date'] = pd.to_datetime(db['valuation_date'])
     
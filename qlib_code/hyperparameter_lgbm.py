@@ -1,84 +1,296 @@
-import qlib
+"""Optuna search over LightGBM parameters on Alpha158.
+
+The dataset is prepared once, in the parent process, exactly as LGBModel prepares it
+(DK_L train/valid feature and label). It is constructed into LightGBM train/valid
+Datasets and saved in LightGBM's binary format through lgb_dataset_cache. Each worker
+process loads the binary files once and reuses the constructed Datasets for all of
+its trials, so a trial starts boosting right away. When the handler config,
+segments and bin data are unchanged, later searches skip the handler entirely.
+
+Validation l2 is reported to Optuna every REPORT_EVERY boosting rounds, and the
+pruner chosen with --pruner (median, sha = successive halving, hyperband, none)
+stops unpromising trials as soon as it decides to prune them. Pruning is off by
+default (--pruner none), so a plain run searches exactly as before; --pruner-warmup
+is rounded up to a multiple of REPORT_EVERY, since that is the step granularity
+the pruner sees.
+
+With --workers N the trials run in N processes, and every process gets
+cpu_count // N LightGBM threads. All of them write to one study.
+
+Workers do not share one memmapped feature matrix; each holds its own copy of the
+constructed Datasets, so RSS grows by N x the size of train.bin + valid.bin (logged
+at startup). A shared float32 memmap would not save memory here: lgb.Dataset copies
+its input into its own binned storage on construct, which is the same private
+memory a worker gets from the binary files, and with max_bin <= 255 that is about a
+quarter of the float32 matrix. Sharing the memmap would only make every worker
+re-bin the features. Lower --workers when the Datasets do not fit N times. SQLite storage is
+switched to WAL mode with a busy timeout; --journal uses Optuna's journal file
+storage instead.
+
+    python hyperparameter_lgbm.py                          # all cores, 200 trials
+    python hyperparameter_lgbm.py --workers 8 --n-trials 400
+    python hyperparameter_lgbm.py --journal optuna_journal.log
+    python hyperparameter_lgbm.py --pruner median --pruner-warmup 50
+    python hyperparameter_lgbm.py --dataset-cache-dir E:\\qlib_cache\\lgb_datasets
+"""
 import optuna
 from qlib.constant import REG_CN
 from qlib.utils import init_instance_by_config
-from qlib.workflow.exp import Experiment
 from qlib.tests.data import GetData
-from qlib.workflow import R
+from qlib_cache import init_qlib
+from lgb_dataset_cache import LGBDatasetCache, cache_key, data_end, prepare_arrays
+from data_version import bin_data_version
+import argparse
+import lightgbm as lgb
+import multiprocessing as mp
+import os
+import shutil
+import sqlite3
+import tempfile
+import yaml
 import warnings
 warnings.simplefilter("ignore", category=FutureWarning)
 warnings.filterwarnings("ignore")
 import logging
 log = logging.getLogger(__name__)
 
-def objective(trial, dataset):
-    task = {
-        "model": {
-            "class": "LGBModel",
-            "module_path": "qlib.contrib.model.gbdt",
+PROVIDER_URI = "E:\\qlib_data\\tushare_qlib_data\\qlib_bin"
+PATHS_YAML = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'config', 'paths.yaml'))
+STUDY_NAME = "LGBM_158"
+DEFAULT_STORAGE = "sqlite:///db.sqlite3"
+# 与 LGBModel.fit 的默认值一致
+NUM_BOOST_ROUND = 1000
+EARLY_STOPPING_ROUNDS = 50
+# 每隔多少轮向 Optuna 报告一次验证集 l2（每次报告都会写 storage）
+REPORT_EVERY = 10
+PRUNERS = ("hyperband", "sha", "median", "none")
+
+custom_dataset_config = {
+    "class": "DatasetH",
+    "module_path": "qlib.data.dataset",
+    "kwargs": {
+        "handler": {
+            "class": "Alpha158",
+            "module_path": "qlib.contrib.data.handler",
             "kwargs": {
-                "loss": "mse",
-                "colsample_bytree": trial.suggest_uniform("colsample_bytree", 0.5, 1),
-                "learning_rate": trial.suggest_uniform("learning_rate", 0, 1),
-                "subsample": trial.suggest_uniform("subsample", 0, 1),
-                "lambda_l1": trial.suggest_loguniform("lambda_l1", 1e-8, 1e4),
-                "lambda_l2": trial.suggest_loguniform("lambda_l2", 1e-8, 1e4),
-                "max_depth": 10,
-                "num_leaves": trial.suggest_int("num_leaves", 1, 1024),
-                "feature_fraction": trial.suggest_uniform("feature_fraction", 0.4, 1.0),
-                "bagging_fraction": trial.suggest_uniform("bagging_fraction", 0.4, 1.0),
-                "bagging_freq": trial.suggest_int("bagging_freq", 1, 7),
-                "min_data_in_leaf": trial.suggest_int("min_data_in_leaf", 1, 50),
-                "min_child_samples": trial.suggest_int("min_child_samples", 5, 100),
+                "start_time": "2015-01-01",
+                "end_time": "2025-11-01",
+                "instruments": "all",
             },
         },
+        "segments": {
+            "train": ("2015-01-01", "2025-10-28"),
+            "valid": ("2025-10-28", "2025-10-30"),
+            "test": ("2025-10-30", "2025-11-01"),
+        },
+    },
+}
+
+
+def suggest_params(trial):
+    return {
+        "objective": "mse",
+        "verbosity": -1,
+        "colsample_bytree": trial.suggest_uniform("colsample_bytree", 0.5, 1),
+        "learning_rate": trial.suggest_uniform("learning_rate", 0, 1),
+        "subsample": trial.suggest_uniform("subsample", 0, 1),
+        "lambda_l1": trial.suggest_loguniform("lambda_l1", 1e-8, 1e4),
+        "lambda_l2": trial.suggest_loguniform("lambda_l2", 1e-8, 1e4),
+        "max_depth": 10,
+        "num_leaves": trial.suggest_int("num_leaves", 1, 1024),
+        "feature_fraction": trial.suggest_uniform("feature_fraction", 0.4, 1.0),
+        "bagging_fraction": trial.suggest_uniform("bagging_fraction", 0.4, 1.0),
+        "bagging_freq": trial.suggest_int("bagging_freq", 1, 7),
+        "min_data_in_leaf": trial.suggest_int("min_data_in_leaf", 1, 50),
+        "min_child_samples": trial.suggest_int("min_child_samples", 5, 100),
     }
+
+
+def dataset_cache_key():
+    dataset_kwargs = custom_dataset_config["kwargs"]
+    segments = {name: list(dataset_kwargs["segments"][name]) for name in ("train", "valid")}
+    end = data_end(PROVIDER_URI, segments)
+    return cache_key(dataset_kwargs["handler"], segments, bin_data_version(PROVIDER_URI, end)), end
+
+
+def round_warmup(warmup):
+    """向上取整到 REPORT_EVERY 的倍数：只有这些轮次会报告给 pruner。"""
+    return -(-max(int(warmup), 1) // REPORT_EVERY) * REPORT_EVERY
+
+
+def make_pruner(name, warmup=20):
+    """warmup 为开始剪枝前至少训练的轮数（median 的 n_warmup_steps，sha/hyperband 的 min_resource），
+    按 round_warmup 向上取整到 REPORT_EVERY 的倍数。"""
+    warmup = round_warmup(warmup)
+    if name == "median":
+        return optuna.pruners.MedianPruner(n_startup_trials=5, n_warmup_steps=warmup, interval_steps=REPORT_EVERY)
+    if name == "sha":
+        return optuna.pruners.SuccessiveHalvingPruner(min_resource=warmup, reduction_factor=3)
+    if name == "hyperband":
+        return optuna.pruners.HyperbandPruner(min_resource=warmup, max_resource=NUM_BOOST_ROUND, reduction_factor=3)
+    return optuna.pruners.NopPruner()
+
+
+def pruning_callback(trial):
+    """LightGBM 回调：报告验证集 l2，pruner 判定剪枝时立即抛出 TrialPruned 结束训练。"""
+    def _callback(env):
+        step = env.iteration + 1
+        if step % REPORT_EVERY:
+            return
+        for data_name, metric, value, _ in env.evaluation_result_list:
+            if data_name == "valid" and metric == "l2":
+                trial.report(value, step)
+                if trial.should_prune():
+                    raise optuna.TrialPruned(f"Trial was pruned at iteration {step}.")
+    return _callback
+
+
+def objective(trial, data, num_threads=None):
+    """data 为 (dtrain, dvalid)；Dataset 以 feature_pre_filter=False 构建，可在各 trial 间复用。"""
+    params = suggest_params(trial)
+    if num_threads:
+        params["num_threads"] = num_threads
+    dtrain, dvalid = data
     evals_result = dict()
-    model = init_instance_by_config(task["model"])
-    model.fit(dataset, evals_result=evals_result)
-  
+    callbacks = [lgb.early_stopping(EARLY_STOPPING_ROUNDS, verbose=False), lgb.record_evaluation(evals_result)]
+    if not isinstance(trial.study.pruner, optuna.pruners.NopPruner):
+        callbacks.append(pruning_callback(trial))
+    lgb.train(
+        params,
+        dtrain,
+        num_boost_round=NUM_BOOST_ROUND,
+        valid_sets=[dtrain, dvalid],
+        valid_names=["train", "valid"],
+        callbacks=callbacks,
+    )
+
     return min(evals_result["valid"]["l2"])
 
 
-if __name__ == "__main__":
-    provider_uri = "E:\\qlib_data\\tushare_qlib_data\\qlib_bin"
+def make_storage(storage_url=DEFAULT_STORAGE, journal=None):
+    """多进程并发写入安全的 storage：journal 文件，或开启 WAL 的 SQLite。"""
+    if journal:
+        try:
+            from optuna.storages.journal import JournalFileBackend, JournalFileOpenLock
+        except ImportError:  # optuna < 4.0
+            from optuna.storages import JournalFileStorage as JournalFileBackend, JournalFileOpenLock
+        # 文件锁用 open(O_EXCL)，Windows 上不需要创建符号链接的权限
+        return optuna.storages.JournalStorage(JournalFileBackend(journal, lock_obj=JournalFileOpenLock(journal)))
+    if storage_url.startswith("sqlite:///"):
+        conn = sqlite3.connect(storage_url[len("sqlite:///"):])
+        conn.execute("PRAGMA journal_mode=WAL")  # 写入 db 文件头，对之后的所有连接生效
+        conn.close()
+        return optuna.storages.RDBStorage(storage_url, engine_kwargs={"connect_args": {"timeout": 60}})
+    return optuna.storages.RDBStorage(storage_url)
+
+
+def run_trials(study_name, storage_url, journal, cache_dir, key, n_trials, num_threads, pruner="none", warmup=20):
+    """一个工作进程：读取一次二进制 Dataset 缓存，在同一个 study 上运行 n_trials 个 trial。"""
+    warnings.filterwarnings("ignore")
+    logging.basicConfig(level=logging.INFO)
+    study = optuna.load_study(study_name=study_name, storage=make_storage(storage_url, journal),
+                              pruner=make_pruner(pruner, warmup))
+    data = LGBDatasetCache(cache_dir).load(key)
+    study.optimize(lambda trial: objective(trial, data, num_threads), n_trials=n_trials)
+
+
+def split_cores(workers, threads_per_worker):
+    """(进程数, 每进程 LightGBM 线程数)，两者都为 0 时默认每进程 4 线程并用满所有核。"""
+    cpus = os.cpu_count() or 1
+    if workers and not threads_per_worker:
+        threads_per_worker = max(1, cpus // workers)
+    elif not workers:
+        threads_per_worker = threads_per_worker or min(4, cpus)
+        workers = max(1, cpus // threads_per_worker)
+    return workers, threads_per_worker
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Optuna 搜索 LightGBM 超参数（多进程共享同一份数据）")
+    parser.add_argument("--n-trials", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=0, help="并行的 trial 进程数，0 为按核数自动设置")
+    parser.add_argument("--threads-per-worker", type=int, default=0, help="每个进程的 LightGBM 线程数，0 为自动")
+    parser.add_argument("--study-name", default=STUDY_NAME)
+    parser.add_argument("--storage", default=DEFAULT_STORAGE)
+    parser.add_argument("--journal", default=None, help="使用 journal 文件 storage（替代 --storage）")
+    parser.add_argument("--pruner", choices=PRUNERS, default="none",
+                        help="sha 为 successive halving；默认 none 不剪枝")
+    parser.add_argument("--pruner-warmup", type=int, default=20,
+                        help=f"开始剪枝前至少训练的轮数，向上取整到 {REPORT_EVERY} 的倍数")
+    parser.add_argument("--dataset-cache-dir", default=None,
+                        help="LightGBM Dataset 二进制缓存目录，缺省读取 paths.yaml 的 lgb_dataset_cache_dir，"
+                             "都未配置时使用临时目录并在结束后删除")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.pruner != "none" and round_warmup(args.pruner_warmup) != args.pruner_warmup:
+        log.warning(f"--pruner-warmup {args.pruner_warmup} 不是 {REPORT_EVERY} 的倍数，"
+                    f"按 {round_warmup(args.pruner_warmup)} 轮处理")
+
+    with open(PATHS_YAML, 'r', encoding='utf-8') as f:
+        cfg = yaml.safe_load(f) or {}
+    cache_dir = args.dataset_cache_dir or cfg.get("lgb_dataset_cache_dir")
+    temp_cache = not cache_dir
+    cache_dir = cache_dir or tempfile.mkdtemp(prefix="lgbm_optuna_")
+    cache = LGBDatasetCache(cache_dir)
+
+    provider_uri = PROVIDER_URI
     GetData().qlib_data(target_dir=provider_uri, region=REG_CN, exists_skip=True)
-    qlib.init(provider_uri=provider_uri, region="cn")
-
-    
-    custom_dataset_config = {
-        "class": "DatasetH",
-        "module_path": "qlib.data.dataset",
-        "kwargs": {
-            "handler": {
-                "class": "Alpha158",
-                "module_path": "qlib.contrib.data.handler",
-                "kwargs": {
-                    "start_time": "2015-01-01",
-                    "end_time": "2025-11-01",
-                    "instruments": "all",
-                },
-            },
-            "segments": {
-                "train": ("2015-01-01", "2025-10-28"),
-                "valid": ("2025-10-28", "2025-10-30"),
-                "test": ("2025-10-30", "2025-11-01"),
-            },
-        },
-    }
-    dataset = init_instance_by_config(custom_dataset_config)
+    init_qlib(provider_uri, region="cn")
+
+    # 缓存未命中时才构建 handler；命中时直接读取二进制 Dataset
+    key, end = dataset_cache_key()
+    data = cache.get_or_build(key, lambda: prepare_arrays(init_instance_by_config(custom_dataset_config)), end=end)
 
-    study = optuna.Study(study_name="LGBM_158", storage="sqlite:///db.sqlite3")
- 
-    # R.start(experiment_name="lgbm_optuna", recorder_name="run_1")
-    study.optimize(lambda trial: objective(trial, dataset), n_trials=200, n_jobs=1)
+    study = optuna.create_study(study_name=args.study_name, storage=make_storage(args.storage, args.journal),
+                                direction="minimize", load_if_exists=True,
+                                pruner=make_pruner(args.pruner, args.pruner_warmup))
 
-   
+    workers, threads = split_cores(args.workers, args.threads_per_worker)
+    workers = min(workers, args.n_trials)
+    log.info(f"{args.n_trials} 个 trial，{workers} 个进程 x {threads} 线程")
+    failed = []
+    try:
+        if workers == 1:
+            study.optimize(lambda trial: objective(trial, data, threads), n_trials=args.n_trials)
+        else:
+            # 各工作进程自己读取二进制缓存，父进程不再持有 Dataset
+            del data
+            log.info(f"每个工作进程持有一份 Dataset，约 {cache.entry_bytes(key) / 2 ** 30:.2f} GB，"
+                     f"共 {workers} 份")
+            ctx = mp.get_context("spawn")
+            base, extra = divmod(args.n_trials, workers)
+            procs = [
+                ctx.Process(target=run_trials, args=(args.study_name, args.storage, args.journal, cache_dir, key,
+                                                     base + (i < extra), threads, args.pruner, args.pruner_warmup))
+                for i in range(workers)
+            ]
+            for p in procs:
+                p.start()
+            for p in procs:
+                p.join()
+            failed = [p.exitcode for p in procs if p.exitcode]
+            if failed:
+                log.error(f"{len(failed)} 个工作进程异常退出: {failed}")
+    finally:
+        if temp_cache:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    study = optuna.load_study(study_name=args.study_name, storage=make_storage(args.storage, args.journal))
+    states = [t.state for t in study.trials]
+    log.info(f"完成 {states.count(optuna.trial.TrialState.COMPLETE)} 个 trial，"
+             f"剪枝 {states.count(optuna.trial.TrialState.PRUNED)} 个")
     if len(study.trials) > 0 and getattr(study, "best_trial", None) is not None:
         log.info("Best params:")
         log.info(study.best_params)
     else:
         log.error("No successful trial found.")
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    mp.freeze_support()
+    main()
 
 
 # optuna create-study --study LGBM_158 --storage sqlite:///db.sqlite3
@@ -1,4 +1,10 @@
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+import argparse
+import hashlib
+import io
+import json
 import pandas as pd
 import os
 from importer import MySQLImporter
@@ -23,6 +29,9 @@ SCHEMA = [
 ]
 
 
+MANIFEST_NAME = '.weight_import_manifest.json'
+
+
 def discover_csv_files(a_folder: str):
     p = Path(a_folder)
     if not p.exists():
@@ -30,48 +39,138 @@ def discover_csv_files(a_folder: str):
     return sorted([str(x) for x in p.rglob('*.csv') if x.is_file()])
 
 
-def read_and_normalize(csv_path: str):
-    df = pd.read_csv(csv_path, dtype=str)
-    # normalize column names
-    df.columns = [c.strip() for c in df.columns]
+def load_manifest(manifest_path: str):
+    """已导入文件清单 {绝对路径: {size, mtime_ns, sha256, rows}}。"""
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_manifest(manifest_path: str, manifest: dict):
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def file_state(csv_path: str, entry: Optional[dict]):
+    """(路径, 新的清单条目, DataFrame 或 None)。
+
+    size 和 mtime 未变时不读文件；变了就把文件读入一次，用同一份内容计算哈希并解析。
+    哈希与清单一致（只是被 touch 过）时不解析，返回 None。
+    """
+    st = os.stat(csv_path)
+    state = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    if entry and entry.get('size') == st.st_size and entry.get('mtime_ns') == st.st_mtime_ns:
+        return csv_path, {**entry, **state}, None
+    with open(csv_path, 'rb') as f:
+        data = f.read()
+    state['sha256'] = hashlib.sha256(data).hexdigest()
+    if entry and entry.get('sha256') == state['sha256']:
+        # 只是被 touch 过，内容未变
+        return csv_path, {**entry, **state}, None
+    return csv_path, state, read_and_normalize(csv_path, data)
+
+
+def read_and_normalize(csv_path: str, data: Optional[bytes] = None):
+    """读取并规范化权重 csv；给出 data 时从这份已读入的文件内容解析，不再读文件。"""
+    def source():
+        return io.BytesIO(data) if data is not None else csv_path
+
+    # 先只读表头确定列名，再按类型只读取需要的列
+    header = pd.read_csv(source(), nrows=0).columns
+    stripped = {c.strip(): c for c in header}
+    lower_map = {c.lower(): raw for c, raw in stripped.items()}
 
     # ensure required columns exist
     required = ['valuation_date', 'code', 'portfolio_name', 'weight']
-    lower_map = {c.lower(): c for c in df.columns}
 
     # Try to map case-insensitive
     mapped = {}
     for req in required:
-        if req in df.columns:
-            mapped[req] = req
+        if req in stripped:
+            mapped[req] = stripped[req]
         elif req in lower_map:
             mapped[req] = lower_map[req]
         else:
             raise KeyError(f"CSV {csv_path} 缺少必要列: {req}")
 
+    df = pd.read_csv(source(), usecols=[mapped[r] for r in required],
+                     dtype={mapped['valuation_date']: str, mapped['code']: str, mapped['portfolio_name']: str})
+
     # select and rename
     df2 = df[[mapped[r] for r in required]].copy()
     df2.columns = required
 
-    # convert types
-    df2['valuation_date'] = df2['valuation_date'].astype(str)
-    df2['code'] = df2['code'].astype(str)
-    df2['portfolio_name'] = df2['portfolio_name'].astype(str)
     # weight to numeric
     df2['weight'] = pd.to_numeric(df2['weight'], errors='coerce')
 
-    # add upload timestamp column for all rows
-    try:
-        df2['update_time'] = pd.Timestamp.now()
-    except Exception:
-        # fallback to python datetime
-        from datetime import datetime
-        df2['update_time'] = datetime.now()
-
     return df2
 
 
-def main():
+def file_partitions(df: pd.DataFrame):
+    """文件覆盖的 (valuation_date, portfolio_name) 分区，记入导入清单。"""
+    pairs = df[['valuation_date', 'portfolio_name']].drop_duplicates()
+    return sorted(f"{d}|{p}" for d, p in zip(pairs['valuation_date'], pairs['portfolio_name']))
+
+
+def files_to_import(states, manifest, imported_states):
+    """按发现顺序产出需要导入的 (文件, DataFrame, 分区)。
+
+    内容变化的文件直接使用 file_state 已解析的 DataFrame。排在其后、已导入且分区与之前
+    导入的文件重叠的文件也要重新导入：单独重导较早的文件会覆盖较晚文件中相同主键的行。
+    清单中没有分区信息的文件按重叠处理。其余文件只更新清单条目。
+    imported_states 收集要导入文件的新清单条目，以及变化/重导的文件数。
+    """
+    touched = set()
+    for csv, state, df in states:
+        if df is None:
+            parts = manifest.get(csv, {}).get('partitions')
+            if not touched or (parts is not None and not touched.intersection(parts)):
+                manifest[csv] = state
+                continue
+            imported_states['replay'] += 1
+            df = read_and_normalize(csv)
+        else:
+            imported_states['changed'] += 1
+        parts = file_partitions(df)
+        touched.update(parts)
+        imported_states[csv] = state
+        yield csv, df, parts
+
+
+def import_batches(importer, frames, table, pk_fields, batch_rows, on_imported):
+    """frames 为按顺序的 (文件, DataFrame, 分区)，攒够 batch_rows 行就写入一次；每批成功后调用 on_imported(该批文件)。
+
+    同一批内主键重复时保留靠后文件的行；每批所有行使用同一个 update_time。
+    on_imported 收到 [(文件, 行数, 分区)]。
+    """
+    batch, batch_files, batch_size = [], [], 0
+
+    def flush():
+        nonlocal batch, batch_files, batch_size
+        if not batch:
+            return
+        # batch 按文件顺序拼接，keep='last' 即后面的文件覆盖前面文件中相同主键的行
+        combined = (pd.concat(batch, ignore_index=True)
+                    .drop_duplicates(subset=pk_fields, keep='last')
+                    .assign(update_time=pd.Timestamp.now()))
+        importer.df_to_mysql(combined, table, SCHEMA, pk_fields, database='database2', raise_on_error=True)
+        on_imported(batch_files)
+        batch, batch_files, batch_size = [], [], 0
+
+    for csv, df, parts in frames:
+        batch.append(df)
+        batch_files.append((csv, len(df), parts))
+        batch_size += len(df)
+        if batch_size >= batch_rows:
+            flush()
+    flush()
+
+
+def main(full: bool = False):
     cfg_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'config', 'db.yaml'))
     with open(cfg_path, 'r', encoding='utf-8') as f:
         cfg = yaml.safe_load(f) or {}
@@ -79,34 +178,51 @@ def main():
     table = cfg['table_name2']
     pk = cfg.get('pk', 'valuation_date,code,portfolio_name')
     a_folder = cfg.get('a_folder', A_FOLDER)
+    workers = max(1, int(cfg.get('workers') or 1))
+    batch_rows = int(cfg.get('import_batch_rows') or 200000)
+    manifest_path = cfg.get('weight_manifest') or os.path.join(a_folder, MANIFEST_NAME)
 
     pk_fields = [p.strip() for p in pk.split(',') if p.strip()]
 
-    csvs = discover_csv_files(a_folder)
+    csvs = [os.path.abspath(c) for c in discover_csv_files(a_folder)]
     if not csvs:
         print(f"在 {a_folder} 中未找到 csv 文件。")
         return
+
+    manifest = {} if full else load_manifest(manifest_path)
+    # 清单中已不存在的文件直接去掉
+    manifest = {k: v for k, v in manifest.items() if k in set(csvs)}
+
     db_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'config', 'db.yaml'))
   
     importer = MySQLImporter(db_path)
+    imported_states = {'changed': 0, 'replay': 0}
 
-    all_rows = []
-    for csv in csvs:
-        df = read_and_normalize(csv)
-        all_rows.append(df)
+    def on_imported(batch):
+        for csv, rows, partitions in batch:
+            manifest[csv] = {**imported_states[csv], 'rows': rows, 'partitions': partitions}
+        save_manifest(manifest_path, manifest)
 
-    if not all_rows:
-        print("没有读取到任何数据。")
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            # map 按提交顺序返回；变化的文件只读一次，哈希、行数和导入共用同一份内容。
+            # 按发现顺序导入，后面的文件覆盖前面文件中相同主键的行
+            states = pool.map(lambda c: file_state(c, manifest.get(c)), csvs)
+            import_batches(importer, files_to_import(states, manifest, imported_states),
+                           table, pk_fields, batch_rows, on_imported)
+    finally:
         importer.close()
-        return
-
-    combined = pd.concat(all_rows, ignore_index=True)
+    save_manifest(manifest_path, manifest)
 
-    # call df_to_mysql with schema and pk_fields
-    importer.df_to_mysql(combined, table, SCHEMA, pk_fields, database='database2')
-   
-    importer.close()
+    if not imported_states['changed']:
+        print(f"{a_folder} 中的 {len(csvs)} 个 csv 文件均已导入，没有新增或变化的文件。")
+        return
+    print(f"导入 {imported_states['changed']}/{len(csvs)} 个新增或变化的 csv"
+          + (f"，并按顺序重新导入 {imported_states['replay']} 个分区重叠的较晚 csv" if imported_states['replay'] else ""))
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description="增量导入 temp_dir 下新增或变化的权重 csv")
+    parser.add_argument("--full", action="store_true", help="忽略导入清单，重新导入全部 csv")
+    args = parser.parse_args()
+    main(full=args.full)
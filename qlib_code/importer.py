@@ -1,26 +1,226 @@
+import csv
+import hashlib
+import json
+import re
+import numpy as np
 import pandas as pd
 import pymysql
-from sqlalchemy import create_engine, text, types
+from sqlalchemy import text
 import yaml
 from typing import Dict, List, Optional
 import os
+import tempfile
+import time
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from logging import Logger
+from db_engine import get_engine, mysql_url, release_engine, retry
 logger: Logger = logging.getLogger(__name__)
 
 
+# LOAD DATA LOCAL INFILE 被服务端或客户端禁用时的错误码
+LOCAL_INFILE_ERRORS = {1148, 2068, 3948}
+
+
+def _is_date_type(mysql_type):
+    mysql_type = mysql_type.upper()
+    return mysql_type == 'DATE' or (mysql_type.startswith('DATE') and 'DATETIME' not in mysql_type)
+
+
+def column_params(series: pd.Series, mysql_type: str = '') -> list:
+    """把一列转换成 pymysql 可直接转义的 Python 值列表（整列向量化处理）。
+
+    缺失值 -> None，datetime64 -> datetime（DATE 列 -> date），DECIMAL(p,s) 列先按 s 位四舍五入。
+    """
+    mysql_type = mysql_type.upper()
+    mask = series.isna().to_numpy()
+    if pd.api.types.is_datetime64_any_dtype(series):
+        index = pd.DatetimeIndex(series)
+        values = index.date if _is_date_type(mysql_type) else index.to_pydatetime()
+        values = np.asarray(values, dtype=object)
+    else:
+        if 'DECIMAL' in mysql_type and pd.api.types.is_float_dtype(series):
+            scale = re.search(r'DECIMAL\s*\(\s*\d+\s*,\s*(\d+)\s*\)', mysql_type)
+            if scale:
+                series = series.round(int(scale.group(1)))
+        values = series.to_numpy(dtype=object)
+    if mask.any():
+        values[mask] = None
+    return values.tolist()
+
+
+def build_param_rows(df: pd.DataFrame, cols: List[str], schema_cols: Dict[str, str]) -> list:
+    """executemany 的参数行：各列先整体转换，再 zip 成元组，不经过 to_dict(records)。"""
+    return list(zip(*[column_params(df[c], schema_cols.get(c, '')) for c in cols]))
+
+
+# diff 模式下不参与比较的列，以及用来圈定受影响分区的主键列
+DIFF_IGNORE_COLUMNS = ('update_time',)
+DIFF_PARTITION_COLUMNS = ('valuation_date', 'portfolio_name', 'score_name')
+DIFF_PARTITION_BATCH = 500
+
+
+# LOAD DATA 默认 ESCAPED BY '\\'：需要转义的字符及其转义序列（反斜杠必须最先处理）
+LOAD_DATA_ESCAPES = (('\\', '\\\\'), ('\0', '\\0'), ('\t', '\\t'), ('\n', '\\n'), ('\r', '\\r'))
+
+
+def _load_data_escape(series: pd.Series) -> pd.Series:
+    """字符串列转换成 LOAD DATA 的转义格式；缺失值保持缺失（写成 \\N），非字符串值不变。"""
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        series = series.astype(object)
+    is_str = series.map(lambda v: isinstance(v, str), na_action='ignore').fillna(False).astype(bool)
+    if not is_str.any():
+        return series
+    escaped = series[is_str].astype(str)
+    for raw, esc in LOAD_DATA_ESCAPES:
+        escaped = escaped.str.replace(raw, esc, regex=False)
+    series = series.astype(object)
+    series[is_str] = escaped
+    return series
+
+
+def _numeric_scale(mysql_type):
+    """比较哈希时数值列保留的小数位：DECIMAL(p,s) 为 s，FLOAT/DOUBLE 为 6，整数为 0；非数值列返回 None。"""
+    scale = re.search(r'DECIMAL\s*\(\s*\d+\s*,\s*(\d+)\s*\)', mysql_type)
+    if scale:
+        return int(scale.group(1))
+    if 'FLOAT' in mysql_type or 'DOUBLE' in mysql_type or 'DECIMAL' in mysql_type:
+        return 6
+    if 'INT' in mysql_type:
+        return 0
+    return None
+
+
+def _diff_sql_expr(col, mysql_type):
+    """列在服务端的规范化字符串表达式，与 _diff_strings 的格式一致。"""
+    mysql_type = mysql_type.upper()
+    scale = _numeric_scale(mysql_type)
+    if 'DATETIME' in mysql_type or 'TIMESTAMP' in mysql_type:
+        expr = f"DATE_FORMAT(`{col}`, '%%Y-%%m-%%d %%H:%%i:%%s')"
+    elif _is_date_type(mysql_type):
+        expr = f"DATE_FORMAT(`{col}`, '%%Y-%%m-%%d')"
+    elif scale is not None:
+        expr = f"CAST(ROUND(`{col}`, {scale}) AS DECIMAL(65, {scale}))"
+    else:
+        expr = f"CAST(`{col}` AS CHAR)"
+    return f"COALESCE({expr}, '\\\\N')"
+
+
+def _diff_strings(series, mysql_type):
+    """列在本地的规范化字符串，缺失值为 \\N。"""
+    mysql_type = mysql_type.upper()
+    scale = _numeric_scale(mysql_type)
+    mask = series.isna().to_numpy()
+    if pd.api.types.is_datetime64_any_dtype(series):
+        fmt = '%Y-%m-%d' if _is_date_type(mysql_type) else '%Y-%m-%d %H:%M:%S'
+        values = series.dt.strftime(fmt).to_numpy(dtype=object)
+    elif scale is not None:
+        values = np.asarray([f"{v:.{scale}f}" for v in pd.to_numeric(series, errors='coerce').fillna(0)],
+                            dtype=object)
+    else:
+        values = series.astype(str).to_numpy(dtype=object)
+    values[mask] = '\\N'
+    return values
+
+
+# 按日期 RANGE 分区：interval 为 month 或 year，ahead 为预先建好的未来分区个数
+PARTITION_INTERVALS = ('month', 'year')
+DEFAULT_PARTITION_AHEAD = 3
+
+
+def _period_start(ts, interval):
+    ts = pd.Timestamp(ts)
+    return pd.Timestamp(ts.year, 1 if interval == 'year' else ts.month, 1)
+
+
+def _next_period(ts, interval):
+    return ts + (pd.DateOffset(years=1) if interval == 'year' else pd.DateOffset(months=1))
+
+
+def _partition_name(ts, interval):
+    return ts.strftime('p%Y' if interval == 'year' else 'p%Y%m')
+
+
+def _partition_defs(start, end, interval):
+    """[start, end] 覆盖的每个周期一个分区，边界为下一周期的第一天。"""
+    defs = []
+    period = _period_start(start, interval)
+    while period <= end:
+        upper = _next_period(period, interval)
+        defs.append(f"PARTITION {_partition_name(period, interval)} VALUES LESS THAN ('{upper:%Y-%m-%d}')")
+        period = upper
+    return defs
+
+
+def partition_clause(column, interval, start, end):
+    """PARTITION BY RANGE COLUMNS 子句：早于 start 所在周期的数据落入 p_hist，其后每个周期一个分区直到 end。
+
+    RANGE COLUMNS 可直接用于 DATE/DATETIME 列，也适用于存 'YYYY-MM-DD' 字符串的 VARCHAR 列。
+    不建 MAXVALUE 分区，未来的分区由 df_to_mysql 在写入前按需添加。
+    """
+    first = _period_start(start, interval)
+    defs = [f"PARTITION p_hist VALUES LESS THAN ('{first:%Y-%m-%d}')"] + _partition_defs(first, end, interval)
+    return f"PARTITION BY RANGE COLUMNS(`{column}`) (\n            " + ',\n            '.join(defs) + "\n        )"
+
+
+class MissingUniqueKeyError(RuntimeError):
+    """目标表没有 upsert 所需的主键/唯一键，且无法自动添加（已有重复行）。"""
+
+
+DEFAULT_DUP_CHECK_STATE = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'spool',
+                                                       'dup_check_state.json'))
+
+
 class MySQLImporter:
     def __init__(self, config_path):
         with open(config_path, 'r') as f:
             self.config = yaml.safe_load(f)
 
-        self.engine = create_engine(
-            f"mysql+pymysql://{self.config['user']}:{self.config['password']}"
-            f"@{self.config['host']}:{self.config['port']}/{self.config['database']}"
+        # 每块的行数、并行写入的连接数、单块失败后的重试次数
+        self.chunk_size = int(self.config.get('chunk_size') or 20000)
+        self.workers = max(1, int(self.config.get('workers') or 1))
+        self.retries = int(self.config.get('retries', 3))
+        # 行数不少于该值时走 LOAD DATA LOCAL INFILE 批量导入
+        self.bulk_threshold = int(self.config.get('bulk_threshold') or 200000)
+
+        # 进程内共享的连接池（pre-ping、定期回收），大小至少为并行写入的连接数
+        self.engine = get_engine(
+            mysql_url(self.config),
+            self.config,
+            pool_size=max(int(self.config.get('pool_size') or 5), self.workers),
+            connect_args={'local_infile': True},
         )
+        # 表结构缓存 {(db, table): {'exists', 'columns', 'pk'}}，以及已做过重复主键检查的 (db, table, keys)
+        self._schema_cache = {}
+        self._dup_checked = set()
+        # 重复主键检查通过的表结构指纹持久化到本地文件，表结构不变时后续进程不再全表扫描
+        self._dup_state_path = self.config.get('dup_check_state') or DEFAULT_DUP_CHECK_STATE
+        self._dup_state = None
         
     
-    def create_table(self, table_name, schema, pk_fields, db: Optional[str] = None):
+    def _partition_spec(self, table_name, partition=None):
+        """分区配置 {'column', 'interval', 'ahead'}：显式传入优先，否则读取 db.yaml 的 partitions[table_name]。
+
+        partition=False 表示不分区。
+        """
+        if partition is False:
+            return None
+        if partition is None:
+            partition = (self.config.get('partitions') or {}).get(table_name)
+        if not partition:
+            return None
+        spec = {'interval': 'month', 'ahead': DEFAULT_PARTITION_AHEAD, **partition}
+        if spec['interval'] not in PARTITION_INTERVALS:
+            raise ValueError(f"不支持的分区周期 {spec['interval']}，可选 {PARTITION_INTERVALS}")
+        return spec
+
+    def create_table(self, table_name, schema, pk_fields, db: Optional[str] = None,
+                     partition: Optional[dict] = None, start=None, end=None):
+        """建表；partition 为 {'column', 'interval', 'ahead'} 时按日期列 RANGE 分区。
+
+        分区从 start 所在周期（缺省为当前周期）建到 max(end, 今天) 之后 ahead 个周期。
+        MySQL 要求分区列包含在主键中。
+        """
 
         columns = []
         for col_def in schema:
@@ -34,11 +234,24 @@ class MySQLImporter:
             pk_cols = ', '.join([f"`{c}`" for c in pk_fields])
             pk_clause = f",\n            PRIMARY KEY ({pk_cols})"
 
+        part_sql = ''
+        if partition:
+            column, interval = partition['column'], partition.get('interval', 'month')
+            if column not in [c['field'] for c in schema]:
+                raise ValueError(f"分区列 {column} 不在表 {table_name} 的 schema 中")
+            if pk_fields and column not in pk_fields:
+                raise ValueError(f"分区列 {column} 必须包含在主键 {pk_fields} 中")
+            today = pd.Timestamp.today().normalize()
+            last = max(pd.Timestamp(end), today) if end is not None else today
+            for _ in range(int(partition.get('ahead', DEFAULT_PARTITION_AHEAD))):
+                last = _next_period(_period_start(last, interval), interval)
+            part_sql = '\n        ' + partition_clause(column, interval, start if start is not None else today, last)
+
         # 生成CREATE TABLE语句
         create_sql = f"""
         CREATE TABLE IF NOT EXISTS `{table_name}` (
             {', '.join(columns)}{pk_clause}
-        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4{part_sql}
         """
 
         # If db provided, qualify table with database name
@@ -48,76 +261,247 @@ class MySQLImporter:
         # use a transaction when creating the table
         with self.engine.begin() as conn:
             conn.execute(text(create_sql))
+        self.invalidate_schema(table_name, db)
 
-    def _table_exists(self, table_name, db: Optional[str] = None):
+    def _table_meta(self, table_name, db: Optional[str] = None):
+        """表是否存在、列集合和主键列，一次 information_schema 查询后按 (db, table) 缓存在本实例中。
+
+        本实例执行的建表/加列会调用 invalidate_schema；其他进程改了表结构时需手动调用。
+        """
         if db is None:
             db = self.config['database']
-        sql = text("SELECT COUNT(*) AS cnt FROM information_schema.tables WHERE table_schema = :db AND table_name = :tbl")
+        key = (db, table_name)
+        meta = self._schema_cache.get(key)
+        if meta is not None:
+            return meta
+
+        sql = text("SELECT c.COLUMN_NAME, k.ORDINAL_POSITION FROM information_schema.columns c "
+                   "LEFT JOIN information_schema.KEY_COLUMN_USAGE k "
+                   "ON k.TABLE_SCHEMA = c.TABLE_SCHEMA AND k.TABLE_NAME = c.TABLE_NAME "
+                   "AND k.COLUMN_NAME = c.COLUMN_NAME AND k.CONSTRAINT_NAME = 'PRIMARY' "
+                   "WHERE c.TABLE_SCHEMA = :db AND c.TABLE_NAME = :tbl")
+        res = self._fetchall(sql, {'db': db, 'tbl': table_name})
+        columns = {row[0] for row in res if row[0]}
+        pk = [name for name, pos in sorted((r for r in res if r[1] is not None), key=lambda r: r[1])]
+        meta = {'exists': bool(columns), 'columns': columns, 'pk': pk}
+        self._schema_cache[key] = meta
+        return meta
+
+    def _fetchall(self, sql, params=None):
+        """只读查询，断线时重试。"""
+        def once():
+            with self.engine.connect() as conn:
+                return conn.execute(sql, params or {}).fetchall()
+        return retry(once, retries=self.retries, engine=self.engine)
+
+    def invalidate_schema(self, table_name: Optional[str] = None, db: Optional[str] = None):
+        """清除表结构缓存；不传参数时清空全部。"""
+        if table_name is None:
+            self._schema_cache.clear()
+            self._dup_checked.clear()
+            return
+        key = (db or self.config['database'], table_name)
+        self._schema_cache.pop(key, None)
+        self._dup_checked = {k for k in self._dup_checked if k[:2] != key}
+
+    def _get_partitions(self, table_name, db: Optional[str] = None):
+        """表的分区 [(名称, 上界字符串)]，按顺序排列；未分区的表返回空列表。上界为 MAXVALUE 时原样返回。"""
+        meta = self._table_meta(table_name, db)
+        if 'partitions' not in meta:
+            sql = text("SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS "
+                       "WHERE TABLE_SCHEMA = :db AND TABLE_NAME = :tbl AND PARTITION_NAME IS NOT NULL "
+                       "ORDER BY PARTITION_ORDINAL_POSITION")
+            res = self._fetchall(sql, {'db': db or self.config['database'], 'tbl': table_name})
+            meta['partitions'] = [(name, (desc or '').strip("'")) for name, desc in res]
+        return list(meta['partitions'])
+
+    def _ensure_partitions(self, table_name, db: str, partition: dict, max_value):
+        """写入前补齐分区，使 max(max_value, 今天) 之后仍有 ahead 个周期的分区。
+
+        未分区的表、或已有 MAXVALUE 分区的表不做处理。
+        """
+        parts = self._get_partitions(table_name, db)
+        if not parts:
+            return
+        if any(bound.upper() == 'MAXVALUE' for _, bound in parts):
+            return
+        interval = partition['interval']
+        upper = max(pd.Timestamp(bound) for _, bound in parts)
+        target = max(pd.Timestamp(max_value), pd.Timestamp.today().normalize()) if max_value is not None \
+            else pd.Timestamp.today().normalize()
+        for _ in range(int(partition['ahead'])):
+            target = _next_period(_period_start(target, interval), interval)
+        defs = _partition_defs(upper, target, interval)
+        if not defs:
+            return
+        with self.engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE `{db}`.`{table_name}` ADD PARTITION ({', '.join(defs)})"))
+        self.invalidate_schema(table_name, db)
+        logger.info("%s.%s 新增 %d 个分区: %s", db, table_name, len(defs), ', '.join(d.split()[1] for d in defs))
+
+    def enable_partitioning(self, table_name, database: Optional[str] = None, partition: Optional[dict] = None):
+        """把已有的未分区表改为按日期 RANGE 分区（会重建整张表，数据量大时耗时较长）。"""
+        target_db = self.config.get(database, database) if database else self.config['database']
+        spec = self._partition_spec(table_name, partition)
+        if spec is None:
+            raise ValueError(f"没有表 {table_name} 的分区配置")
+        if self._get_partitions(table_name, target_db):
+            logger.info("%s.%s 已经分区", target_db, table_name)
+            return
+        # MySQL 要求分区列出现在每个主键/唯一键中；没有任何唯一键的表可以直接分区
+        missing = {name: cols for name, cols in self._unique_keys(table_name, target_db).items()
+                   if spec['column'] not in cols}
+        if missing:
+            raise ValueError(f"分区列 {spec['column']} 必须包含在每个主键/唯一键中，以下键缺少该列: {missing}")
         with self.engine.connect() as conn:
-            # use scalar() to get the first column of the first row (count)
-            scalar = conn.execute(sql, {
-                'db': db,
-                'tbl': table_name
-            }).scalar()
-            try:
-                return bool(scalar and int(scalar) > 0)
-            except Exception:
-                return False
+            lo, hi = conn.execute(text(f"SELECT MIN(`{spec['column']}`), MAX(`{spec['column']}`) "
+                                       f"FROM `{target_db}`.`{table_name}`")).first()
+        today = pd.Timestamp.today().normalize()
+        last = max(pd.Timestamp(hi), today) if hi is not None else today
+        for _ in range(int(spec['ahead'])):
+            last = _next_period(_period_start(last, spec['interval']), spec['interval'])
+        clause = partition_clause(spec['column'], spec['interval'], lo if lo is not None else today, last)
+        with self.engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE `{target_db}`.`{table_name}` {clause}"))
+        self.invalidate_schema(table_name, target_db)
+        logger.info("%s.%s 已按 %s 分区", target_db, table_name, spec['column'])
+
+    def drop_partitions_before(self, table_name, before, database: Optional[str] = None):
+        """删除上界不晚于 before 的分区（整段删除历史数据，不逐行 DELETE）；返回删除的分区名。"""
+        target_db = self.config.get(database, database) if database else self.config['database']
+        before = pd.Timestamp(before)
+        names = [name for name, bound in self._get_partitions(table_name, target_db)
+                 if bound.upper() != 'MAXVALUE' and pd.Timestamp(bound) <= before]
+        if names:
+            with self.engine.begin() as conn:
+                conn.execute(text(f"ALTER TABLE `{target_db}`.`{table_name}` DROP PARTITION {', '.join(names)}"))
+            self.invalidate_schema(table_name, target_db)
+            logger.info("%s.%s 删除分区: %s", target_db, table_name, ', '.join(names))
+        return names
+
+    def _unique_keys(self, table_name, db: Optional[str] = None):
+        """表的主键和唯一索引 {索引名: [列]}，列按索引中的顺序排列；与表结构一起缓存。"""
+        meta = self._table_meta(table_name, db)
+        if 'unique_keys' not in meta:
+            sql = text("SELECT INDEX_NAME, COLUMN_NAME FROM information_schema.STATISTICS "
+                       "WHERE TABLE_SCHEMA = :db AND TABLE_NAME = :tbl AND NON_UNIQUE = 0 "
+                       "ORDER BY INDEX_NAME, SEQ_IN_INDEX")
+            keys = {}
+            for name, column in self._fetchall(sql, {'db': db or self.config['database'], 'tbl': table_name}):
+                keys.setdefault(name, []).append(column)
+            meta['unique_keys'] = keys
+        return {name: list(cols) for name, cols in meta['unique_keys'].items()}
+
+    def _is_unique_key(self, table_name, key_fields, db: Optional[str] = None):
+        """key_fields 是否包含表的某个主键/唯一键，即表中每组 key_fields 至多一行。"""
+        return any(set(cols) <= set(key_fields) for cols in self._unique_keys(table_name, db).values())
+
+    def ensure_unique_key(self, table_name, key_fields, database: Optional[str] = None):
+        """确认 key_fields 是目标表的主键或唯一键：ON DUPLICATE KEY UPDATE 和重放的幂等性都依赖它。
+
+        表不存在时由 create_table 按 key_fields 建主键；已有表缺少该键时，没有重复行就添加唯一键，
+        有重复行时抛出 MissingUniqueKeyError。
+        """
+        target_db = self.config.get(database, database) if database else self.config['database']
+        if not self._table_exists(table_name, db=target_db):
+            return
+        if self._is_unique_key(table_name, key_fields, target_db):
+            return
+        if self._has_duplicate_keys(table_name, key_fields, db=target_db):
+            raise MissingUniqueKeyError(
+                f"{target_db}.{table_name} 没有 ({', '.join(key_fields)}) 主键/唯一键，且已有重复行（或无法检查），"
+                "请先清理重复数据或手动添加唯一键")
+        name = ('uk_' + '_'.join(key_fields))[:64]
+        cols = ', '.join(f"`{k}`" for k in key_fields)
+        with self.engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE `{target_db}`.`{table_name}` ADD UNIQUE KEY `{name}` ({cols})"))
+        self.invalidate_schema(table_name, target_db)
+        logger.warning("%s.%s 缺少 (%s) 唯一键，已添加 %s", target_db, table_name, ', '.join(key_fields), name)
+
+    def _table_exists(self, table_name, db: Optional[str] = None):
+        return self._table_meta(table_name, db)['exists']
 
     def _get_table_pk_columns(self, table_name, db: Optional[str] = None):
-        if db is None:
-            db = self.config['database']
-        sql = text("SELECT COLUMN_NAME FROM information_schema.KEY_COLUMN_USAGE "
-                   "WHERE TABLE_SCHEMA = :db AND TABLE_NAME = :tbl AND CONSTRAINT_NAME = 'PRIMARY' "
-                   "ORDER BY ORDINAL_POSITION")
-        with self.engine.connect() as conn:
-            res = conn.execute(sql, {'db': db, 'tbl': table_name}).fetchall()
-            cols = []
-            for row in res:
-                # SQLAlchemy row may be a tuple or have a _mapping
-                if hasattr(row, '_mapping'):
-                    cols.append(row._mapping.get('COLUMN_NAME'))
-                else:
-                    # assume first element is the column name
-                    cols.append(row[0])
-            return [c for c in cols if c]
-
-    def _count_duplicate_pk_groups(self, table_name, key_fields, db: Optional[str] = None):
-        # Count number of duplicate key groups (groups having count > 1)
+        return list(self._table_meta(table_name, db)['pk'])
+
+    def _has_duplicate_keys(self, table_name, key_fields, db: Optional[str] = None):
+        """目标表中 key_fields 是否有重复；找到第一组重复即停止，不再统计全部分组。"""
         if db is None:
             db = self.config['database']
         keys = ', '.join([f'`{k}`' for k in key_fields])
-        dup_sql = f"SELECT COUNT(*) AS dup_groups FROM (SELECT {keys}, COUNT(*) AS cnt FROM `{db}`.`{table_name}` GROUP BY {keys} HAVING cnt>1) t"
+        dup_sql = f"SELECT 1 FROM `{db}`.`{table_name}` GROUP BY {keys} HAVING COUNT(*) > 1 LIMIT 1"
         with self.engine.connect() as conn:
             try:
-                scalar = conn.execute(text(dup_sql)).scalar()
-                return int(scalar) if scalar is not None else 0
+                return conn.execute(text(dup_sql)).first() is not None
             except Exception:
-                # If the query fails (e.g., permission issues), return a conservative non-zero value to prevent inserts
-                return 1
+                # If the query fails (e.g., permission issues), be conservative and prevent inserts
+                return True
+
+    def _dup_fingerprint(self, table_name, key_fields, db):
+        """(库, 表, 列, 主键, key_fields) 的指纹；表结构变化后指纹随之变化，需重新检查。"""
+        meta = self._table_meta(table_name, db)
+        blob = json.dumps([db, table_name, sorted(meta['columns']), meta['pk'], list(key_fields)])
+        return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+    def _load_dup_state(self):
+        if self._dup_state is None:
+            try:
+                with open(self._dup_state_path, 'r', encoding='utf-8') as f:
+                    self._dup_state = set(json.load(f))
+            except (FileNotFoundError, ValueError):
+                self._dup_state = set()
+        return self._dup_state
+
+    def _save_dup_state(self, fingerprint):
+        state = self._load_dup_state()
+        state.add(fingerprint)
+        os.makedirs(os.path.dirname(os.path.abspath(self._dup_state_path)), exist_ok=True)
+        tmp_path = f"{self._dup_state_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(sorted(state), f)
+        os.replace(tmp_path, self._dup_state_path)
+
+    def _check_duplicate_keys(self, table_name, key_fields, db):
+        """表主键与 key_fields 不一致时确认表中没有重复的 key_fields 分组。
+
+        同一实例内每个 (db, table, keys) 只检查一次；通过后按表结构指纹记入 dup_check_state，
+        表结构不变时之后的进程直接跳过全表扫描。
+        """
+        dup_key = (db, table_name, tuple(key_fields))
+        if dup_key in self._dup_checked:
+            return
+        fingerprint = self._dup_fingerprint(table_name, key_fields, db)
+        if fingerprint not in self._load_dup_state():
+            if self._has_duplicate_keys(table_name, key_fields, db=db):
+                raise RuntimeError(f"目标表 {db}.{table_name} 中存在重复主键分组，请先清理数据库再导入。")
+            try:
+                self._save_dup_state(fingerprint)
+            except OSError as e:
+                logger.warning("无法写入 %s: %s", self._dup_state_path, e)
+        self._dup_checked.add(dup_key)
 
     def _get_table_columns(self, table_name, db: Optional[str] = None):
         """Return a set of column names that exist in the given table."""
-        if db is None:
-            db = self.config['database']
-        sql = text("SELECT COLUMN_NAME FROM information_schema.columns WHERE TABLE_SCHEMA = :db AND TABLE_NAME = :tbl")
-        with self.engine.connect() as conn:
-            res = conn.execute(sql, {'db': db, 'tbl': table_name}).fetchall()
-            cols = set()
-            for row in res:
-                if hasattr(row, '_mapping'):
-                    name = row._mapping.get('COLUMN_NAME')
-                else:
-                    name = row[0]
-                if name:
-                    cols.add(name)
-            return cols
+        return set(self._table_meta(table_name, db)['columns'])
         
-    def df_to_mysql(self, df, table_name, schema, pk_fields: Optional[List[str]] = None, database: Optional[str] = None):
+    def df_to_mysql(self, df, table_name, schema, pk_fields: Optional[List[str]] = None, database: Optional[str] = None,
+                    bulk: Optional[bool] = None, diff: Optional[bool] = None, raise_on_error: bool = False,
+                    partition: Optional[dict] = None):
         """Insert or upsert a DataFrame into a MySQL table.
 
         database: optional. If equals a key in the loaded config (e.g. 'database2'), the mapped value
                   from config is used; otherwise the provided string is treated as a literal database name.
+        bulk: True loads through LOAD DATA LOCAL INFILE into a staging table, False uses chunked
+              executemany; None (default) picks bulk when the frame has at least bulk_threshold rows.
+        diff: compare per-key hashes with the rows already in the affected partitions
+              (valuation_date / portfolio_name / score_name) and only write new or changed rows.
+              update_time is not compared. None (default) uses diff_upsert from db.yaml.
+        raise_on_error: raise instead of only logging when a chunk or the bulk load fails, for callers
+              that must know whether every row was written.
+        partition: {'column': 'valuation_date', 'interval': 'month', 'ahead': 3} to RANGE-partition the
+              table on a date column; None (default) uses partitions[table_name] from db.yaml, False disables.
+              New tables are created partitioned, and missing upcoming partitions of an already
+              partitioned table are added before the insert.
         """
         # resolve target_db
         if database is not None and database in self.config:
@@ -130,40 +514,52 @@ class MySQLImporter:
         df_clean = self._preprocess_data(df, schema)
         key_fields = pk_fields if pk_fields else []
 
+        partition = self._partition_spec(table_name, partition)
+        part_range = (None, None)
+        if partition and partition['column'] in df_clean.columns and not df_clean.empty:
+            part_values = pd.to_datetime(df_clean[partition['column']], errors='coerce')
+            part_range = (part_values.min(), part_values.max())
+            part_range = tuple(None if pd.isna(v) else v for v in part_range)
+
         # create table if not exists in target_db
         if not self._table_exists(table_name, db=target_db):
-            self.create_table(table_name, schema, pk_fields, db=target_db)
+            self.create_table(table_name, schema, pk_fields, db=target_db, partition=partition,
+                              start=part_range[0], end=part_range[1])
             table_created = True
         else:
+            if partition:
+                self._ensure_partitions(table_name, target_db, partition, part_range[1])
             table_created = False
             pk_cols = self._get_table_pk_columns(table_name, db=target_db)
+            # 表主键与 key_fields 不一致时检查重复；同一表结构只检查一次（跨进程持久化）
             if key_fields and (not pk_cols or set(pk_cols) != set(key_fields)):
-                dup_count = self._count_duplicate_pk_groups(table_name, key_fields, db=target_db)
-                if dup_count > 0:
-                    raise RuntimeError(f"目标表 {target_db}.{table_name} 中存在重复主键分组 ({dup_count})，请先清理数据库再导入。")
+                self._check_duplicate_keys(table_name, key_fields, target_db)
 
         # Deduplicate incoming DataFrame by key_fields, keep latest by update_time
         if key_fields and all(k in df_clean.columns for k in key_fields):
             if 'update_time' in df_clean.columns:
                 try:
                     df_clean['update_time'] = pd.to_datetime(df_clean['update_time'])
-                    df_clean = df_clean.sort_values('update_time').drop_duplicates(subset=key_fields, keep='last')
+                    df_clean = df_clean.sort_values('update_time', kind='stable').drop_duplicates(subset=key_fields, keep='last')
                 except Exception:
                     df_clean = df_clean.drop_duplicates(subset=key_fields, keep='last')
             else:
                 df_clean = df_clean.drop_duplicates(subset=key_fields, keep='last')
 
-        records = df_clean.to_dict(orient='records')
-        if not records:
+        # 按主键排序后再分块，各块落在不相交的主键区间，并行写入时减少锁冲突
+        if key_fields and all(k in df_clean.columns for k in key_fields):
+            df_clean = df_clean.sort_values(key_fields)
+
+        if df_clean.empty:
             logger.info("没有要插入的数据")
-            return
+            return 0
 
         # Ensure columns exist; if we just created the table assume schema present
         schema_cols = {col['field']: col['type'] for col in schema}
         if table_created:
             existing_cols = set(schema_cols.keys())
         else:
-            existing_cols = self._get_table_columns(table_name, db=target_db) if self._table_exists(table_name, db=target_db) else set()
+            existing_cols = self._get_table_columns(table_name, db=target_db)
 
         missing = [f for f in schema_cols.keys() if f not in existing_cols]
         if missing:
@@ -175,6 +571,7 @@ class MySQLImporter:
                         conn.execute(text(alter_sql))
                     except Exception as e:
                         raise RuntimeError(f"无法为表 {table_name} 添加列 {m}: {e}")
+            self.invalidate_schema(table_name, target_db)
             existing_cols = self._get_table_columns(table_name, db=target_db)
 
         cols = list(df_clean.columns)
@@ -189,46 +586,225 @@ class MySQLImporter:
 
         insert_sql = f"INSERT INTO `{target_db}`.`{table_name}` ({col_list_sql}) VALUES ({driver_placeholders}) ON DUPLICATE KEY UPDATE {update_clause}"
 
-        def _sanitize_value(v):
+        # diff 模式：只写入新主键和内容确有变化的行
+        diff = self.config.get('diff_upsert', False) if diff is None else diff
+        diff_keys = key_fields or (self._get_table_pk_columns(table_name, db=target_db) if not table_created else [])
+        if diff and not table_created and diff_keys and all(k in cols for k in diff_keys):
+            compare_cols = [c for c in non_key_cols if c not in DIFF_IGNORE_COLUMNS and c not in diff_keys]
+            df_clean = self._changed_rows(df_clean, diff_keys, compare_cols, schema_cols, target_db, table_name)
+            if df_clean.empty:
+                logger.info("%s.%s 没有新增或变化的行，跳过写入", target_db, table_name)
+                return 0
+
+        use_bulk = bulk if bulk is not None else len(df_clean) >= self.bulk_threshold
+        if use_bulk:
             try:
-                if pd.isna(v):
-                    return None
-            except Exception:
-                pass
-            if hasattr(v, 'to_pydatetime'):
+                return self._bulk_upsert(df_clean, cols, schema_cols, update_clause, target_db, table_name)
+            except Exception as e:
+                code = e.args[0] if isinstance(e, pymysql.err.MySQLError) and e.args else None
+                if code not in LOCAL_INFILE_ERRORS:
+                    # 写临时文件的 OSError、编码错误、pandas 错误与数据库错误同样处理
+                    logger.exception("批量导入 失败: %s", e)
+                    if raise_on_error:
+                        raise
+                    return 0
+                # 服务端或驱动未开启 local_infile 时退回逐行 upsert
+                logger.warning("LOAD DATA LOCAL INFILE 不可用 (%s)，改用分块 upsert", e)
+
+        param_tuples = build_param_rows(df_clean, cols, schema_cols)
+
+        return self._upsert_chunks(insert_sql, param_tuples, f"{target_db}.{table_name}", raise_on_error)
+
+    def _changed_rows(self, df_clean, key_fields, compare_cols, schema_cols, target_db, table_name):
+        """从目标表取出受影响分区内每个主键的内容哈希，返回新主键或哈希不同的行。
+
+        key_fields 必须覆盖表的主键/唯一键，否则表中同一 key 可能有多行，按 key 合并会放大行数。
+        """
+        if not self._is_unique_key(table_name, key_fields, target_db):
+            raise ValueError(f"diff 模式的键 {list(key_fields)} 不是 {target_db}.{table_name} 的主键/唯一键，"
+                             f"请先添加唯一键（ensure_unique_key）或关闭 diff_upsert")
+        partition_fields = [f for f in DIFF_PARTITION_COLUMNS if f in key_fields] or list(key_fields)
+        key_sql = [_diff_sql_expr(k, schema_cols.get(k, '')) for k in key_fields]
+        if compare_cols:
+            hash_sql = "LEFT(MD5(CONCAT_WS(CHAR(31), {})), 16)".format(
+                ', '.join(_diff_sql_expr(c, schema_cols.get(c, '')) for c in compare_cols))
+        else:
+            hash_sql = "''"
+
+        key_str = pd.DataFrame({k: _diff_strings(df_clean[k], schema_cols.get(k, '')) for k in key_fields},
+                               index=df_clean.index)
+        if compare_cols:
+            joined = pd.DataFrame({c: _diff_strings(df_clean[c], schema_cols.get(c, '')) for c in compare_cols})
+            joined = joined.agg('\x1f'.join, axis=1)
+            new_hash = pd.Series([hashlib.md5(v.encode('utf-8')).hexdigest()[:16] for v in joined],
+                                 index=df_clean.index)
+        else:
+            new_hash = pd.Series('', index=df_clean.index)
+
+        partitions = df_clean[partition_fields].drop_duplicates()
+        part_params = build_param_rows(partitions, partition_fields, schema_cols)
+        part_cols = ', '.join(f"`{f}`" for f in partition_fields)
+        row_sql = '(' + ', '.join(['%s'] * len(partition_fields)) + ')'
+
+        def fetch_existing():
+            rows = []
+            raw_conn = self.engine.raw_connection()
+            try:
+                cur = raw_conn.cursor()
+                for i in range(0, len(part_params), DIFF_PARTITION_BATCH):
+                    batch = part_params[i:i + DIFF_PARTITION_BATCH]
+                    sql = (f"SELECT {', '.join(key_sql)}, {hash_sql} FROM `{target_db}`.`{table_name}` "
+                           f"WHERE ({part_cols}) IN ({', '.join([row_sql] * len(batch))})")
+                    cur.execute(sql, [v for row in batch for v in row])
+                    rows.extend(cur.fetchall())
+                cur.close()
+            finally:
+                raw_conn.close()
+            return rows
+
+        existing = retry(fetch_existing, retries=self.retries, engine=self.engine)
+
+        old = pd.DataFrame(existing, columns=list(key_fields) + ['_old_hash'])
+        current = key_str.assign(_new_hash=new_hash.values, _pos=np.arange(len(df_clean)))
+        merged = current.merge(old, on=list(key_fields), how='left')
+        changed = merged['_old_hash'].isna() | (merged['_old_hash'] != merged['_new_hash'])
+        positions = np.sort(merged.loc[changed, '_pos'].to_numpy())
+        logger.info("diff %s.%s: %d 行中 %d 行新增或变化，已有 %d 行", target_db, table_name,
+                    len(df_clean), len(positions), len(old))
+        return df_clean.iloc[positions]
+
+    def _bulk_upsert(self, df_clean, cols, schema_cols, update_clause, target_db, table_name):
+        """把数据写成 TSV，LOAD DATA LOCAL INFILE 到会话临时表，再用一条 INSERT ... SELECT 合并到目标表。"""
+        stage = f"_stage_{table_name}"
+        stage_cols = ', '.join([f"`{c}` {schema_cols.get(c, 'TEXT')}" for c in cols])
+        col_list_sql = ', '.join([f"`{c}`" for c in cols])
+
+        t0 = time.perf_counter()
+        path = None
+        try:
+            tsv = df_clean[cols].copy()
+            for c in cols:
+                if _is_date_type(schema_cols.get(c, '')) and pd.api.types.is_datetime64_any_dtype(tsv[c]):
+                    tsv[c] = tsv[c].dt.strftime('%Y-%m-%d')
+                elif (pd.api.types.is_object_dtype(tsv[c]) or pd.api.types.is_string_dtype(tsv[c])
+                      or isinstance(tsv[c].dtype, pd.CategoricalDtype)):
+                    # 字段和行分隔符为 \t 和 \n，反斜杠转义；转义后字段中不再有分隔符、换行或 NUL
+                    tsv[c] = _load_data_escape(tsv[c])
+
+            fd, path = tempfile.mkstemp(suffix='.tsv', prefix=f'{table_name}_')
+            os.close(fd)
+            # 转义已在上面完成：不加引号（LOAD DATA 没有 ENCLOSED BY），引号字符设为已被转义掉的 NUL，
+            # 这样 csv 模块既不会给含 " 的字段加引号，也不会再次转义反斜杠
+            tsv.to_csv(path, sep='\t', header=False, index=False, na_rep='\\N', lineterminator='\n',
+                       date_format='%Y-%m-%d %H:%M:%S', encoding='utf-8',
+                       quoting=csv.QUOTE_NONE, quotechar='\0')
+            del tsv
+            load_path = path.replace('\\', '/')
+
+            def once():
+                raw_conn = self.engine.raw_connection()
                 try:
-                    return v.to_pydatetime()
+                    cur = raw_conn.cursor()
+                    cur.execute(f"DROP TEMPORARY TABLE IF EXISTS `{stage}`")
+                    cur.execute(f"CREATE TEMPORARY TABLE `{stage}` ({stage_cols}) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4")
+                    cur.execute(f"LOAD DATA LOCAL INFILE '{load_path}' INTO TABLE `{stage}` CHARACTER SET utf8mb4 "
+                                f"FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' "
+                                f"({col_list_sql})")
+                    cur.execute(f"INSERT INTO `{target_db}`.`{table_name}` ({col_list_sql}) "
+                                f"SELECT {col_list_sql} FROM `{stage}` ON DUPLICATE KEY UPDATE {update_clause}")
+                    raw_conn.commit()
+                    cur.execute(f"DROP TEMPORARY TABLE IF EXISTS `{stage}`")
+                    cur.close()
                 except Exception:
+                    try:
+                        raw_conn.rollback()
+                    except Exception:
+                        pass
+                    raise
+                finally:
+                    try:
+                        raw_conn.close()
+                    except Exception:
+                        pass
+
+            # 临时表属于会话，重试时在新连接上重新建表和加载；合并是幂等的 upsert
+            retry(once, retries=self.retries, engine=self.engine)
+        finally:
+            # 任何一步失败（含写文件、转义）都删除临时文件
+            if path is not None:
+                try:
+                    os.remove(path)
+                except OSError:
                     pass
-            return v
 
-        param_tuples = [tuple(_sanitize_value(rec[c]) for c in cols) for rec in records]
+        seconds = time.perf_counter() - t0
+        logger.info("批量导入 %d 行到 %s.%s，用时 %.1f 秒 (%.0f 行/秒)", len(df_clean), target_db, table_name,
+                    seconds, len(df_clean) / max(seconds, 1e-9))
+        return len(df_clean)
 
-        try:
+    def _execute_chunk(self, sql, rows):
+        """在连接池的一个连接上写入一块并提交；可重试错误按指数退避重试（upsert 是幂等的）。"""
+        def once():
             raw_conn = self.engine.raw_connection()
+            cur = None
             try:
                 cur = raw_conn.cursor()
-                cur.executemany(insert_sql, param_tuples)
+                cur.executemany(sql, rows)
                 raw_conn.commit()
-                logger.info(f"导入 %d 行到 %s.%s", len(param_tuples), target_db, table_name)
+                return len(rows)
+            except pymysql.err.MySQLError:
+                try:
+                    raw_conn.rollback()
+                except Exception:
+                    pass
+                raise
             finally:
                 try:
-                    cur.close()
+                    if cur is not None:
+                        cur.close()
                 except Exception:
                     pass
                 try:
                     raw_conn.close()
                 except Exception:
                     pass
-        except Exception as e:
-            # Log full exception with stacktrace so it's visible in logs
-            logger.exception("导入 失败: %s", e)
+
+        return retry(once, retries=self.retries, engine=self.engine)
+
+    def _upsert_chunks(self, sql, param_tuples, target, raise_on_error=False):
+        """按 chunk_size 分块，用 workers 个连接并行写入，每块单独提交；返回成功写入的行数。"""
+        chunks = [param_tuples[i:i + self.chunk_size] for i in range(0, len(param_tuples), self.chunk_size)]
+        done_rows = 0
+        failed = 0
+        first_error = None
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(chunks))) as pool:
+            futures = [pool.submit(self._execute_chunk, sql, chunk) for chunk in chunks]
+            for i, fut in enumerate(as_completed(futures), 1):
+                try:
+                    done_rows += fut.result()
+                except Exception as e:
+                    # Log full exception with stacktrace so it's visible in logs
+                    failed += 1
+                    first_error = first_error or e
+                    logger.exception("导入 失败: %s", e)
+                logger.info("导入进度 %s: %d/%d 块, %d/%d 行", target, i, len(chunks), done_rows, len(param_tuples))
+        if failed:
+            logger.error("导入 %s 有 %d/%d 块失败，已写入 %d/%d 行", target, failed, len(chunks),
+                         done_rows, len(param_tuples))
+            if raise_on_error:
+                raise RuntimeError(f"导入 {target} 有 {failed}/{len(chunks)} 块失败") from first_error
+        else:
+            logger.info("导入 %d 行到 %s", done_rows, target)
+        return done_rows
     
     def _preprocess_data(self, df: pd.DataFrame, schema: List[Dict]) -> pd.DataFrame:
         """
         数据预处理：确保数据类型匹配
+
+        日期列保持 datetime64，转换成 Python 对象推迟到 build_param_rows 里按列整体完成。
         """
-        df_clean = df.copy()
+        # 浅拷贝即可：下面只整列替换，不会改动调用方的 DataFrame
+        df_clean = df.copy(deep=False)
         
         # 获取字段类型映射
         type_mapping = {col['field']: col['type'] for col in schema}
@@ -239,20 +815,10 @@ class MySQLImporter:
                 
          
                 if 'DATETIME' in mysql_type or 'TIMESTAMP' in mysql_type:
-                 
                     df_clean[column] = pd.to_datetime(df_clean[column])
-                    # convert to python datetime objects which to_sql will insert as proper DATETIME
-                    try:
-                        df_clean[column] = [
-                            (x.to_pydatetime() if hasattr(x, 'to_pydatetime') and not pd.isna(x) else None)
-                            for x in df_clean[column]
-                        ]
-                    except Exception:
-              
-                        pass
-                elif mysql_type == 'DATE' or (mysql_type.startswith('DATE') and 'DATETIME' not in mysql_type):
-                    # convert to date only (no time part)
-                    df_clean[column] = pd.to_datetime(df_clean[column]).dt.date
+                elif _is_date_type(mysql_type):
+                    # date only (no time part)
+                    df_clean[column] = pd.to_datetime(df_clean[column]).dt.normalize()
                 elif 'DECIMAL' in mysql_type or 'FLOAT' in mysql_type or 'DOUBLE' in mysql_type:
                     df_clean[column] = pd.to_numeric(df_clean[column], errors='coerce')
                 elif 'INT' in mysql_type:
@@ -262,8 +828,8 @@ class MySQLImporter:
     
     
     def close(self):
-        """关闭连接"""
-        self.engine.dispose()
+        """释放共享连接池；最后一个使用者释放时关闭连接"""
+        release_engine(self.engine)
 
 
 
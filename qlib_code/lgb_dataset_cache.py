@@ -0,0 +1,305 @@
+"""Cache of constructed LightGBM train/valid Datasets in LightGBM's binary format.
+
+Building lgb.Dataset from the Alpha158 frame re-samples and re-bins every
+feature. This is the same work for every Optuna trial and every retrain on the
+same data. An entry holds train.bin and valid.bin (saved with
+Dataset.save_binary), keyed by:
+
+    * the handler: its class and config kwargs (CachedLGBModel's handler_config), or
+      its constructor arguments, feature columns and processor configs; never
+      fitted state or object reprs, so the key is the same in every process
+    * the train/valid segments
+    * the bin data version up to LABEL_HORIZON trading days past the end of the last
+      segment (data_version.bin_data_version / label_data_end): the label of the last
+      rows is NaN, and dropped, until those days are in the store
+    * the binning parameters (BINNING_PARAMS)
+
+Datasets are built with feature_pre_filter=False. Because of that, changing
+min_data_in_leaf, num_leaves, learning rate or any other training parameter
+reuses the entry, and only a different binning parameter builds a new one.
+dump_update can rewrite bins of dates that are already in the calendar, so
+run_daily_update.py calls invalidate_from the same way it does for the
+prediction cache.
+
+Retrains use CachedLGBModel, a drop-in LGBModel subclass for workflow yaml:
+
+    model:
+        class: CachedLGBModel
+        module_path: lgb_dataset_cache
+        kwargs:
+            cache_dir: "E:\\qlib_cache\\lgb_datasets"
+            handler_config: *data_handler_config
+            loss: mse
+            ...
+"""
+import argparse
+import hashlib
+import inspect
+import json
+import logging
+import os
+import shutil
+import time
+
+import lightgbm as lgb
+import numpy as np
+import yaml
+from qlib.contrib.model.gbdt import LGBModel
+from qlib.data.dataset.handler import DataHandlerLP
+
+from data_version import bin_data_version, label_data_end
+
+logger = logging.getLogger(__name__)
+
+PATHS_YAML = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'config', 'paths.yaml'))
+# Parameters fixed when a Dataset is constructed; any other parameter can change between fits
+BINNING_PARAMS = (
+    "max_bin", "max_bin_by_feature", "min_data_in_bin", "bin_construct_sample_cnt", "data_random_seed",
+    "feature_pre_filter", "use_missing", "zero_as_missing", "categorical_feature", "forcedbins_filename",
+    "linear_tree",
+)
+DEFAULT_DATASET_PARAMS = {"feature_pre_filter": False, "verbosity": -1}
+DEFAULT_MAX_ENTRIES = 4
+# Alpha158 的标签 Ref($close, -2) / Ref($close, -1) - 1 读取样本之后 2 个交易日的数据
+LABEL_HORIZON = 2
+
+
+def dataset_params(params=None):
+    """Construction parameters of a Dataset: the binning subset of params, with feature_pre_filter off."""
+    ds = dict(DEFAULT_DATASET_PARAMS)
+    ds.update({k: v for k, v in (params or {}).items() if k in BINNING_PARAMS})
+    return ds
+
+
+def cache_key(handler, segments, data_version, params=None):
+    blob = json.dumps({"handler": handler, "segments": segments, "data_version": data_version,
+                       "dataset_params": dataset_params(params)}, sort_keys=True, default=str)
+    return hashlib.sha256(blob.encode()).hexdigest()[:32]
+
+
+def segments_end(segments):
+    """Latest end date over the segments."""
+    return max(str(seg[1])[:10] for seg in segments.values())
+
+
+def data_end(provider_uri, segments, horizon=LABEL_HORIZON):
+    """Last date of bin data the segments' features and labels read; the key's bin_data_version and
+    the entry's `end` (for invalidate_from) both use it."""
+    return label_data_end(provider_uri, segments_end(segments), horizon)
+
+
+def _plain(value):
+    """JSON-stable form of a config value; None for anything without a stable representation."""
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_plain(v) for v in value]
+    if isinstance(value, dict):
+        return {str(k): _plain(v) for k, v in value.items()}
+    if hasattr(value, "isoformat"):  # datetime / pd.Timestamp
+        return str(value)
+    if callable(value):
+        # Module and qualified name are the same in every process, unlike str(function)
+        return f"{getattr(value, '__module__', '')}.{getattr(value, '__qualname__', type(value).__name__)}"
+    return None
+
+
+def processor_config(p):
+    """[class, constructor kwargs] of a processor: only attributes named like __init__ parameters, so
+    fitted statistics and other state never reach the key. Processor.__call__ turns a str fields_group
+    into a list, so it is normalized to a list here."""
+    params = [name for name, prm in inspect.signature(type(p).__init__).parameters.items()
+              if name != "self" and prm.kind not in (prm.VAR_POSITIONAL, prm.VAR_KEYWORD)]
+    kwargs = {name: _plain(getattr(p, name)) for name in params if hasattr(p, name)}
+    # Choices that are only kept as a callable (CSZScoreNorm's method -> zscore_func)
+    kwargs.update({name: _plain(v) for name, v in vars(p).items() if callable(v) and not isinstance(v, type)})
+    if isinstance(kwargs.get("fields_group"), str):
+        kwargs["fields_group"] = [kwargs["fields_group"]]
+    return [f"{type(p).__module__}.{type(p).__name__}", kwargs]
+
+
+def handler_fingerprint(handler, handler_config=None):
+    """Cache identity of a DataHandlerLP: its class and config kwargs, or, when no config is given,
+    its constructor arguments (instruments, time range) plus feature columns and processor configs."""
+    cls = f"{type(handler).__module__}.{type(handler).__name__}"
+    if handler_config is not None:
+        return {"class": cls, "kwargs": _plain(handler_config)}
+    return {
+        "class": cls,
+        "instruments": _plain(handler.instruments),
+        "start_time": _plain(handler.start_time),
+        "end_time": _plain(handler.end_time),
+        "columns": [str(c) for c in handler.get_cols()],
+        "processors": [processor_config(p) for p in list(handler.infer_processors) + list(handler.learn_processors)],
+    }
+
+
+def prepare_arrays(dataset):
+    """train/valid features and labels exactly as LGBModel._prepare_data takes them, as float32 arrays."""
+    df_train, df_valid = dataset.prepare(
+        ["train", "valid"], col_set=["feature", "label"], data_key=DataHandlerLP.DK_L
+    )
+    arrays = []
+    for name, df in (("train", df_train), ("valid", df_valid)):
+        if df.empty:
+            raise ValueError(f"Empty data from dataset segment {name}, please check your dataset config.")
+        arrays.append(np.ascontiguousarray(df["feature"].to_numpy(np.float32)))
+        arrays.append(df["label"].to_numpy(np.float32).ravel())
+    return tuple(arrays)
+
+
+class LGBDatasetCache:
+    def __init__(self, cache_dir, max_entries=DEFAULT_MAX_ENTRIES):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        # 标签向后读取的交易日数，非 Alpha158 标签时在 yaml 中设置
+        self.label_horizon = label_horizon
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, cfg):
+        """Cache from paths.yaml's lgb_dataset_cache_dir, or None when it is not configured."""
+        if not cfg.get("lgb_dataset_cache_dir"):
+            return None
+        return cls(cfg["lgb_dataset_cache_dir"], int(cfg.get("lgb_dataset_cache_max_entries") or DEFAULT_MAX_ENTRIES))
+
+    def _dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _entries(self):
+        return [e for e in os.scandir(self.cache_dir) if e.is_dir() and os.path.exists(os.path.join(e.path, "meta.json"))]
+
+    def entry_bytes(self, key):
+        """Size of an entry's files on disk, about the memory one process needs to load it."""
+        d = self._dir(key)
+        return sum(os.path.getsize(os.path.join(d, n)) for n in os.listdir(d))
+
+    def load(self, key, params=None):
+        """(dtrain, dvalid) read lazily from the binary files, or None on a miss."""
+        d = self._dir(key)
+        if not os.path.exists(os.path.join(d, "meta.json")):
+            return None
+        os.utime(d)
+        ds = dataset_params(params)
+        dtrain = lgb.Dataset(os.path.join(d, "train.bin"), params=ds)
+        dvalid = lgb.Dataset(os.path.join(d, "valid.bin"), reference=dtrain, params=ds)
+        logger.info("LightGBM Dataset 缓存命中 %s", key)
+        return dtrain, dvalid
+
+    def save(self, key, arrays, params=None, end=None):
+        """Construct train/valid from (x_train, y_train, x_valid, y_valid), save them as binary and return them."""
+        x_train, y_train, x_valid, y_valid = arrays
+        ds = dataset_params(params)
+        t0 = time.perf_counter()
+        dtrain = lgb.Dataset(x_train, label=y_train, params=ds, free_raw_data=True).construct()
+        dvalid = lgb.Dataset(x_valid, label=y_valid, reference=dtrain, params=ds, free_raw_data=True).construct()
+        logger.info("构建 LightGBM Dataset 用时 %.1f 秒", time.perf_counter() - t0)
+
+        d = self._dir(key)
+        tmp = f"{d}.tmp{os.getpid()}"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        dtrain.save_binary(os.path.join(tmp, "train.bin"))
+        dvalid.save_binary(os.path.join(tmp, "valid.bin"))
+        with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"end": end, "rows": [int(dtrain.num_data()), int(dvalid.num_data())],
+                       "features": int(dtrain.num_feature()), "params": ds}, f, default=str)
+        try:
+            os.replace(tmp, d)
+        except OSError:
+            # Another process saved the same key first
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+        return dtrain, dvalid
+
+    def get_or_build(self, key, build, params=None, end=None):
+        """Cached (dtrain, dvalid) for key; on a miss call build() for the arrays and save the result."""
+        hit = self.load(key, params)
+        if hit is not None:
+            return hit
+        return self.save(key, build(), params, end)
+
+    def invalidate_from(self, date):
+        """Drop every entry whose data reaches date or later; returns the number removed."""
+        date = str(date)[:10]
+        removed = 0
+        for entry in self._entries():
+            with open(os.path.join(entry.path, "meta.json"), encoding="utf-8") as f:
+                end = json.load(f).get("end")
+            if end is None or str(end)[:10] >= date:
+                shutil.rmtree(entry.path, ignore_errors=True)
+                removed += 1
+        return removed
+
+    def evict(self):
+        """Keep the max_entries most recently used entries."""
+        entries = sorted(self._entries(), key=lambda e: e.stat().st_mtime, reverse=True)
+        for entry in entries[self.max_entries:]:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+    def clear(self):
+        for entry in self._entries():
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+
+class CachedLGBModel(LGBModel):
+    """LGBModel whose train/valid lgb.Dataset come from LGBDatasetCache.
+
+    A cache hit skips dataset.prepare and Dataset construction. Fits with a reweighter
+    or without a valid segment go through LGBModel unchanged.
+    """
+
+    def __init__(self, cache_dir=None, provider_uri=None, max_entries=DEFAULT_MAX_ENTRIES, handler_config=None,
+                 label_horizon=LABEL_HORIZON, **kwargs):
+        super().__init__(**kwargs)
+        # handler 的 kwargs（workflow yaml 中的 data_handler_config），给出时缓存键直接由配置生成
+        self.handler_config = handler_config
+        self.cache_dir = cache_dir
+        self.provider_uri = provider_uri
+        self.max_entries = max_entries
+
+    def _data_uri(self):
+        if self.provider_uri:
+            return self.provider_uri
+        from qlib.config import C
+        return str(C.dpm.get_data_uri(C.DEFAULT_FREQ))
+
+    def _prepare_data(self, dataset, reweighter=None):
+        if reweighter is not None or not self.cache_dir or "valid" not in dataset.segments:
+            return super()._prepare_data(dataset, reweighter)
+        segments = {name: list(dataset.segments[name]) for name in ("train", "valid")}
+        uri = self._data_uri()
+        end = data_end(uri, segments, self.label_horizon)
+        key = cache_key(handler_fingerprint(dataset.handler, self.handler_config), segments, bin_data_version(uri, end),
+                        self.params)
+        cache = LGBDatasetCache(self.cache_dir, self.max_entries)
+        dtrain, dvalid = cache.get_or_build(key, lambda: prepare_arrays(dataset), self.params, end)
+        return [(dtrain, "train"), (dvalid, "valid")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="管理 LightGBM Dataset 二进制缓存")
+    parser.add_argument("--cache-dir", default=None, help="缺省读取 paths.yaml 的 lgb_dataset_cache_dir")
+    parser.add_argument("--clear", action="store_true", help="删除全部缓存")
+    parser.add_argument("--invalidate-from", default=None, help="删除数据覆盖该日期及之后的缓存")
+    args = parser.parse_args()
+
+    with open(PATHS_YAML, 'r', encoding='utf-8') as f:
+        cfg = yaml.safe_load(f) or {}
+    cache_dir = args.cache_dir or cfg.get("lgb_dataset_cache_dir")
+    if not cache_dir:
+        raise SystemExit("未配置 lgb_dataset_cache_dir")
+    cache = LGBDatasetCache(cache_dir)
+    if args.clear:
+        cache.clear()
+    elif args.invalidate_from:
+        print(f"已删除 {cache.invalidate_from(args.invalidate_from)} 条缓存")
+    for entry in cache._entries():
+        with open(os.path.join(entry.path, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        size = cache.entry_bytes(entry.name)
+        print(f"{entry.name}  end={meta.get('end')}  rows={meta.get('rows')}  {size / 2 ** 30:.2f} GB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""Compact dtypes for feature/score frames and per-stage peak memory accounting.
+
+Compact mode is opt-in in the scripts that hold large frames
+(export_test_scores_per_day --compact, ShapRecord(compact=True),
+save_plot.save_all_figures(compact=True)):
+
+    * feature and score columns are stored as float32 instead of float64
+    * code / score_name / instrument columns become categoricals (integer codes)
+    * unused MultiIndex levels are dropped
+
+MemoryTracker samples the process RSS in a background thread while a stage
+runs and reports start, peak and end RSS per stage. It is enabled separately
+from compact mode (--memory-report, memory_report=True), so the memory of a
+float64 run can be measured too. It needs psutil; without it only the
+elapsed time is reported.
+"""
+import contextlib
+import threading
+import time
+import numpy as np
+import pandas as pd
+
+CATEGORICAL_COLUMNS = ("code", "instrument", "score_name")
+
+
+def _rss():
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss
+
+
+def compact_features(df):
+    """Cast float64 feature columns to float32 and drop unused index levels; the caller's frame is not modified."""
+    float_cols = [c for c, dt in df.dtypes.items() if dt == np.float64]
+    if float_cols:
+        df = df.astype({c: np.float32 for c in float_cols}, copy=False)
+    else:
+        df = df.copy(deep=False)
+    if isinstance(df.index, pd.MultiIndex):
+        df.index = df.index.remove_unused_levels()
+    return df
+
+
+def compact_scores(df):
+    """float32 final_score and categorical code/instrument/score_name columns."""
+    df = df.copy(deep=False)
+    if "final_score" in df.columns:
+        df["final_score"] = df["final_score"].astype(np.float32)
+    for col in CATEGORICAL_COLUMNS:
+        if col in df.columns and df[col].dtype == object:
+            df[col] = df[col].astype("category")
+    return df
+
+
+def frame_nbytes(df):
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+def _fmt_mb(n):
+    return "n/a" if n is None else f"{n / 1024 ** 2:,.0f} MB"
+
+
+class MemoryTracker:
+    def __init__(self, enabled=True, interval=0.05):
+        self.enabled = enabled
+        self.interval = interval
+        self.stages = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = _rss()
+        peak = [start]
+        done = threading.Event()
+
+        def sample():
+            while not done.wait(self.interval):
+                rss = _rss()
+                if rss is not None and (peak[0] is None or rss > peak[0]):
+                    peak[0] = rss
+
+        sampler = threading.Thread(target=sample, daemon=True) if start is not None else None
+        if sampler:
+            sampler.start()
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - t0
+            done.set()
+            if sampler:
+                sampler.join()
+            end = _rss()
+            if end is not None and peak[0] is not None:
+                peak[0] = max(peak[0], end)
+            self.stages.append({"stage": name, "seconds": elapsed, "start": start, "peak": peak[0], "end": end})
+
+    def report_lines(self):
+        lines = [f"{'stage':<20} {'seconds':>9} {'start':>12} {'peak':>12} {'end':>12}"]
+        for s in self.stages:
+            lines.append(f"{s['stage']:<20} {s['seconds']:>9.2f} {_fmt_mb(s['start']):>12} "
+                         f"{_fmt_mb(s['peak']):>12} {_fmt_mb(s['end']):>12}")
+        return lines
+
+    def report(self, printer=print, title="Memory by stage"):
+        if not self.enabled or not self.stages:
+            return
+        printer(title)
+        for line in self.report_lines():
+            printer(line)
@@ -0,0 +1,411 @@
+"""Vectorized Alpha158 feature engine over dates x instruments panels.
+
+qlib evaluates every Alpha158 expression instrument by instrument, paying
+Python and pandas overhead per operator per stock. This engine reads each raw
+field once, straight from the memory-mapped `<field>.day.bin` files, into a
+(dates, instruments) float64 panel, and evaluates the expressions from
+`Alpha158.get_feature_config()` with NumPy kernels that cover all instruments
+at once. The expression strings are the handler's own, so the feature
+definitions cannot drift from qlib's.
+
+Operator semantics follow qlib's implementations:
+
+    * rolling operators use min_periods=1 and skip NaN like pandas rolling
+    * Slope / Rsquare / Resi regress on the window position like qlib's Cython kernels
+    * IdxMax / IdxMin follow `np.argmax` over the window (first NaN wins)
+    * Corr is NaN where either side's rolling std is close to 0
+    * Greater / Less propagate NaN (np.maximum / np.minimum)
+
+Each instrument's series starts where its bin starts, exactly as qlib loads
+it, and rows are kept only inside the instrument's span in the instruments
+file. Values are computed in float64 and returned as float32, the dtype qlib
+returns. qlib evaluates some arithmetic in float32, so parity is checked
+with a tolerance rather than bit for bit.
+
+Per-feature parity check against qlib's Alpha158 handler (prints max abs /
+relative difference per feature and both build times):
+    python panel_features.py --provider-uri "E:\\qlib_data\\tushare_qlib_data\\qlib_bin" \
+        --start-date 2025-10-01 --end-date 2025-10-22 --limit 300
+"""
+import os
+import argparse
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+RAW_FIELDS = ("open", "high", "low", "close", "vwap", "volume")
+# Extra trading days loaded before the first requested date. Alpha158's longest
+# dependency is a 60-day window over Ref(x, 1), i.e. 61 days of history.
+LOOKBACK_DAYS = 64
+# Upper bound on window elements (rows x instruments x window) held per kernel call
+BLOCK_ELEMENTS = 1 << 24
+
+
+def alpha158_features():
+    """(expressions, names) of Alpha158 in the handler's column order."""
+    from qlib.contrib.data.handler import Alpha158
+
+    fields, names = Alpha158.get_feature_config(None)
+    return list(fields), list(names)
+
+
+def load_calendar(provider_uri, freq="day"):
+    with open(os.path.join(provider_uri, "calendars", f"{freq}.txt")) as f:
+        return pd.DatetimeIndex([line.strip() for line in f if line.strip()])
+
+
+def _read_bin(path, lo, hi):
+    """Values of a qlib bin for calendar indices [lo, hi] and the calendar span of the whole file."""
+    if not os.path.exists(path):
+        return None, None
+    data = np.memmap(path, dtype="<f4", mode="r")
+    if len(data) < 2:
+        return None, None
+    start = int(data[0])
+    end = start + len(data) - 2
+    a, b = max(lo, start), min(hi, end)
+    values = np.array(data[1 + a - start:2 + b - start], dtype=np.float64) if a <= b else None
+    del data
+    return (a, values), (start, end)
+
+
+def load_panels(provider_uri, instruments, lo, hi, fields=RAW_FIELDS, threads=None):
+    """Raw field panels (hi - lo + 1, len(instruments)) and each instrument's bin span in panel rows."""
+    n_rows, n_inst = hi - lo + 1, len(instruments)
+    panels = {field: np.full((n_rows, n_inst), np.nan) for field in fields}
+    first = np.full(n_inst, n_rows, dtype=np.int64)
+    last = np.full(n_inst, -1, dtype=np.int64)
+
+    def load(j):
+        inst_dir = os.path.join(provider_uri, "features", instruments[j].lower())
+        for field in fields:
+            chunk, span = _read_bin(os.path.join(inst_dir, f"{field}.day.bin"), lo, hi)
+            if chunk is not None and chunk[1] is not None:
+                a, values = chunk
+                panels[field][a - lo:a - lo + len(values), j] = values
+            if field == "close" and span is not None:
+                # Series start/end of the instrument; rows outside it do not exist in qlib
+                first[j], last[j] = span[0] - lo, span[1] - lo
+
+    with ThreadPoolExecutor(max_workers=threads or min(32, (os.cpu_count() or 1) * 4)) as pool:
+        list(pool.map(load, range(n_inst)))
+    return panels, first, last
+
+
+class PanelEngine:
+    """Evaluate qlib expression strings on (dates, instruments) panels."""
+
+    def __init__(self, panels, first, last):
+        self.panels = panels
+        self.first = first
+        n_rows = next(iter(panels.values())).shape[0]
+        rows = np.arange(n_rows)[:, None]
+        self.span = (rows >= first[None, :]) & (rows <= last[None, :])
+
+    def evaluate(self, expression):
+        code = re.sub(r"\$(\w+)", r'F("\1")', expression)
+        namespace = {name: getattr(self, name) for name in (
+            "F", "Ref", "Mean", "Std", "Sum", "Max", "Min", "Quantile", "Rank", "Slope", "Rsquare", "Resi",
+            "IdxMax", "IdxMin", "Corr", "Greater", "Less", "Abs", "Log")}
+        with np.errstate(all="ignore"):
+            return self._mask(np.asarray(eval(code, {"__builtins__": {}}, namespace), dtype=np.float64))
+
+    # -- helpers --------------------------------------------------------
+
+    def _mask(self, x):
+        return np.where(self.span, np.asarray(x, dtype=np.float64), np.nan)
+
+    def _rolling(self, reducer, n, *arrays):
+        """Apply reducer(windows..., rows) to NaN-padded (rows, instruments, n) windows, block by block."""
+        arrays = [self._mask(x) for x in arrays]
+        n_rows, n_inst = arrays[0].shape
+        views = [sliding_window_view(np.concatenate([np.full((n - 1, n_inst), np.nan), x]), n, axis=0)
+                 for x in arrays]
+        out = np.empty((n_rows, n_inst))
+        step = max(1, BLOCK_ELEMENTS // max(1, n_inst * n))
+        for s in range(0, n_rows, step):
+            rows = slice(s, min(s + step, n_rows))
+            out[rows] = reducer(*[v[rows] for v in views], rows=rows)
+        return self._mask(out)
+
+    @staticmethod
+    def _moments(w):
+        valid = ~np.isnan(w)
+        cnt = valid.sum(-1)
+        z = np.where(valid, w, 0.0)
+        return valid, cnt, z
+
+    @staticmethod
+    def _std(w):
+        valid, cnt, z = PanelEngine._moments(w)
+        mean = z.sum(-1) / cnt
+        dev = np.where(valid, w - mean[..., None], 0.0)
+        return np.where(cnt > 1, np.sqrt((dev * dev).sum(-1) / (cnt - 1)), np.nan)
+
+    @staticmethod
+    def _regression(w):
+        valid, cnt, z = PanelEngine._moments(w)
+        x = np.where(valid, np.arange(w.shape[-1], dtype=np.float64), 0.0)
+        sx, sxx, sy, sxy = x.sum(-1), (x * x).sum(-1), z.sum(-1), (x * z).sum(-1)
+        return cnt, sx, sxx, sy, sxy, z
+
+    def _idx(self, w, rows, use_max):
+        n = w.shape[-1]
+        t = np.arange(rows.start, rows.stop)[:, None]
+        # qlib's rolling.apply sees only the part of the window after the series start
+        pad = n - np.clip(t - self.first[None, :] + 1, 0, n)
+        inside = np.arange(n)[None, None, :] >= pad[..., None]
+        is_nan = np.isnan(w)
+        nan_inside = is_nan & inside
+        fill = -np.inf if use_max else np.inf
+        filled = np.where(inside & ~is_nan, w, fill)
+        best = filled.argmax(-1) if use_max else filled.argmin(-1)
+        # np.argmax / np.argmin return the first NaN when the window has one
+        idx = np.where(nan_inside.any(-1), nan_inside.argmax(-1), best) - pad + 1
+        return np.where((~is_nan).sum(-1) > 0, idx, np.nan)
+
+    # -- operators ------------------------------------------------------
+
+    def F(self, field):
+        return self.panels[field]
+
+    def Ref(self, x, n):
+        x = self._mask(x)
+        out = np.full_like(x, np.nan)
+        if n == 0:
+            return x
+        out[n:] = x[:-n]
+        return self._mask(out)
+
+    def Mean(self, x, n):
+        def reduce(w, rows):
+            _, cnt, z = self._moments(w)
+            return z.sum(-1) / cnt
+        return self._rolling(reduce, n, x)
+
+    def Sum(self, x, n):
+        def reduce(w, rows):
+            _, cnt, z = self._moments(w)
+            return np.where(cnt > 0, z.sum(-1), np.nan)
+        return self._rolling(reduce, n, x)
+
+    def Std(self, x, n):
+        return self._rolling(lambda w, rows: self._std(w), n, x)
+
+    def Max(self, x, n):
+        def reduce(w, rows):
+            valid, cnt, _ = self._moments(w)
+            return np.where(cnt > 0, np.where(valid, w, -np.inf).max(-1), np.nan)
+        return self._rolling(reduce, n, x)
+
+    def Min(self, x, n):
+        def reduce(w, rows):
+            valid, cnt, _ = self._moments(w)
+            return np.where(cnt > 0, np.where(valid, w, np.inf).min(-1), np.nan)
+        return self._rolling(reduce, n, x)
+
+    def Quantile(self, x, n, q):
+        def reduce(w, rows):
+            cnt = (~np.isnan(w)).sum(-1)
+            ordered = np.sort(w, axis=-1)  # NaN sorts last
+            pos = np.maximum(cnt - 1, 0) * q
+            lo = np.floor(pos).astype(np.int64)
+            hi = np.ceil(pos).astype(np.int64)
+            v_lo = np.take_along_axis(ordered, lo[..., None], -1)[..., 0]
+            v_hi = np.take_along_axis(ordered, hi[..., None], -1)[..., 0]
+            return np.where(cnt > 0, v_lo + (v_hi - v_lo) * (pos - lo), np.nan)
+        return self._rolling(reduce, n, x)
+
+    def Rank(self, x, n):
+        def reduce(w, rows):
+            valid, cnt, _ = self._moments(w)
+            cur = w[..., -1]
+            less = (valid & (w < cur[..., None])).sum(-1)
+            equal = (valid & (w == cur[..., None])).sum(-1)
+            # pandas rolling rank(pct=True), average method
+            return np.where(np.isnan(cur), np.nan, (less + (equal + 1) / 2) / cnt)
+        return self._rolling(reduce, n, x)
+
+    def Slope(self, x, n):
+        def reduce(w, rows):
+            cnt, sx, sxx, sy, sxy, _ = self._regression(w)
+            return (cnt * sxy - sx * sy) / (cnt * sxx - sx * sx)
+        return self._rolling(reduce, n, x)
+
+    def Rsquare(self, x, n):
+        def reduce(w, rows):
+            cnt, sx, sxx, sy, sxy, z = self._regression(w)
+            syy = (z * z).sum(-1)
+            r = (cnt * sxy - sx * sy) / np.sqrt((cnt * sxx - sx * sx) * (cnt * syy - sy * sy))
+            return r * r
+        return self._rolling(reduce, n, x)
+
+    def Resi(self, x, n):
+        def reduce(w, rows):
+            cnt, sx, sxx, sy, sxy, _ = self._regression(w)
+            slope = (cnt * sxy - sx * sy) / (cnt * sxx - sx * sx)
+            intercept = (sy - slope * sx) / cnt
+            return w[..., -1] - (intercept + slope * (w.shape[-1] - 1))
+        return self._rolling(reduce, n, x)
+
+    def IdxMax(self, x, n):
+        return self._rolling(lambda w, rows: self._idx(w, rows, True), n, x)
+
+    def IdxMin(self, x, n):
+        return self._rolling(lambda w, rows: self._idx(w, rows, False), n, x)
+
+    def Corr(self, x, y, n):
+        def reduce(wx, wy, rows):
+            joint = ~np.isnan(wx) & ~np.isnan(wy)
+            cnt = joint.sum(-1)
+            zx, zy = np.where(joint, wx, 0.0), np.where(joint, wy, 0.0)
+            dx = np.where(joint, wx - (zx.sum(-1) / cnt)[..., None], 0.0)
+            dy = np.where(joint, wy - (zy.sum(-1) / cnt)[..., None], 0.0)
+            corr = (dx * dy).sum(-1) / np.sqrt((dx * dx).sum(-1) * (dy * dy).sum(-1))
+            flat = (np.abs(self._std(wx)) <= 2e-05) | (np.abs(self._std(wy)) <= 2e-05)
+            return np.where((cnt > 1) & ~flat, corr, np.nan)
+        return self._rolling(reduce, n, x, y)
+
+    def Greater(self, x, y):
+        return np.maximum(x, y)
+
+    def Less(self, x, y):
+        return np.minimum(x, y)
+
+    def Abs(self, x):
+        return np.abs(x)
+
+    def Log(self, x):
+        return np.log(x)
+
+
+def _instrument_spans(instruments, start_date, end_date):
+    """(sorted codes, {code: [(start, end), ...]} or None) for a D.instruments config or a list."""
+    if isinstance(instruments, dict):
+        from qlib.data import D
+
+        spans = D.list_instruments(instruments, start_time=start_date, end_time=end_date, as_list=False)
+        return sorted(spans), spans
+    return sorted(instruments), None
+
+
+def compute_panel_features(provider_uri, instruments, start_date, end_date, features=None, threads=None):
+    """Alpha158 feature frame (datetime, instrument) x names, float32, like the handler's fetch(col_set="feature").
+
+    features: names to compute (default all 158); the others are returned as NaN
+    in the full column layout, matching pruned_handler.PrunedAlpha158.
+    """
+    fields, names = alpha158_features()
+    keep = set(features) if features else set(names)
+
+    calendar = load_calendar(provider_uri)
+    start_idx = int(calendar.searchsorted(pd.Timestamp(start_date), side="left"))
+    end_idx = int(calendar.searchsorted(pd.Timestamp(end_date), side="right")) - 1
+    codes, spans = _instrument_spans(instruments, start_date, end_date)
+    if end_idx < start_idx or not codes:
+        return pd.DataFrame(columns=names, dtype=np.float32)
+
+    lo = max(0, start_idx - LOOKBACK_DAYS)
+    panels, first, last = load_panels(provider_uri, codes, lo, end_idx, threads=threads)
+    engine = PanelEngine(panels, first, last)
+
+    q = slice(start_idx - lo, end_idx - lo + 1)
+    dates = calendar[start_idx:end_idx + 1]
+    rows_keep = engine.span[q].copy()
+    if spans is not None:
+        in_file = np.zeros_like(rows_keep)
+        for j, code in enumerate(codes):
+            for s, e in spans[code]:
+                in_file[:, j] |= (dates >= pd.Timestamp(s)) & (dates <= pd.Timestamp(e))
+        rows_keep &= in_file
+
+    r, c = np.nonzero(rows_keep)
+    values = np.full((len(r), len(names)), np.nan, dtype=np.float32)
+    for k, (expression, name) in enumerate(zip(fields, names)):
+        if name in keep:
+            values[:, k] = engine.evaluate(expression)[q][r, c]
+    index = pd.MultiIndex.from_arrays([dates[r], np.asarray(codes, dtype=object)[c]],
+                                      names=["datetime", "instrument"])
+    return pd.DataFrame(values, index=index, columns=names)
+
+
+def build_panel_dataset(provider_uri, instruments, start_date, end_date, handler=None, compact=False):
+    """PreparedDataset with a 'test' segment of [start_date, end_date] built by the panel engine.
+
+    handler: None, Alpha158 or a pruned_handler spec (its keep_features are honoured).
+    Features are always float32, so compact needs no extra cast.
+    """
+    from parallel_features import PreparedDataset
+
+    features = None
+    if handler:
+        if handler["class"] not in ("Alpha158", "PrunedAlpha158"):
+            raise ValueError(f"panel engine only implements Alpha158, not {handler['class']}")
+        features = handler.get("kwargs", {}).get("keep_features")
+    frame = compute_panel_features(provider_uri, instruments, start_date, end_date, features)
+    return PreparedDataset(frame, {"test": (start_date, end_date)})
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Per-feature parity check of the panel engine against qlib's Alpha158 handler")
+    p.add_argument("--provider-uri", default=r"E:\\qlib_data\\tushare_qlib_data\\qlib_bin", help="Qlib provider uri")
+    p.add_argument("--start-date", required=True)
+    p.add_argument("--end-date", required=True)
+    p.add_argument("--instruments", default="all")
+    p.add_argument("--limit", type=int, default=None, help="Only check the first N instruments")
+    p.add_argument("--rtol", type=float, default=1e-4)
+    p.add_argument("--atol", type=float, default=1e-5)
+    return p.parse_args()
+
+
+def main():
+    from qlib.data import D
+    from qlib_cache import init_qlib
+    from parallel_features import compute_features
+
+    args = parse_args()
+    init_qlib(args.provider_uri)
+    os.environ["QLIB_DISABLE_MP"] = "1"
+
+    instruments = D.instruments(market=args.instruments)
+    codes = D.list_instruments(instruments, start_time=args.start_date, end_time=args.end_date, as_list=True)
+    codes = sorted(codes)[:args.limit] if args.limit else sorted(codes)
+
+    t0 = time.perf_counter()
+    expected = compute_features(args.provider_uri, codes, args.start_date, args.end_date, workers=1)
+    t1 = time.perf_counter()
+    actual = compute_panel_features(args.provider_uri, codes, args.start_date, args.end_date)
+    t2 = time.perf_counter()
+    print(f"{len(codes)} instruments: qlib handler {t1 - t0:.2f}s, panel engine {t2 - t1:.2f}s")
+
+    if not expected.index.equals(actual.index):
+        missing, extra = expected.index.difference(actual.index), actual.index.difference(expected.index)
+        print(f"index mismatch: {len(missing)} rows missing, {len(extra)} extra; comparing the common rows")
+        common = expected.index.intersection(actual.index)
+        expected, actual = expected.loc[common], actual.loc[common]
+
+    failed = []
+    print(f"{'feature':<10} {'max_abs':>12} {'max_rel':>12} {'nan_mismatch':>13}")
+    for name in actual.columns:
+        a = expected[name].to_numpy(dtype=np.float64)
+        b = actual[name].to_numpy(dtype=np.float64)
+        both = ~np.isnan(a) & ~np.isnan(b)
+        nan_mismatch = int((np.isnan(a) != np.isnan(b)).sum())
+        diff = np.abs(a[both] - b[both])
+        max_abs = float(diff.max()) if diff.size else 0.0
+        max_rel = float((diff / np.maximum(np.abs(a[both]), 1e-12)).max()) if diff.size else 0.0
+        ok = nan_mismatch == 0 and np.allclose(b[both], a[both], rtol=args.rtol, atol=args.atol)
+        if not ok:
+            failed.append(name)
+        print(f"{name:<10} {max_abs:>12.3g} {max_rel:>12.3g} {nan_mismatch:>13}{'' if ok else '  FAIL'}")
+
+    if failed:
+        raise SystemExit(f"{len(failed)} features outside tolerance: {', '.join(failed)}")
+    print("All features match")
+
+
+if __name__ == "__main__":
+    main()
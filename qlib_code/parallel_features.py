@@ -0,0 +1,113 @@
+"""Multi-process Alpha158 feature computation with a deterministic merge.
+
+The instrument universe is sorted and cut into `workers` contiguous slices.
+Each worker process runs its own qlib (single kernel) and builds the handler
+for its slice only; the parent concatenates the slices and sorts the index,
+so the result is identical to a single-process build whatever the number of
+workers. Alpha158 features are per-instrument time series, which is what makes
+splitting by instrument safe.
+
+All pools are created inside functions called from `main()`, so scripts that
+use this module stay safe under the `freeze_support()` entry point on Windows
+(spawned workers re-import the script without running it).
+
+`PreparedDataset` wraps the merged frame in the subset of the `DatasetH`
+interface that `LGBModel.predict` and the scoring scripts use, so both the
+qlib path and the native booster path can consume it.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+DEFAULT_HANDLER = {"class": "Alpha158", "module_path": "qlib.contrib.data.handler"}
+
+
+def partition_instruments(instruments, n_parts):
+    """Split instruments into at most n_parts contiguous, sorted, non-empty slices."""
+    ordered = sorted(instruments)
+    return [list(part) for part in np.array_split(np.asarray(ordered, dtype=object), max(1, n_parts)) if len(part)]
+
+
+def _init_worker(provider_uri):
+    from qlib_cache import init_qlib
+
+    # One kernel per worker: the pool already provides the parallelism
+    init_qlib(provider_uri, maintain=False, kernels=1)
+
+
+def _compute_partition(instruments, start_time, end_time, handler, compact=False):
+    from qlib.data.dataset.handler import DataHandlerLP
+    from memory_utils import compact_features
+    from qlib.utils import init_instance_by_config
+
+    config = dict(handler)
+    config["kwargs"] = {
+        **handler.get("kwargs", {}),
+        "instruments": instruments,
+        "start_time": start_time,
+        "end_time": end_time,
+    }
+    h = init_instance_by_config(config)
+    df = h.fetch(col_set="feature", data_key=DataHandlerLP.DK_I)
+    # Cast in the worker so only float32 data crosses the process boundary
+    return compact_features(df) if compact else df
+
+
+def compute_features(provider_uri, instruments, start_time, end_time, workers=None, handler=None, compact=False):
+    """Feature frame (datetime, instrument) x features for instruments over [start_time, end_time].
+
+    instruments: list of instrument codes.
+    workers: number of processes (default: cpu count); 1 computes in-process.
+    compact: return float32 features (see memory_utils.compact_features).
+    """
+    handler = handler or DEFAULT_HANDLER
+    parts = partition_instruments(instruments, workers or os.cpu_count() or 1)
+    if not parts:
+        return pd.DataFrame()
+
+    if len(parts) == 1:
+        frames = [_compute_partition(parts[0], start_time, end_time, handler, compact)]
+    else:
+        with ProcessPoolExecutor(max_workers=len(parts), initializer=_init_worker,
+                                 initargs=(provider_uri,)) as pool:
+            # map() yields in submission order, so the merge does not depend on finishing order
+            frames = list(pool.map(_compute_partition, parts, [start_time] * len(parts),
+                                   [end_time] * len(parts), [handler] * len(parts), [compact] * len(parts)))
+
+    frames = [f for f in frames if f is not None and len(f)]
+    if not frames:
+        return pd.DataFrame()
+    return pd.concat(frames).sort_index()
+
+
+class PreparedDataset:
+    """Precomputed features exposed through `DatasetH.prepare`.
+
+    segments: {name: (start, end)} like DatasetH; prepare() slices the
+    datetime level and ignores col_set/data_key because only inference
+    features are held.
+    """
+
+    def __init__(self, features, segments):
+        self.features = features
+        self.segments = segments
+
+    def prepare(self, segments, col_set=None, data_key=None, **kwargs):
+        if isinstance(segments, (list, tuple)):
+            return [self.prepare(seg) for seg in segments]
+        start, end = self.segments[segments]
+        return self.features.loc[pd.IndexSlice[pd.Timestamp(start):pd.Timestamp(end), :], :]
+
+
+def build_dataset(provider_uri, instruments, start_date, end_date, workers, lookback_days=0, compact=False,
+                  handler=None):
+    """PreparedDataset with a 'test' segment of [start_date, end_date], computed by `workers` processes."""
+    from qlib.data import D
+
+    handler_start = (pd.Timestamp(start_date) - pd.Timedelta(days=lookback_days)).strftime("%Y-%m-%d")
+    if isinstance(instruments, dict):
+        instruments = D.list_instruments(instruments, start_time=handler_start, end_time=end_date, as_list=True)
+    features = compute_features(provider_uri, instruments, handler_start, end_date, workers, handler=handler,
+                                compact=compact)
+    return PreparedDataset(features, {"test": (start_date, end_date)})
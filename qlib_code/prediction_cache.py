@@ -0,0 +1,138 @@
+"""Content-addressed cache of prediction results.
+
+An entry holds the scored frame (valuation_date, code, final_score, score_name)
+for one run and is keyed by everything that can change the scores:
+
+    * sha256 of every model file (and the score_name it is published under)
+    * the target date range
+    * the bin store version: calendar entries up to the range end plus the
+      instrument list, so appending a newer trading day does not invalidate
+      older dates
+    * the handler/dataset config and predict options
+
+`dump_update` can rewrite bins for dates already in the calendar, which the
+version above cannot see, so `run_daily_update.py` calls `invalidate_from`
+with the earliest date it just dumped. Every entry whose range ends on or
+after that date is dropped, because rolling features of later dates depend
+on it too.
+
+Entries are evicted by age and, least recently used first, by total size.
+"""
+import hashlib
+import json
+import os
+import time
+
+CACHE_SUFFIX = ".pkl"
+
+
+def earliest_csv_date(csv_dir):
+    """Smallest value of the `date` column over the qlib-format CSVs in csv_dir, or None."""
+    import csv
+
+    earliest = None
+    for name in os.listdir(csv_dir):
+        if not name.endswith(".csv"):
+            continue
+        with open(os.path.join(csv_dir, name), "r", encoding="utf-8", newline="") as f:
+            for row in csv.DictReader(f):
+                day = (row.get("date") or "")[:10]
+                if day and (earliest is None or day < earliest):
+                    earliest = day
+    return earliest
+
+
+class PredictionCache:
+    def __init__(self, cache_dir, max_bytes=None, max_age_days=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, cfg):
+        """Build from paths.yaml keys, or return None when prediction_cache_dir is not set."""
+        cache_dir = cfg.get('prediction_cache_dir')
+        if not cache_dir:
+            return None
+        max_gb = cfg.get('prediction_cache_max_gb')
+        return cls(cache_dir,
+                   max_bytes=int(max_gb * 1024 ** 3) if max_gb else None,
+                   max_age_days=cfg.get('prediction_cache_max_age_days'))
+
+    @staticmethod
+    def make_key(model_hashes, start_date, end_date, data_version, handler_config, options=None):
+        payload = {
+            "models": model_hashes,
+            "start_date": str(start_date)[:10],
+            "end_date": str(end_date)[:10],
+            "data_version": data_version,
+            "handler": handler_config,
+            "options": options or {},
+        }
+        blob = json.dumps(payload, sort_keys=True, default=str).encode()
+        return hashlib.sha256(blob).hexdigest()
+
+    def _path(self, key, start_date, end_date):
+        start = str(start_date)[:10].replace("-", "")
+        end = str(end_date)[:10].replace("-", "")
+        return os.path.join(self.cache_dir, f"{start}_{end}_{key}{CACHE_SUFFIX}")
+
+    def _entries(self):
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(CACHE_SUFFIX):
+                yield os.path.join(self.cache_dir, name), name
+
+    def get(self, key, start_date, end_date):
+        import pandas as pd
+
+        path = self._path(key, start_date, end_date)
+        if not os.path.exists(path):
+            return None
+        try:
+            df = pd.read_pickle(path)
+        except Exception:
+            # Truncated or unreadable entry: drop it and recompute
+            os.remove(path)
+            return None
+        # Refresh mtime so size eviction is least-recently-used
+        os.utime(path, None)
+        return df
+
+    def put(self, key, start_date, end_date, df):
+        path = self._path(key, start_date, end_date)
+        tmp_path = path + ".tmp"
+        df.to_pickle(tmp_path)
+        os.replace(tmp_path, path)
+        self.evict()
+        return path
+
+    def invalidate_from(self, date):
+        """Drop every entry whose date range ends on or after date; return how many."""
+        since = str(date)[:10].replace("-", "")
+        removed = 0
+        for path, name in self._entries():
+            end = name.split("_")[1]
+            if end >= since:
+                os.remove(path)
+                removed += 1
+        return removed
+
+    def evict(self):
+        entries = []
+        now = time.time()
+        for path, _ in self._entries():
+            st = os.stat(path)
+            if self.max_age_days is not None and now - st.st_mtime > self.max_age_days * 86400:
+                os.remove(path)
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+
+        if self.max_bytes is None:
+            return
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
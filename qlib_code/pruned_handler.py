@@ -0,0 +1,173 @@
+"""Alpha158 handler that only computes the features a trained booster uses.
+
+`ShapRecord.generate` saves `gain_importance` and `split_importance` next to
+`trained_model`. `select_features` reads them (or asks the booster directly
+when they are missing) and keeps either every feature the booster splits on
+(`mode="split"`, predictions unchanged) or the top-K features by gain
+(`mode="topk"`, an approximation).
+
+`PrunedAlpha158` computes only those expressions and then restores the full
+158-column layout, filling the dropped features with NaN. LightGBM routes
+NaN down each split's default branch and never reads a feature it does not
+split on, so with `mode="split"` the scores are the same as with the full
+handler. Feature computation time drops roughly in proportion to the kept set.
+
+Parity check (prints max abs difference, rank IC against the full handler
+and both feature build times):
+    python pruned_handler.py --model-path "E:\\qlib-optimizer\\qlib_code\\mlruns\\...\\artifacts\\trained_model" \
+        --start-date 2025-10-20 --end-date 2025-10-22 --mode split
+"""
+import os
+import argparse
+import pickle
+import time
+import numpy as np
+import pandas as pd
+from qlib.contrib.data.handler import Alpha158
+
+
+def full_feature_names():
+    """Alpha158 feature names in the column order the models were trained on."""
+    _, names = Alpha158.get_feature_config(None)
+    return list(names)
+
+
+class PrunedAlpha158(Alpha158):
+    """Alpha158 restricted to keep_features; the other columns are returned as NaN."""
+
+    def __init__(self, keep_features=None, **kwargs):
+        # Set before Alpha158.__init__, which builds the loader from get_feature_config()
+        self.keep_features = list(keep_features) if keep_features else None
+        super().__init__(**kwargs)
+
+    def get_feature_config(self):
+        fields, names = super().get_feature_config()
+        if not self.keep_features:
+            return fields, names
+        keep = set(self.keep_features)
+        pairs = [(f, n) for f, n in zip(fields, names) if n in keep]
+        return [f for f, _ in pairs], [n for _, n in pairs]
+
+    def setup_data(self, *args, **kwargs):
+        super().setup_data(*args, **kwargs)
+        if not self.keep_features:
+            return
+        for attr in ("_data", "_infer", "_learn"):
+            df = getattr(self, attr, None)
+            if isinstance(df, pd.DataFrame):
+                setattr(self, attr, self._restore_columns(df))
+
+    @staticmethod
+    def _restore_columns(df):
+        if not isinstance(df.columns, pd.MultiIndex):
+            return df
+        others = [c for c in df.columns if c[0] != "feature"]
+        columns = [("feature", n) for n in full_feature_names()] + others
+        return df.reindex(columns=pd.MultiIndex.from_tuples(columns, names=df.columns.names))
+
+
+def load_importance(model_path):
+    """(gain, split) importance arrays for a trained_model artifact, in feature order."""
+    artifacts_dir = os.path.dirname(model_path)
+    found = {}
+    for kind in ("gain", "split"):
+        path = os.path.join(artifacts_dir, f"{kind}_importance")
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                found[kind] = np.asarray(pickle.load(f), dtype=float)
+    if len(found) < 2:
+        with open(model_path, "rb") as f:
+            model = pickle.load(f)
+        booster = getattr(model, "model", model)
+        for kind in ("gain", "split"):
+            found.setdefault(kind, np.asarray(booster.feature_importance(importance_type=kind), dtype=float))
+    return found["gain"], found["split"]
+
+
+def select_features(model_path, mode="split", top_k=None):
+    """Names of the features to compute for model_path.
+
+    mode="split": every feature with at least one split (exact).
+    mode="topk": the top_k features by gain (approximate).
+    """
+    gain, split = load_importance(model_path)
+    names = full_feature_names()
+    if len(names) != len(gain):
+        raise ValueError(f"{model_path} has {len(gain)} features, Alpha158 has {len(names)}")
+    if mode == "split":
+        return [n for n, s in zip(names, split) if s > 0]
+    if mode == "topk":
+        if not top_k:
+            raise ValueError("mode='topk' needs top_k")
+        order = np.argsort(-gain, kind="stable")[:top_k]
+        return [names[i] for i in sorted(order)]
+    raise ValueError(f"unknown prune mode: {mode}")
+
+
+def pruned_handler(model_paths, mode="split", top_k=None):
+    """Handler spec for build_dataset_config / parallel_features.compute_features.
+
+    model_paths: one trained_model path or a list of them; with several models
+    (update_new scoring more than one score_name) the union of their features is kept.
+    """
+    if isinstance(model_paths, str):
+        model_paths = [model_paths]
+    keep = set()
+    for path in model_paths:
+        keep.update(select_features(path, mode, top_k))
+    return {
+        "class": "PrunedAlpha158",
+        "module_path": "pruned_handler",
+        "kwargs": {"keep_features": [n for n in full_feature_names() if n in keep]},
+    }
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Compare PrunedAlpha158 predictions with the full Alpha158 handler")
+    p.add_argument("--model-path", required=True)
+    p.add_argument("--provider-uri", default=r"E:\\qlib_data\\tushare_qlib_data\\qlib_bin", help="Qlib provider uri")
+    p.add_argument("--start-date", required=True)
+    p.add_argument("--end-date", required=True)
+    p.add_argument("--instruments", default="all")
+    p.add_argument("--mode", choices=["split", "topk"], default="split")
+    p.add_argument("--top-k", type=int, default=None)
+    p.add_argument("--atol", type=float, default=1e-6, help="Allowed max abs difference in split mode")
+    return p.parse_args()
+
+
+def main():
+    from qlib.data import D
+    from qlib.utils import init_instance_by_config
+    from export_test_scores_per_day import build_dataset_config
+    from qlib_cache import init_qlib
+
+    args = parse_args()
+    init_qlib(args.provider_uri)
+    os.environ["QLIB_DISABLE_MP"] = "1"
+
+    with open(args.model_path, "rb") as f:
+        model = pickle.load(f)
+    handler = pruned_handler(args.model_path, args.mode, args.top_k)
+    print(f"Computing {len(handler['kwargs']['keep_features'])} of {len(full_feature_names())} features")
+
+    instruments = D.instruments(market=args.instruments)
+    preds = {}
+    for name, spec in (("full", None), ("pruned", handler)):
+        t0 = time.perf_counter()
+        dataset = init_instance_by_config(build_dataset_config(instruments, args.start_date, args.end_date,
+                                                               handler=spec))
+        t1 = time.perf_counter()
+        preds[name] = model.predict(dataset)
+        print(f"{name}: features {t1 - t0:.2f}s")
+
+    full, pruned = preds["full"], preds["pruned"].reindex(preds["full"].index)
+    max_diff = float(np.nanmax(np.abs(full.to_numpy() - pruned.to_numpy()))) if len(full) else 0.0
+    rank_ic = pd.concat([full, pruned], axis=1).groupby(level="datetime").apply(
+        lambda g: g.iloc[:, 0].corr(g.iloc[:, 1], method="spearman")).mean()
+    print(f"max_abs_diff={max_diff:.3g} mean_daily_rank_ic={rank_ic:.6f}")
+    if args.mode == "split" and max_diff > args.atol:
+        raise SystemExit(f"Pruned predictions differ by {max_diff} (> {args.atol})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""Shared on-disk cache of qlib expression series and datasets.
+
+Every qlib entry point in this repo calls `init_qlib` instead of `qlib.init`.
+When `qlib_cache_dir` is set in config/paths.yaml, it registers two cache
+wrappers in front of qlib's providers:
+
+    * SharedExpressionCache -- one series per (instrument, expression, freq, window),
+      stored as a little-endian int64 start index followed by float32 values
+    * SharedDatasetCache    -- one pickled frame per D.features() call
+      (instruments, fields, window, freq, instrument processors)
+
+Keys include the exact query window, so a cached result is the same as a
+fresh one. Research runs repeated over the same window hit the cache.
+
+Layout: <qlib_cache_dir>/<provider_uri hash>/<bin store version>/{expr,dataset}/...
+The bin store version is the newest mtime under calendars/ and instruments/,
+which dump_bin/dump_update rewrite on every update, so an update moves all
+processes to a fresh directory. The main process of each entry point removes
+the directories of older versions and evicts least recently used files above
+`qlib_cache_max_gb`. Writes go through a temp file and os.replace, so
+concurrent worker processes can share the cache without locks. qlib's own
+Disk*Cache classes would need a redis server for locking.
+"""
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import time
+import numpy as np
+import pandas as pd
+import yaml
+from qlib.data.cache import DatasetCache, ExpressionCache
+from data_version import bin_store_version
+
+PATHS_YAML = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'config', 'paths.yaml'))
+# Only refresh a hit file's mtime (the LRU clock) if it is older than this, to save syscalls
+TOUCH_INTERVAL = 3600
+
+
+def _digest(*parts):
+    blob = json.dumps(parts, sort_keys=True, default=str).encode()
+    return hashlib.sha1(blob).hexdigest()
+
+
+class DiskLRUStore:
+    """Files under one bin store version, with size-capped LRU eviction by mtime."""
+
+    def __init__(self, cache_dir, provider_uri, max_bytes=None):
+        self.root = os.path.join(cache_dir, _digest(os.path.abspath(provider_uri))[:12])
+        self.version = bin_store_version(provider_uri)
+        self.dir = os.path.join(self.root, self.version)
+        self.max_bytes = max_bytes
+
+    def path(self, *parts):
+        return os.path.join(self.dir, *parts)
+
+    def _hit(self, path):
+        if time.time() - os.stat(path).st_mtime > TOUCH_INTERVAL:
+            os.utime(path, None)
+
+    def _write(self, path, write):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        write(tmp_path)
+        os.replace(tmp_path, path)
+
+    def load_series(self, path):
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            start = int(np.frombuffer(f.read(8), dtype="<i8")[0])
+            values = np.frombuffer(bytearray(f.read()), dtype="<f4")
+        self._hit(path)
+        return pd.Series(values, index=pd.RangeIndex(start, start + len(values)), dtype=np.float32)
+
+    def save_series(self, path, series):
+        index = np.asarray(series.index)
+        # Expression series are indexed by contiguous calendar positions; cache nothing else
+        if len(index) and (index.dtype.kind not in "iu" or np.any(np.diff(index) != 1)):
+            return
+        start = int(index[0]) if len(index) else 0
+
+        def write(tmp_path):
+            with open(tmp_path, "wb") as f:
+                f.write(np.asarray([start], dtype="<i8").tobytes())
+                f.write(np.asarray(series.values, dtype="<f4").tobytes())
+
+        self._write(path, write)
+
+    def load_pickle(self, path):
+        if not os.path.exists(path):
+            return None
+        try:
+            obj = pd.read_pickle(path)
+        except Exception:
+            return None
+        self._hit(path)
+        return obj
+
+    def save_pickle(self, path, obj):
+        self._write(path, lambda tmp_path: pd.to_pickle(obj, tmp_path, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def drop_stale_versions(self):
+        if not os.path.isdir(self.root):
+            return
+        for name in os.listdir(self.root):
+            if name != self.version:
+                shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+
+    def evict(self):
+        if self.max_bytes is None or not os.path.isdir(self.dir):
+            return
+        entries = []
+        for root, _, files in os.walk(self.dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+class SharedExpressionCache(ExpressionCache):
+    def __init__(self, provider, cache_dir, provider_uri, max_bytes=None):
+        super().__init__(provider)
+        self.store = DiskLRUStore(cache_dir, provider_uri, max_bytes)
+
+    def _uri(self, instrument, field, start_time=None, end_time=None, freq="day"):
+        return self.store.path("expr", str(instrument).lower(), _digest(str(field), freq, start_time, end_time) + ".bin")
+
+    def _expression(self, instrument, field, start_time=None, end_time=None, freq="day"):
+        path = self._uri(instrument, field, start_time, end_time, freq)
+        series = self.store.load_series(path)
+        if series is None:
+            series = self.provider.expression(instrument, field, start_time, end_time, freq)
+            self.store.save_series(path, series)
+        return series
+
+    def update(self, cache_uri, freq="day"):
+        # Entries are immutable per bin store version; updates move to a new version directory
+        return 1
+
+
+class SharedDatasetCache(DatasetCache):
+    def __init__(self, provider, cache_dir, provider_uri, max_bytes=None):
+        super().__init__(provider)
+        self.store = DiskLRUStore(cache_dir, provider_uri, max_bytes)
+
+    def _uri(self, instruments, fields, start_time=None, end_time=None, freq="day", disk_cache=1,
+             inst_processors=[], **kwargs):
+        key = _digest(instruments, list(fields), start_time, end_time, freq, repr(inst_processors))
+        return self.store.path("dataset", key + ".pkl")
+
+    def _dataset(self, instruments, fields, start_time=None, end_time=None, freq="day", disk_cache=1,
+                 inst_processors=[]):
+        path = self._uri(instruments, fields, start_time, end_time, freq, inst_processors=inst_processors)
+        df = self.store.load_pickle(path)
+        if df is None:
+            df = self.provider.dataset(instruments, fields, start_time, end_time, freq,
+                                       inst_processors=inst_processors)
+            self.store.save_pickle(path, df)
+        return df
+
+    def update(self, cache_uri, freq="day"):
+        return 1
+
+
+def load_cache_config(path=PATHS_YAML):
+    """(cache_dir, max_bytes) from paths.yaml; cache_dir is None when the cache is disabled."""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            cfg = yaml.safe_load(f) or {}
+    except FileNotFoundError:
+        return None, None
+    max_gb = cfg.get('qlib_cache_max_gb')
+    return cfg.get('qlib_cache_dir'), (int(max_gb * 1024 ** 3) if max_gb else None)
+
+
+def init_qlib(provider_uri, maintain=True, **kwargs):
+    """qlib.init with the shared expression/dataset cache registered when configured.
+
+    maintain: drop stale versions and evict over-size entries; pass False from
+    worker processes so only the entry point's main process walks the cache.
+    """
+    import qlib
+    from qlib.config import C
+    from qlib.data.data import register_all_wrappers
+
+    qlib.init(provider_uri=provider_uri, **kwargs)
+    cache_dir, max_bytes = load_cache_config()
+    if not cache_dir:
+        return
+
+    cache_kwargs = {"cache_dir": cache_dir, "provider_uri": provider_uri, "max_bytes": max_bytes}
+    # qlib.init drops expression/dataset caches when no redis is reachable, so register
+    # ours afterwards; the settings travel with C into qlib's own worker processes
+    C["expression_cache"] = {"class": "SharedExpressionCache", "module_path": "qlib_cache", "kwargs": cache_kwargs}
+    C["dataset_cache"] = {"class": "SharedDatasetCache", "module_path": "qlib_cache", "kwargs": cache_kwargs}
+    register_all_wrappers(C)
+
+    if maintain:
+        store = DiskLRUStore(cache_dir, provider_uri, max_bytes)
+        store.drop_stale_versions()
+        store.evict()
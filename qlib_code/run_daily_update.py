@@ -6,6 +6,7 @@ import os
 from pathlib import Path
 import yaml
 from typing import TextIO
+from prediction_cache import PredictionCache, earliest_csv_date
 from datetime import datetime, date
 
 WORKDIR = Path(__file__).resolve().parent
@@ -99,6 +100,8 @@ def run_cmd(cmd, cwd=None, env=None):
 def main():
     parser = argparse.ArgumentParser(description="Run full daily update pipeline")
     parser.add_argument("--date", help="目标预测日期 YYYY-MM-DD (可选)")
+    parser.add_argument("--start", help="补跑区间起始日期 YYYY-MM-DD，与 --end 一起一次性预测整个区间 (可选)")
+    parser.add_argument("--end", help="补跑区间结束日期 YYYY-MM-DD (可选)")
     parser.add_argument("--data_csv_dir", default=csv_path)
     parser.add_argument("--qlib_bin_dir", default=qlib_bin_dir)
     parser.add_argument("--qlib_workdir", default=qlib_workdir)
@@ -176,6 +179,22 @@ def main():
         print(f"Warning: qlib_workdir {qlib_workdir} does not exist. Attempting to run anyway.")
     run_cmd(dump_cmd, cwd=str(qlib_workdir))
 
+    # dump_update 可能改写已有日期的 bin 数据，相关日期及之后的缓存预测全部失效
+    cache = PredictionCache.from_config(cfg)
+    if cache is not None:
+        touched = earliest_csv_date(args.data_csv_dir)
+        if touched:
+            removed = cache.invalidate_from(touched)
+            print(f"已清除 {touched} 及之后的 {removed} 条预测缓存")
+    if cfg.get("lgb_dataset_cache_dir"):
+        # 按需导入：该模块依赖 lightgbm 和 qlib
+        from lgb_dataset_cache import LGBDatasetCache
+        lgb_cache = LGBDatasetCache.from_config(cfg)
+        touched = earliest_csv_date(args.data_csv_dir)
+        if touched:
+            removed = lgb_cache.invalidate_from(touched)
+            print(f"已清除覆盖 {touched} 及之后数据的 {removed} 个 LightGBM Dataset 缓存")
+
     update_script = WORKDIR / "update_new.py"
     if not update_script.exists():
         raise SystemExit(f"Missing script: {update_script}")
@@ -189,7 +208,10 @@ def main():
 
     env["QLIB_PROVIDER_URI"] = args.qlib_bin_dir
 
-    run_cmd([py, str(update_script)], env=env)
+    update_cmd = [py, str(update_script)]
+    if getattr(args, "start", None):
+        update_cmd += ["--start", args.start, "--end", args.end or args.start]
+    run_cmd(update_cmd, env=env)
 
     print("\n每日更新完成")
 
@@ -1,9 +1,10 @@
 import shap
 from matplotlib import pyplot as plt
 from qlib.workflow import R
-import qlib
 from qlib.config import REG_CN
 from qlib.contrib.report import analysis_position, analysis_model
+from qlib_cache import init_qlib
+from memory_utils import MemoryTracker
 import warnings
 warnings.filterwarnings('ignore', category=FutureWarning)
 warnings.filterwarnings('ignore', category=UserWarning)
@@ -11,22 +12,29 @@ warnings.filterwarnings('ignore', category=UserWarning)
 import shutil
 import os
 
-def save_all_figures(experiment_id, experiment_name,provider_uri, mlruns_uri, output_dir=r"E:\qlib_data\analysis_figures"):
-    
+def save_all_figures(experiment_id, experiment_name,provider_uri, mlruns_uri, output_dir=r"E:\qlib_data\analysis_figures", compact=False,
+                     memory_report=False):
+    """compact: pred_label 使用 float32；memory_report: 打印各阶段内存峰值。"""
 
-    qlib.init(provider_uri=provider_uri, region=REG_CN)
+    init_qlib(provider_uri, region=REG_CN)
     R.set_uri(mlruns_uri)
     recorder = R.get_recorder(experiment_id=experiment_id, experiment_name=experiment_name)
+    tracker = MemoryTracker(enabled=memory_report)
 
-    report_normal_df = recorder.load_object("portfolio_analysis/report_normal_1day.pkl")
-    positions = recorder.load_object("portfolio_analysis/positions_normal_1day.pkl")
-    analysis_df = recorder.load_object("portfolio_analysis/port_analysis_1day.pkl")
-    pred = recorder.load_object("pred.pkl")
-    label = recorder.load_object("label.pkl")
+    with tracker.stage("load artifacts"):
+        report_normal_df = recorder.load_object("portfolio_analysis/report_normal_1day.pkl")
+        positions = recorder.load_object("portfolio_analysis/positions_normal_1day.pkl")
+        analysis_df = recorder.load_object("portfolio_analysis/port_analysis_1day.pkl")
+        pred = recorder.load_object("pred.pkl")
+        label = recorder.load_object("label.pkl")
 
     import pandas as pd
-    pred_label = pd.concat([pred, label], axis=1, sort=True)
-    pred_label.columns = ['score', 'label']
+    with tracker.stage("pred_label"):
+        pred_label = pd.concat([pred, label], axis=1, sort=True)
+        pred_label.columns = ['score', 'label']
+        if compact:
+            pred_label = pred_label.astype('float32')
+        del pred, label
     fig_list = []
 
     try:
@@ -207,6 +215,7 @@ def save_all_figures(experiment_id, experiment_name,provider_uri, mlruns_uri, ou
     except Exception as e:
         print(f"特征重要性图生成或保存失败: {e}")
 
+    tracker.report()
     print(f"\n=== 保存结果 ===")
     print(f"成功保存: {len(saved_paths)} 个文件")
     print(f"保存失败: {len(failed_saves)} 个文件")
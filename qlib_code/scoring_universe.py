@@ -0,0 +1,57 @@
+"""Scoring universe: the instruments we actually optimize over.
+
+The Matlab optimizer only keeps scores for the constituents of its stock pool
+(score_zz800/1800/3800_stockpool_processing.m), so scoring the whole market
+computes features and predictions for names that are thrown away. A universe
+is a list of pool names and/or qlib instruments files (instruments/<name>.txt,
+written by get_index_component.py). It resolves to the sorted union of their
+constituents and is applied before feature computation.
+
+Constituent spans in the instruments files are widened by `margin_days`
+calendar days on both sides. Names that joined or left an index around the
+scored range are therefore still scored, so the universe is a superset of
+what the optimizer reads on any day in the range.
+"""
+import pandas as pd
+
+# Matlab stock pools -> qlib instruments files (hs300 = csi300, zz500 = csi500, ...)
+POOLS = {
+    "zz800": ["csi300", "csi500"],
+    "zz1800": ["csi300", "csi500", "csi1000"],
+    "zz3800": ["csi300", "csi500", "csi1000", "csi2000"],
+}
+DEFAULT_MARGIN_DAYS = 30
+
+
+def resolve_markets(universe):
+    """Instruments file names for a universe given as 'zz800', 'csi300,csi500' or a list."""
+    if isinstance(universe, str):
+        universe = [u.strip() for u in universe.split(",")]
+    markets = []
+    for name in universe:
+        for market in POOLS.get(name.lower(), [name]):
+            if market and market not in markets:
+                markets.append(market)
+    return markets
+
+
+def universe_instruments(universe, start_date, end_date, margin_days=DEFAULT_MARGIN_DAYS):
+    """Sorted instrument codes of the universe that have data in [start_date, end_date].
+
+    Raises ValueError when none of the constituents is in the 'all' market,
+    which usually means the instruments files use a different code format.
+    """
+    from qlib.data import D
+
+    lo = (pd.Timestamp(start_date) - pd.Timedelta(days=margin_days)).strftime("%Y-%m-%d")
+    hi = (pd.Timestamp(end_date) + pd.Timedelta(days=margin_days)).strftime("%Y-%m-%d")
+    codes = set()
+    for market in resolve_markets(universe):
+        codes.update(D.list_instruments(D.instruments(market=market), start_time=lo, end_time=hi, as_list=True))
+
+    listed = set(D.list_instruments(D.instruments(market="all"), start_time=start_date, end_time=end_date,
+                                    as_list=True))
+    selected = sorted(codes & listed)
+    if codes and not selected:
+        raise ValueError(f"no constituent of {universe} is in instruments/all.txt; check the code format")
+    return selected
@@ -1,30 +1,44 @@
 from qlib.workflow.record_temp import SignalRecord
+import numpy as np
 import shap
 import logging
+from memory_utils import MemoryTracker, compact_features
 
 log = logging.getLogger(__name__)
 
 class ShapRecord(SignalRecord):
-    def __init__(self, model=None, dataset=None, **kwargs):
+    """compact: 以 float32 保存特征和 SHAP 值；memory_report: 记录各阶段内存峰值（见 memory_utils）。"""
+
+    def __init__(self, model=None, dataset=None, compact=False, memory_report=False, **kwargs):
         super().__init__(model=model, dataset=dataset, **kwargs)
+        self.compact = compact
+        self.memory_report = memory_report
 
     def generate(self):
         recorder = self.recorder
         model = self.model
         explainer = shap.TreeExplainer(model.model)
+        tracker = MemoryTracker(enabled=self.memory_report)
   
         train_X = self.dataset.prepare('train')
         train_X = train_X[[col for col in train_X.columns if not str(col).lower().startswith('label')]]
         feature_names = list(train_X.columns)
+        del train_X
         for seg in ["train", "valid", "test"]:
             try:
-                X = self.dataset.prepare(seg)
-        
-                X = X[[col for col in X.columns if not str(col).lower().startswith('label')]]
+                with tracker.stage(f"prepare {seg}"):
+                    X = self.dataset.prepare(seg)
+            
+                    X = X[[col for col in X.columns if not str(col).lower().startswith('label')]]
+                    if self.compact:
+                        X = compact_features(X)
                 # 检查特征顺序和名称是否一致
                 if list(X.columns) == list(feature_names):
                     X = X[feature_names]
-                    shap_values = explainer.shap_values(X)
+                    with tracker.stage(f"shap {seg}"):
+                        shap_values = explainer.shap_values(X)
+                        if self.compact:
+                            shap_values = np.asarray(shap_values, dtype=np.float32)
                     recorder.save_objects(**{f"shap_values_{seg}.pkl": shap_values})
                     recorder.save_objects(**{f"shap_X_{seg}.pkl": X})
                     log.info(f"SHAP values and X for {seg} saved.")
@@ -38,6 +52,7 @@ class ShapRecord(SignalRecord):
             except Exception as e:
                 
                 log.exception(f"SHAP {seg} 生成或保存失败: {e}")
+        tracker.report(printer=log.info)
              
         
         # 保存 gain/split importance
@@ -0,0 +1,337 @@
+"""Write-behind publishing of result frames to MySQL through a local SQLite spool.
+
+`publish()` pickles the frame into a SQLite spool file (WAL, fsync on commit)
+and returns as soon as the batch is durable. A background thread drains the
+spool in publish order (per target table) through `MySQLImporter.df_to_mysql(..., raise_on_error=True)`.
+Batches that fail with a transient error (db_engine.is_retryable: cannot connect,
+lost connection, deadlock, lock wait timeout) stay in the spool and are retried
+with exponential backoff. A batch that fails with any other error, or has failed
+MAX_ATTEMPTS times, moves to the dead_letters table of the spool file and is
+logged as an error. It then no longer blocks later batches for its table.
+
+Exactly-once delivery needs pk_fields to be a primary or unique key of the
+target table. Before the first batch of each (table, pk_fields) is written the
+key is checked, and added when the table has no duplicate rows
+(MySQLImporter.ensure_unique_key). When it cannot be added, the batches stay
+in the spool and an error is logged on every attempt, instead of
+dead-lettering every batch; callers can run the same check up front with
+ensure_unique_key() to fail before publishing.
+Dead letters are kept for inspection and can be requeued with:
+    python spool_publisher.py --requeue-dead
+
+Delivery is exactly-once on the primary key. A batch is deleted from the
+spool only after MySQL has committed it. If the process dies in between, the
+batch is replayed on the next run, and because the rows are upserted with the
+same values (update_time included, it is stored in the batch) the table ends
+up in the same state.
+
+Batches left over when a run exits are drained by the next publisher, or by:
+    python spool_publisher.py            # drain once and exit
+"""
+import os
+import argparse
+import io
+import logging
+import pickle
+import sqlite3
+import threading
+import time
+import pandas as pd
+import yaml
+from importer import MissingUniqueKeyError, MySQLImporter
+from db_engine import is_retryable
+
+logger = logging.getLogger(__name__)
+
+DB_YAML = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'config', 'db.yaml'))
+PATHS_YAML = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'config', 'paths.yaml'))
+DEFAULT_SPOOL = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'spool', 'publish_spool.sqlite'))
+# A batch claimed by a process that has not finished within this many seconds is claimed again
+CLAIM_TIMEOUT = 1800
+MAX_BACKOFF = 300
+# 可重试错误累计失败这么多次后也转入 dead_letters
+MAX_ATTEMPTS = 20
+BATCH_COLUMNS = "id, table_name, database, schema, pk_fields, payload, rows, created_at, attempts"
+
+
+class SpoolPublisher:
+    def __init__(self, spool_path=DEFAULT_SPOOL, db_config_path=DB_YAML, start=True, max_attempts=MAX_ATTEMPTS):
+        self.spool_path = spool_path
+        self.db_config_path = db_config_path
+        self.max_attempts = max_attempts
+        os.makedirs(os.path.dirname(os.path.abspath(spool_path)), exist_ok=True)
+        conn = self._connect()
+        with conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS batches (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    table_name TEXT NOT NULL,
+                    database TEXT,
+                    schema BLOB NOT NULL,
+                    pk_fields BLOB,
+                    payload BLOB NOT NULL,
+                    rows INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_try REAL NOT NULL DEFAULT 0,
+                    claimed_at REAL,
+                    last_error TEXT
+                )""")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS dead_letters (
+                    id INTEGER PRIMARY KEY,
+                    table_name TEXT NOT NULL,
+                    database TEXT,
+                    schema BLOB NOT NULL,
+                    pk_fields BLOB,
+                    payload BLOB NOT NULL,
+                    rows INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    attempts INTEGER NOT NULL,
+                    failed_at REAL NOT NULL,
+                    error TEXT
+                )""")
+        conn.close()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._importer = None
+        self._importer_lock = threading.Lock()
+        # 已确认主键/唯一键的 (table, database, pk_fields)
+        self._keys_checked = set()
+        self._thread = None
+        if start:
+            self.start()
+
+    @classmethod
+    def from_config(cls, cfg, **kwargs):
+        """Publisher for paths.yaml's publish_spool (default: spool/publish_spool.sqlite in the repo)."""
+        return cls(cfg.get('publish_spool') or DEFAULT_SPOOL, **kwargs)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.spool_path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=FULL")
+        return conn
+
+    def _get_importer(self):
+        with self._importer_lock:
+            if self._importer is None:
+                self._importer = MySQLImporter(self.db_config_path)
+            return self._importer
+
+    def _check_key(self, table_name, database, pk_fields):
+        key = (table_name, database, tuple(sorted(pk_fields or [])))
+        if not pk_fields or key in self._keys_checked:
+            return
+        self._get_importer().ensure_unique_key(table_name, pk_fields, database)
+        self._keys_checked.add(key)
+
+    def ensure_unique_key(self, table_name, pk_fields, database=None):
+        """发布前确认目标表有 pk_fields 主键/唯一键（缺少且无重复行时添加），否则抛出 MissingUniqueKeyError。
+
+        数据库暂时无法连接时只记录警告并返回 False，写入线程会在写入前再次检查。
+        """
+        try:
+            self._check_key(table_name, database, pk_fields)
+        except Exception as e:
+            if not is_retryable(e):
+                raise
+            logger.warning("暂时无法检查 %s 的唯一键 (%s)，写入前再检查", table_name, e)
+            return False
+        return True
+
+    # -- producer side ----------------------------------------------------
+
+    def publish(self, df, table_name, schema, pk_fields=None, database=None):
+        """Durably queue df for df_to_mysql(df, table_name, schema, pk_fields, database); returns the batch id."""
+        buf = io.BytesIO()
+        df.to_pickle(buf, compression=None, protocol=pickle.HIGHEST_PROTOCOL)
+        conn = self._connect()
+        try:
+            with conn:
+                cur = conn.execute(
+                    "INSERT INTO batches (table_name, database, schema, pk_fields, payload, rows, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (table_name, database, pickle.dumps(schema), pickle.dumps(pk_fields), buf.getvalue(),
+                     len(df), time.time()))
+                batch_id = cur.lastrowid
+        finally:
+            conn.close()
+        logger.info("已写入本地队列 #%d: %d 行 -> %s", batch_id, len(df), table_name)
+        self._wake.set()
+        return batch_id
+
+    def dead_letters(self):
+        """(batches, rows) moved to dead_letters."""
+        conn = self._connect()
+        try:
+            n, rows = conn.execute("SELECT COUNT(*), COALESCE(SUM(rows), 0) FROM dead_letters").fetchone()
+        finally:
+            conn.close()
+        return n, rows
+
+    def requeue_dead(self):
+        """Move every dead letter back to the end of the spool (after the cause was fixed); returns the count."""
+        conn = self._connect()
+        try:
+            with conn:
+                # 新 id 排在队尾：重新入队的批次在已写入的较新批次之后应用，会覆盖其中相同主键的行
+                cols = BATCH_COLUMNS.replace('id, ', '', 1)
+                n = conn.execute(f"INSERT INTO batches ({cols}, next_try) "
+                                 f"SELECT {cols.replace('attempts', '0')}, 0 FROM dead_letters ORDER BY id").rowcount
+                conn.execute("DELETE FROM dead_letters")
+        finally:
+            conn.close()
+        self._wake.set()
+        return n
+
+    def pending(self):
+        """(batches, rows) still waiting in the spool."""
+        conn = self._connect()
+        try:
+            n, rows = conn.execute("SELECT COUNT(*), COALESCE(SUM(rows), 0) FROM batches").fetchone()
+        finally:
+            conn.close()
+        return n, rows
+
+    # -- consumer side ----------------------------------------------------
+
+    def _claim(self, conn):
+        now = time.time()
+        # Only the oldest batch of each target table is eligible, so upserts of the same keys
+        # are applied in publish order even when an earlier batch is waiting for a retry
+        row = conn.execute(
+            "SELECT id FROM batches b WHERE next_try <= ? AND (claimed_at IS NULL OR claimed_at < ?) "
+            "AND id = (SELECT MIN(id) FROM batches o WHERE o.table_name = b.table_name "
+            "AND COALESCE(o.database, '') = COALESCE(b.database, '')) "
+            "ORDER BY id LIMIT 1", (now, now - CLAIM_TIMEOUT)).fetchone()
+        if row is None:
+            return None
+        with conn:
+            cur = conn.execute(
+                "UPDATE batches SET claimed_at = ? WHERE id = ? AND (claimed_at IS NULL OR claimed_at < ?)",
+                (now, row[0], now - CLAIM_TIMEOUT))
+        if cur.rowcount != 1:
+            # Another process claimed it first
+            return self._claim(conn)
+        return conn.execute(
+            "SELECT id, table_name, database, schema, pk_fields, payload, attempts FROM batches WHERE id = ?",
+            (row[0],)).fetchone()
+
+    def drain_once(self):
+        """Send every batch that is due; returns the number of batches written to MySQL."""
+        sent = 0
+        conn = self._connect()
+        try:
+            while not self._stop.is_set():
+                batch = self._claim(conn)
+                if batch is None:
+                    break
+                batch_id, table_name, database, schema, pk_fields, payload, attempts = batch
+                try:
+                    pk_fields = pickle.loads(pk_fields)
+                    self._check_key(table_name, database, pk_fields)
+                    df = pd.read_pickle(io.BytesIO(payload), compression=None)
+                    self._get_importer().df_to_mysql(df, table_name, pickle.loads(schema), pk_fields,
+                                                     database=database, raise_on_error=True)
+                except MissingUniqueKeyError as e:
+                    # 表结构问题，每个批次都会失败：留在队列中并持续报错，修复后自动继续写入
+                    logger.error("队列 #%d 暂停写入 %s: %s", batch_id, table_name, e)
+                    with conn:
+                        conn.execute("UPDATE batches SET next_try = ?, claimed_at = NULL, last_error = ? WHERE id = ?",
+                                     (time.time() + MAX_BACKOFF, str(e), batch_id))
+                    continue
+                except Exception as e:
+                    if not is_retryable(e) or attempts + 1 >= self.max_attempts:
+                        self._dead_letter(conn, batch_id, e, attempts + 1)
+                        continue
+                    delay = min(MAX_BACKOFF, 2 ** attempts)
+                    logger.warning("队列 #%d 写入失败 (%s)，%d 秒后重试", batch_id, e, delay)
+                    with conn:
+                        conn.execute("UPDATE batches SET attempts = attempts + 1, next_try = ?, claimed_at = NULL, "
+                                     "last_error = ? WHERE id = ?", (time.time() + delay, str(e), batch_id))
+                    continue
+                with conn:
+                    conn.execute("DELETE FROM batches WHERE id = ?", (batch_id,))
+                sent += 1
+                logger.info("队列 #%d 已写入数据库", batch_id)
+        finally:
+            conn.close()
+        return sent
+
+    def _dead_letter(self, conn, batch_id, error, attempts):
+        """Move a batch that cannot succeed by retrying out of the queue, so later batches of its table proceed."""
+        with conn:
+            conn.execute(f"INSERT INTO dead_letters ({BATCH_COLUMNS}, failed_at, error) "
+                         f"SELECT {BATCH_COLUMNS.replace('attempts', '?')}, ?, ? FROM batches WHERE id = ?",
+                         (attempts, time.time(), repr(error), batch_id))
+            conn.execute("DELETE FROM batches WHERE id = ?", (batch_id,))
+        logger.error("队列 #%d 写入失败 %d 次，已转入 dead_letters，需人工处理后用 --requeue-dead 重新入队: %r",
+                     batch_id, attempts, error, exc_info=error)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.drain_once()
+            # Wake on publish() or when the earliest retry becomes due
+            self._wake.wait(timeout=self._next_wait())
+            self._wake.clear()
+
+    def _next_wait(self):
+        conn = self._connect()
+        try:
+            (next_try,) = conn.execute("SELECT MIN(next_try) FROM batches").fetchone()
+        finally:
+            conn.close()
+        if next_try is None:
+            return MAX_BACKOFF
+        return min(MAX_BACKOFF, max(0.1, next_try - time.time()))
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="spool-drain", daemon=True)
+            self._thread.start()
+
+    def close(self, timeout=60):
+        """Wait up to timeout seconds for the spool to drain, then stop; leftovers stay for the next run."""
+        if self._thread is not None:
+            deadline = time.time() + (timeout or 0)
+            while self.pending()[0] and time.time() < deadline:
+                self._wake.set()
+                time.sleep(0.2)
+            n, rows = self.pending()
+            if n:
+                logger.warning("本地队列中仍有 %d 批 %d 行未写入数据库，将在下次运行时继续写入", n, rows)
+            self._stop.set()
+            self._wake.set()
+            self._thread.join(timeout=5)
+            if self._thread.is_alive():
+                # 后台线程仍在写入当前批次，不能释放它正在使用的连接池；批次未删除，下次运行会重放
+                logger.warning("后台写入线程 5 秒内未结束，保留数据库连接直到进程退出")
+                return
+        if self._importer is not None:
+            self._importer.close()
+            self._importer = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="把本地队列中未写入的批次写入 MySQL")
+    parser.add_argument("--spool", default=None, help="队列文件，缺省读取 paths.yaml 的 publish_spool")
+    parser.add_argument("--requeue-dead", action="store_true", help="把 dead_letters 中的批次重新放回队列")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)-8s %(name)s: %(message)s")
+
+    with open(PATHS_YAML, 'r', encoding='utf-8') as f:
+        cfg = yaml.safe_load(f) or {}
+    publisher = SpoolPublisher(args.spool or cfg.get('publish_spool') or DEFAULT_SPOOL, start=False)
+    if args.requeue_dead:
+        print(f"重新入队 {publisher.requeue_dead()} 批")
+    sent = publisher.drain_once()
+    n, rows = publisher.pending()
+    publisher.close()
+    n_dead, dead_rows = publisher.dead_letters()
+    print(f"写入 {sent} 批，队列剩余 {n} 批 {rows} 行，dead_letters {n_dead} 批 {dead_rows} 行")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# qlib_code 下的模块按顶层模块导入（与各脚本的运行方式一致）
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
@@ -0,0 +1,49 @@
+import os
+
+from data_version import OPEN_END, bin_data_version, label_data_end
+
+VALID_END = "2025-10-30"
+
+
+def _provider(tmp_path, days):
+    os.makedirs(tmp_path / "calendars", exist_ok=True)
+    (tmp_path / "calendars" / "day.txt").write_text("".join(f"{d}\n" for d in days))
+    return str(tmp_path)
+
+
+def _append_day(provider_uri, day):
+    with open(os.path.join(provider_uri, "calendars", "day.txt"), "a") as f:
+        f.write(f"{day}\n")
+
+
+def _version(provider_uri, horizon=2):
+    end = label_data_end(provider_uri, VALID_END, horizon)
+    return end, bin_data_version(provider_uri, end)
+
+
+def test_day_after_valid_end_changes_version(tmp_path):
+    uri = _provider(tmp_path, ["2025-10-28", "2025-10-29", VALID_END])
+    end, before = _version(uri)
+    assert end == OPEN_END
+
+    # 新增的交易日让验证集最后几行的标签从 NaN 变为实际值，缓存键必须变化
+    _append_day(uri, "2025-10-31")
+    end, after = _version(uri)
+    assert after != before
+    # invalidate_from(新增日期) 会删除该条目（end >= 日期）
+    assert end >= "2025-10-31"
+
+
+def test_version_stable_once_label_horizon_is_covered(tmp_path):
+    uri = _provider(tmp_path, ["2025-10-29", VALID_END, "2025-10-31"])
+    _append_day(uri, "2025-11-03")
+    end, covered = _version(uri)
+    assert end == "2025-11-03"
+
+    _append_day(uri, "2025-11-04")
+    assert _version(uri) == (end, covered)
+
+
+def test_zero_horizon_uses_segment_end(tmp_path):
+    uri = _provider(tmp_path, ["2025-10-29", VALID_END])
+    assert label_data_end(uri, VALID_END, 0) == VALID_END
@@ -6,7 +6,8 @@ import concurrent.futures
 from datetime import datetime, timedelta, date
 import yaml
 import sqlalchemy
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
+from db_engine import get_engine, mysql_url, pool_metrics, read_sql
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
 log = logging.getLogger(__name__)
 
@@ -23,8 +24,9 @@ class QlibDataConverter:
         
         # 创建数据库连接
         try:
-            db_url = f"mysql+pymysql://{db_cfg['user']}:{db_cfg['password']}@{db_cfg['host2']}:{db_cfg['port']}/{db_cfg['database3']}"
-            self.engine = create_engine(db_url)
+            # 共享连接池：pre-ping、定期回收，查询遇到断线/死锁时重试
+            db_url = mysql_url(db_cfg, host_key='host2', database_key='database3')
+            self.engine = get_engine(db_url, db_cfg)
             log.info("数据库连接成功")
         except Exception as e:
             log.error(f"数据库连接失败: {e}")
@@ -48,7 +50,7 @@ class QlibDataConverter:
                 WHERE valuation_date <= CURDATE()
             """)
             
-            result = pd.read_sql(query, self.engine)
+            result = read_sql(query, self.engine)
             latest_date = result.iloc[0]['latest_date']
             
             if latest_date is not None:
@@ -110,7 +112,7 @@ class QlibDataConverter:
                 AND valuation_date = :target_date
             """)
             
-            df = pd.read_sql(query, self.engine, 
+            df = read_sql(query, self.engine, 
                            params={'code': code, 'target_date': target_date_str})
             
             if df is not None and not df.empty:
@@ -147,7 +149,7 @@ class QlibDataConverter:
                 ORDER BY code
             """)
             
-            df = pd.read_sql(query, self.engine, 
+            df = read_sql(query, self.engine, 
                            params={'target_date': target_date_str})
             
             if df is not None and not df.empty:
@@ -325,7 +327,7 @@ class QlibDataConverter:
                 AND valuation_date = :target_date
             """)
             
-            df = pd.read_sql(query, self.engine, 
+            df = read_sql(query, self.engine, 
                            params={'index_code': index_code, 'target_date': target_date_str})
             
             if df is None or df.empty:
@@ -425,11 +427,11 @@ class QlibDataConverter:
                     WHERE organization = :market
                     ORDER BY code
                 """)
-                df = pd.read_sql(query, self.engine, params={'market': market})
+                df = read_sql(query, self.engine, params={'market': market})
             else:
                 # 获取所有股票
                 query = text("SELECT DISTINCT code FROM data_stock ORDER BY code")
-                df = pd.read_sql(query, self.engine)
+                df = read_sql(query, self.engine)
             
             stock_list = df['code'].tolist()
             log.info(f"获取到 {len(stock_list)} 只股票")
@@ -526,6 +528,8 @@ def main():
     converter.process_all_stocks(market=market, batch_size=batch_size, target_date=None)
     converter.process_all_indices(market=market, target_date=None)
     
+    if converter.engine is not None:
+        log.info(f"连接池统计: {pool_metrics(converter.engine)}")
     logging.info("处理完成")
     
 
@@ -3,95 +3,203 @@ Load a trained model and run prediction for a target date using Qlib dataset han
 
 This script expects the following environment variables (set by `run_daily_update.py` or manually):
     TARGET_PREDICT_DATE  -- (optional) YYYY-MM-DD date string for prediction. Defaults to today.
+
+Catch-up mode scores every trading day in a range with one handler and one predict call,
+writes one prediction_YYYYMMDD.csv per date and upserts all rows in a single import:
+    python update_new.py --start 2025-10-01 --end 2025-10-09
 """
 
-from importer import MySQLImporter
+from spool_publisher import SpoolPublisher
+from booster_predict import BoosterPredictor, prepare_features
+from export_test_scores_per_day import build_dataset_config
+from prediction_cache import PredictionCache
+from data_version import bin_data_version, file_sha256
+from parallel_features import build_dataset
+from pruned_handler import pruned_handler
+from panel_features import build_panel_dataset
+from scoring_universe import DEFAULT_MARGIN_DAYS, universe_instruments
+from qlib_cache import init_qlib
+import argparse
 import os
 from qlib.utils import init_instance_by_config
-from qlib.workflow import R
 from qlib.data import D
+import numpy as np
 import pandas as pd
-import qlib
 from multiprocessing import freeze_support
 import pickle
 import sys
 import os
 import yaml
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, time, date
 original_sys_path = sys.path.copy()
 
+DEFAULT_SCORE_NAME = "vp08"
+PK_FIELDS = ['valuation_date', 'code', 'score_name']
+
+
+def model_specs(cfg):
+    """配置中的模型列表；未配置 models 时沿用单模型 model_path，score_name 为 vp08。"""
+    return cfg.get('models') or [{'score_name': DEFAULT_SCORE_NAME, 'model_path': cfg['model_path']}]
+
+
+def load_models(cfg, fast_predict):
+    """按配置加载全部模型，返回 {score_name: model}。"""
+    specs = model_specs(cfg)
+    num_threads = cfg.get('predict_num_threads')
+    if fast_predict and not num_threads and len(specs) > 1:
+        # 多个模型并行预测时平分 CPU，避免线程过度订阅
+        num_threads = max(1, (os.cpu_count() or 1) // len(specs))
+
+    models = {}
+    for spec in specs:
+        if fast_predict:
+            models[spec['score_name']] = BoosterPredictor.from_model_path(spec['model_path'], num_threads=num_threads)
+        else:
+            with open(spec['model_path'], "rb") as f:
+                models[spec['score_name']] = pickle.load(f)
+    return models
+
+
+def predict_all(models, dataset, fast_predict):
+    """在同一个 dataset 上并行运行所有模型，返回 (index, {score_name: 分数数组})。
 
+    特征只在 handler 构建时计算一次，各模型共享同一份特征矩阵。
+    """
+    if fast_predict:
+        features = prepare_features(dataset)
+        index = features.index
+        # 只转换一次 float32 连续矩阵，所有模型读同一份数组（predict_array 对这样的数组不再复制）
+        X = np.ascontiguousarray(features.to_numpy(np.float32))
+        del features
 
-def main():
+        def run(model):
+            return model.predict_array(X)
+    else:
+        index = dataset.prepare("test").index
+
+        def run(model):
+            pred = model.predict(dataset)
+            return pred.values if isinstance(pred, pd.Series) else pred.ravel()
+
+    with ThreadPoolExecutor(max_workers=len(models)) as pool:
+        futures = {name: pool.submit(run, model) for name, model in models.items()}
+        return index, {name: fut.result() for name, fut in futures.items()}
+
+
+def blend_scores(index, scores, blend_cfg):
+    """按日截面 z-score 后加权平均得到融合分数；某只股票缺少部分模型的分数时，只按有分数的模型权重归一。"""
+    weights = pd.Series(blend_cfg.get('weights') or {name: 1.0 for name in scores}, dtype=float)
+    unknown = [name for name in weights.index if name not in scores]
+    if unknown:
+        raise ValueError(f"blend.weights 中的 {unknown} 不是已配置的模型，可选: {sorted(scores)}")
+    frame = pd.DataFrame({name: scores[name] for name in weights.index}, index=index)
+    by_date = frame.groupby(level="datetime")
+    z = (frame - by_date.transform("mean")) / by_date.transform("std")
+    total = z.notna().mul(weights).sum(axis=1)
+    return ((z * weights).sum(axis=1, min_count=1) / total.where(total != 0)).to_numpy()
+
+
+def main(start_date, end_date):
    
     cfg_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'config', 'paths.yaml'))
 
     with open(cfg_path, 'r', encoding='utf-8') as f:
         cfg = yaml.safe_load(f) or {}
 
-    provider_uri = cfg['provider_uri']
-    qlib.init(provider_uri=provider_uri)
-
-    model_path = cfg['model_path']
-
-    model = pickle.load(open(model_path, "rb"))
-    print("模型加载成功")
-    
-
-    instruments = D.instruments(market="all")
-    handler_config = {
-        "start_time": TARGET_PREDICT_DATE, 
-        "end_time": TARGET_PREDICT_DATE,
-        "instruments": instruments
-    }
-
-    dataset_config = {
-        "class": "DatasetH",
-        "module_path": "qlib.data.dataset",
-        "kwargs": {
-            "handler": {
-                "class": "Alpha158",
-                "module_path": "qlib.contrib.data.handler",
-                "kwargs": handler_config
-            },
-            "segments": {
-                "test": [TARGET_PREDICT_DATE, TARGET_PREDICT_DATE]
-            }
-        }
-    }
-    
-    # 禁用并行处理
-    os.environ["QLIB_DISABLE_MP"] = "1"  
-    dataset = init_instance_by_config(dataset_config)
-    test_df = dataset.prepare("test")
-    pred = model.predict(dataset)
-    pred_values = pred.values if isinstance(pred, pd.Series) else pred.ravel()
-
-    pred_df = (
-        pd.DataFrame({
-            "valuation_date": test_df.index.get_level_values("datetime"),
-            "code": test_df.index.get_level_values("instrument"),
-            "final_score": pred_values,
-            "score_name": "vp08",
-            "update_time": datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        })
-        .sort_values("final_score", ascending=False)
-    )
-
-
-    filename = f"prediction_{TARGET_PREDICT_DATE.replace('-', '')}.csv"
-    OUTPUT_DIR = cfg['prediction_output_dir']
-    output_path = os.path.join(OUTPUT_DIR, filename)
-    os.makedirs(OUTPUT_DIR, exist_ok=True)
-    pred_df.to_csv(output_path, index=False)
-    print(f"预测结果已保存到 {output_path}")
-
     db_yaml_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'config', 'db.yaml'))
-
     with open(db_yaml_path, 'r', encoding='utf-8') as f:
         db_cfg = yaml.safe_load(f) or {}
 
-    importer = MySQLImporter(db_yaml_path)
+    # 结果先写入本地队列后立即返回，由后台线程写入数据库；网络故障时保留在队列中下次继续写入
+    publisher = SpoolPublisher.from_config(cfg, db_config_path=db_yaml_path)
+    # 队列重放按主键 upsert 才是幂等的：启动时确认表有该唯一键（缺少时添加），有重复行无法添加时直接报错退出
+    publisher.ensure_unique_key(db_cfg['table_name'], PK_FIELDS)
+
+    provider_uri = cfg['provider_uri']
+    init_qlib(provider_uri)
+
+    # 使用 LightGBM 原生 booster 直接预测，跳过 LGBModel.predict 中重复的 prepare
+    fast_predict = cfg.get('fast_predict', False)
+
+    # scoring_universe: 只对优化器实际使用的股票池（如 zz3800）打分，留空则为全市场
+    if cfg.get('scoring_universe'):
+        instruments = universe_instruments(cfg['scoring_universe'], start_date, end_date,
+                                           cfg.get('scoring_universe_margin_days', DEFAULT_MARGIN_DAYS))
+        print(f"打分股票池 {cfg['scoring_universe']}: {len(instruments)} 只")
+    else:
+        instruments = D.instruments(market="all")
+    # 整个日期区间只构建一个 handler，lookback_days 为区间起点之前额外加载的自然日
+    # prune_features: split / topk 时只计算模型实际用到的 Alpha158 特征，其余列填 NaN
+    handler = None
+    if cfg.get('prune_features'):
+        handler = pruned_handler([spec['model_path'] for spec in model_specs(cfg)],
+                                 cfg['prune_features'], cfg.get('prune_top_k'))
+        print(f"裁剪特征: 计算 {len(handler['kwargs']['keep_features'])} 个特征")
+    dataset_config = build_dataset_config(instruments, start_date, end_date, cfg.get('lookback_days', 0), handler)
+    blend_cfg = cfg.get('blend')
+
+    # 预测缓存：模型文件、日期区间、bin 数据版本和 handler 配置都未变时，直接复用上次的分数
+    cache = PredictionCache.from_config(cfg)
+    pred_df = None
+    if cache is not None:
+        cache_key = PredictionCache.make_key(
+            {spec['score_name']: file_sha256(spec['model_path']) for spec in model_specs(cfg)},
+            start_date, end_date, bin_data_version(provider_uri, end_date), dataset_config,
+            options={'fast_predict': fast_predict, 'blend': blend_cfg,
+                     'feature_engine': cfg.get('feature_engine', 'qlib')},
+        )
+        pred_df = cache.get(cache_key, start_date, end_date)
+        if pred_df is not None:
+            print("命中预测缓存，跳过特征计算和预测")
+
+    if pred_df is None:
+        models = load_models(cfg, fast_predict)
+        print(f"模型加载成功: {', '.join(models)}")
+
+        feature_workers = cfg.get('feature_workers') or 1
+        if cfg.get('feature_engine') == 'panel':
+            # 向量化面板引擎：直接读取 bin 文件，对所有股票一次性计算 Alpha158
+            dataset = build_panel_dataset(provider_uri, instruments, start_date, end_date, handler=handler)
+        elif feature_workers > 1:
+            # 按排序后的股票切片多进程计算特征，合并结果与单进程一致
+            dataset = build_dataset(provider_uri, instruments, start_date, end_date,
+                                    feature_workers, cfg.get('lookback_days', 0), handler=handler)
+        else:
+            # 禁用并行处理
+            os.environ["QLIB_DISABLE_MP"] = "1"  
+            dataset = init_instance_by_config(dataset_config)
+        index, scores = predict_all(models, dataset, fast_predict)
+
+        if blend_cfg:
+            scores[blend_cfg['score_name']] = blend_scores(index, scores, blend_cfg)
+
+        pred_df = (
+            pd.concat([
+                pd.DataFrame({
+                    "valuation_date": index.get_level_values("datetime"),
+                    "code": index.get_level_values("instrument"),
+                    "final_score": pred_values,
+                    "score_name": score_name,
+                })
+                for score_name, pred_values in scores.items()
+            ], ignore_index=True)
+            .sort_values(["score_name", "final_score"], ascending=[True, False])
+        )
+        if cache is not None:
+            cache.put(cache_key, start_date, end_date, pred_df)
+
+    pred_df = pred_df.assign(update_time=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+
+
+    OUTPUT_DIR = cfg['prediction_output_dir']
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    for valuation_date, day_df in pred_df.groupby("valuation_date", sort=True):
+        filename = f"prediction_{pd.Timestamp(valuation_date).strftime('%Y%m%d')}.csv"
+        output_path = os.path.join(OUTPUT_DIR, filename)
+        day_df.to_csv(output_path, index=False)
+        print(f"预测结果已保存到 {output_path}")
+
     schema = [
         {'field': 'valuation_date', 'type': 'DATE'},
         {'field': 'code', 'type': 'VARCHAR(50)'},
@@ -101,26 +209,37 @@ def main():
     ]
 
  
-    importer.df_to_mysql(pred_df, db_cfg['table_name'], schema)
- 
-    print(f"预测结果已保存到数据库")
+    # 显式传入主键：队列重放时按 (日期, 代码, 分数名) upsert，重复写入结果不变
+    publisher.publish(pred_df, db_cfg['table_name'], schema, pk_fields=PK_FIELDS)
+    publisher.close(timeout=cfg.get('publish_wait_seconds', 60))
+    n_pending, _ = publisher.pending()
+    print("预测结果已保存到数据库" if not n_pending else f"预测结果已写入本地队列，{n_pending} 批待写入数据库")
 
 
 if __name__ == '__main__':
-    # TARGET_PREDICT_DATE = ("2025-07-31")
-    custom_path  = os.getenv('GLOBAL_TOOLSFUNC_test')
-    sys.path.append(custom_path )
-    import global_tools as gt
-    date = datetime.now().time()
-    date_str = datetime.now().strftime('%Y-%m-%d')
-  
-    if gt.is_workday(date_str) == False:
-        TARGET_PREDICT_DATE = gt.last_workday_calculate(date_str)
-    elif date <= time(19, 0):
-        TARGET_PREDICT_DATE = gt.last_workday_calculate(date_str)
+    parser = argparse.ArgumentParser(description="Score one date, or every trading day in [--start, --end]")
+    parser.add_argument("--start", help="区间起始日期 YYYY-MM-DD（补跑模式）")
+    parser.add_argument("--end", help="区间结束日期 YYYY-MM-DD，缺省等于 --start")
+    args = parser.parse_args()
+
+    if args.start:
+        START_DATE, END_DATE = args.start, args.end or args.start
     else:
-        TARGET_PREDICT_DATE = date_str
-    sys.path = original_sys_path  
+        # TARGET_PREDICT_DATE = ("2025-07-31")
+        custom_path  = os.getenv('GLOBAL_TOOLSFUNC_test')
+        sys.path.append(custom_path )
+        import global_tools as gt
+        date = datetime.now().time()
+        date_str = datetime.now().strftime('%Y-%m-%d')
+      
+        if gt.is_workday(date_str) == False:
+            TARGET_PREDICT_DATE = gt.last_workday_calculate(date_str)
+        elif date <= time(19, 0):
+            TARGET_PREDICT_DATE = gt.last_workday_calculate(date_str)
+        else:
+            TARGET_PREDICT_DATE = date_str
+        sys.path = original_sys_path  
+        START_DATE = END_DATE = TARGET_PREDICT_DATE
    
     freeze_support()  
-    main()
\ No newline at end of file
+    main(START_DATE, END_DATE)
\ No newline at end of file